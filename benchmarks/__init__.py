@@ -0,0 +1,3 @@
+"""
+Offline benchmarks for haikubot
+"""
\ No newline at end of file
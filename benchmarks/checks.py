@@ -0,0 +1,96 @@
+"""
+Offline regression checks of behaviour that is hard to see in a benchmark run,
+using the in-memory stand-ins from benchmarks.fakes. Run from the repository root:
+
+    python -m benchmarks.checks
+"""
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import traceback
+from typing import AsyncIterator, Callable, List
+
+# The application reads these at import time; the checks never talk to real services
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_KEY", "benchmark")
+os.environ.setdefault("TELEGRAM_TOKEN", "benchmark")
+
+import sync_data
+from utils.telegram_stream import reply_streaming
+from benchmarks.fakes import FakeBot, SyncFakeSupabase, make_update
+
+def check_sync_late_rows() -> None:
+    """
+    A message written after an incremental sync, with a created_at older than the newest
+    synced row (the bot writes messages in batches after they arrive), is still copied
+    """
+    prod, dev = SyncFakeSupabase(), SyncFakeSupabase()
+    now = datetime.datetime.now()
+
+    def message(message_id: int, age: datetime.timedelta) -> dict:
+        return {"id": message_id, "chat_id": -1, "tg_id": message_id, "user_id": 1, "text": f"m{message_id}",
+                "created_at": (now - age).isoformat()}
+
+    prod.tables["users"].append({"id": 1, "user_id": 1, "first_name": "A",
+                                 "created_at": (now - datetime.timedelta(days=1)).isoformat()})
+    prod.tables["messages"] += [message(1, datetime.timedelta(hours=1)), message(3, datetime.timedelta(minutes=5))]
+    clients = sync_data.get_supabase_client
+    sync_data.get_supabase_client = lambda is_prod=False: prod if is_prod else dev
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            state_file = os.path.join(tmp, "state.json")
+            sync_data.sync_data(days_back=1, incremental=True, state_file=state_file, safety_lag=600)
+            # Received before message 3, written after the sync
+            prod.tables["messages"].append(message(2, datetime.timedelta(minutes=6)))
+            # Later, once nothing newer than the watermark can be in flight
+            sync_data.sync_data(days_back=1, incremental=True, state_file=state_file, safety_lag=0)
+    finally:
+        sync_data.get_supabase_client = clients
+    synced = sorted(row["id"] for row in dev.tables["messages"])
+    assert synced == [1, 2, 3], f"synced messages {synced}"
+
+def check_stream_long_response() -> None:
+    """
+    A streamed response longer than one Telegram message is shown in full,
+    continued in follow-up messages
+    """
+    bot = FakeBot()
+    update = make_update(bot, 1, -1, 1, "/ask 1d Підсумуй")
+    words = [f"слово{i}" for i in range(2000)]
+
+    async def chunks() -> AsyncIterator[str]:
+        for i in range(0, len(words), 100):
+            yield " ".join(words[i:i + 100]) + " "
+
+    prefix = "📊 Аналіз за останні 1d:\n\n"
+    response = asyncio.run(reply_streaming(update.message, chunks(), prefix=prefix, min_interval=0))
+    assert len(prefix + response) > bot.max_message_length, "the response fits into one message"
+    texts = [bot.texts[(-1, message.message_id)] for message in bot.sent]
+    assert len(texts) > 1, f"{len(texts)} messages sent"
+    assert " ".join(texts).split() == (prefix + response).split(), "the shown text differs from the response"
+
+CHECKS: List[Callable[[], None]] = [
+    check_sync_late_rows,
+    check_stream_long_response,
+]
+
+def main():
+    """
+    Entry point of the checks
+    """
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+            print(f"ok   {check.__name__}")
+        except Exception:
+            failed += 1
+            print(f"FAIL {check.__name__}")
+            traceback.print_exc()
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
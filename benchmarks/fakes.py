@@ -0,0 +1,569 @@
+"""
+In-memory stand-ins for Supabase (PostgREST), OpenAI and the Telegram Bot API
+"""
+import asyncio
+import datetime
+import itertools
+import json
+import math
+import re
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+import httpx
+from telegram import Chat, Message, Update, User
+from telegram.error import BadRequest
+
+# --- Supabase
+
+def _split_top_level(expr: str) -> List[str]:
+    # Split a PostgREST logic expression on commas outside of parentheses and quotes
+    parts, depth, quoted, current = [], 0, False, ""
+    for ch in expr:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == "(":
+            depth += 1
+        elif not quoted and ch == ")":
+            depth -= 1
+        elif not quoted and depth == 0 and ch == ",":
+            parts.append(current)
+            current = ""
+            continue
+        current += ch
+    parts.append(current)
+    return parts
+
+def _parse_logic(expr: str) -> tuple:
+    match = re.match(r"^(and|or)\((.*)\)$", expr, re.S)
+    if match:
+        return (match.group(1), [_parse_logic(part) for part in _split_top_level(match.group(2))])
+    column, op, value = expr.split(".", 2)
+    if value.startswith('"'):
+        value = value[1:-1]
+    else:
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+    return ("cmp", column, op, value)
+
+def _normalize(value: Any) -> Any:
+    # Timestamps are compared as strings, so drop the UTC offset the client may add
+    if isinstance(value, str) and re.match(r"^\d{4}-\d\d-\d\dT", value):
+        return value.replace("+00:00", "")
+    return value
+
+COMPARISONS: Dict[str, Callable[[Any, Any], bool]] = {
+    "eq": lambda x, v: x == v,
+    "neq": lambda x, v: x != v,
+    "gt": lambda x, v: x > v,
+    "gte": lambda x, v: x >= v,
+    "lt": lambda x, v: x < v,
+    "lte": lambda x, v: x <= v,
+}
+
+def _eval_logic(tree: tuple, row: Dict[str, Any]) -> bool:
+    if tree[0] == "and":
+        return all(_eval_logic(child, row) for child in tree[1])
+    if tree[0] == "or":
+        return any(_eval_logic(child, row) for child in tree[1])
+    _, column, op, value = tree
+    current = _normalize(row.get(column))
+    if current is None:
+        return False
+    return COMPARISONS[op](current, _normalize(value))
+
+class FakeResponse:
+    """
+    Result of an executed query, like postgrest's APIResponse
+    """
+
+    def __init__(self, data: Any, count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+class FakeQuery:
+    """
+    Subset of the postgrest request builder used by the bot, evaluated in memory
+    """
+
+    def __init__(self, db: "FakeSupabase", table: str):
+        self.db = db
+        self.table = table
+        self.op = "select"
+        self.columns = "*"
+        self.filters: List[Callable[[Dict[str, Any]], bool]] = []
+        self.orders: List[tuple] = []
+        self.limit_rows: Optional[int] = None
+        self.single_row = False
+        self.maybe_single_row = False
+        self.payload: Any = None
+        self.on_conflict = ""
+        self.ignore_duplicates = False
+
+    def select(self, columns: str = "*", count: Optional[str] = None) -> "FakeQuery":
+        self.columns = columns
+        return self
+
+    def insert(self, payload: Any, **kwargs) -> "FakeQuery":
+        self.op, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload: Any, on_conflict: str = "", ignore_duplicates: bool = False, **kwargs) -> "FakeQuery":
+        self.op, self.payload = "upsert", payload
+        self.on_conflict, self.ignore_duplicates = on_conflict, ignore_duplicates
+        return self
+
+    def update(self, payload: Dict[str, Any]) -> "FakeQuery":
+        self.op, self.payload = "update", payload
+        return self
+
+    def delete(self) -> "FakeQuery":
+        self.op = "delete"
+        return self
+
+    def _compare(self, op: str, column: str, value: Any) -> "FakeQuery":
+        value = _normalize(value)
+
+        def check(row: Dict[str, Any]) -> bool:
+            current = _normalize(row.get(column))
+            return current is not None and COMPARISONS[op](current, value)
+
+        self.filters.append(check)
+        return self
+
+    def eq(self, column: str, value: Any) -> "FakeQuery":
+        return self._compare("eq", column, value)
+
+    def neq(self, column: str, value: Any) -> "FakeQuery":
+        return self._compare("neq", column, value)
+
+    def gt(self, column: str, value: Any) -> "FakeQuery":
+        return self._compare("gt", column, value)
+
+    def gte(self, column: str, value: Any) -> "FakeQuery":
+        return self._compare("gte", column, value)
+
+    def lt(self, column: str, value: Any) -> "FakeQuery":
+        return self._compare("lt", column, value)
+
+    def lte(self, column: str, value: Any) -> "FakeQuery":
+        return self._compare("lte", column, value)
+
+    def in_(self, column: str, values: Any) -> "FakeQuery":
+        values = set(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def or_(self, expr: str) -> "FakeQuery":
+        tree = _parse_logic(f"or({expr})")
+        self.filters.append(lambda row: _eval_logic(tree, row))
+        return self
+
+    def order(self, column: str, desc: bool = False) -> "FakeQuery":
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, rows: int) -> "FakeQuery":
+        self.limit_rows = rows
+        return self
+
+    def single(self) -> "FakeQuery":
+        self.single_row = True
+        return self
+
+    def maybe_single(self) -> "FakeQuery":
+        self.maybe_single_row = True
+        return self
+
+    def _matches(self, row: Dict[str, Any]) -> bool:
+        return all(check(row) for check in self.filters)
+
+    def _select(self, rows: List[Dict[str, Any]]) -> FakeResponse:
+        out = [row for row in rows if self._matches(row)]
+        for column, desc in reversed(self.orders):
+            out.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+        if self.limit_rows is not None:
+            out = out[:self.limit_rows]
+        if self.columns.strip() != "*":
+            columns = [column.strip() for column in self.columns.split(",")]
+            out = [{column: row.get(column) for column in columns} for row in out]
+        else:
+            out = [dict(row) for row in out]
+        if self.single_row:
+            if len(out) != 1:
+                raise RuntimeError("JSON object requested, multiple (or no) rows returned")
+            return FakeResponse(out[0])
+        if self.maybe_single_row:
+            return FakeResponse(out[0] if out else None)
+        return FakeResponse(out)
+
+    def _write(self, rows: List[Dict[str, Any]]) -> FakeResponse:
+        payload = self.payload if isinstance(self.payload, list) else [self.payload]
+        keys = [key.strip() for key in self.on_conflict.split(",") if key.strip()]
+        out = []
+        for item in payload:
+            item = dict(item)
+            if self.op == "upsert" and keys:
+                existing = next((row for row in rows if all(row.get(k) == item.get(k) for k in keys)), None)
+                if existing is not None:
+                    if not self.ignore_duplicates:
+                        existing.update(item)
+                        out.append(dict(existing))
+                    continue
+            item.setdefault("id", next(self.db.ids[self.table]))
+            item.setdefault("created_at", datetime.datetime.now().isoformat())
+            rows.append(item)
+            out.append(dict(item))
+        return FakeResponse(out)
+
+    async def execute(self) -> FakeResponse:
+        self.db.calls += 1
+        self.db.calls_by_table[self.table] = self.db.calls_by_table.get(self.table, 0) + 1
+        if self.db.latency:
+            await asyncio.sleep(self.db.latency)
+        if self.table in self.db.views:
+            rows = self.db.views[self.table](self.db)
+        else:
+            rows = self.db.tables.setdefault(self.table, [])
+        if self.op == "select":
+            return self._select(rows)
+        if self.op in ("insert", "upsert"):
+            return self._write(rows)
+        if self.op == "update":
+            out = []
+            for row in rows:
+                if self._matches(row):
+                    row.update(self.payload)
+                    out.append(dict(row))
+            return FakeResponse(out)
+        if self.op == "delete":
+            kept = [row for row in rows if not self._matches(row)]
+            removed = len(rows) - len(kept)
+            rows[:] = kept
+            return FakeResponse([None] * removed)
+        raise ValueError(f"Unsupported operation: {self.op}")
+
+def chat_history_view(db: "FakeSupabase") -> List[Dict[str, Any]]:
+    """
+    Rows of the chat_history view: messages joined with their authors
+    """
+    users = {user["user_id"]: user for user in db.tables["users"]}
+    rows = []
+    for message in db.tables["messages"]:
+        user = users.get(message["user_id"])
+        if user is None:
+            continue
+        from_user = f"{user.get('first_name') or ''} {user.get('last_name') or ''}".strip()
+        rows.append(dict(message, from_user=from_user, is_bot=bool(user.get("isBot"))))
+    return rows
+
+def get_haiku_with_sources(db: "FakeSupabase", p_chat_id: int, p_tg_id: int) -> Optional[Dict[str, Any]]:
+    """
+    The get_haiku_with_sources RPC
+    """
+    haiku = next((m for m in db.tables["messages"]
+                  if m.get("chat_id") == p_chat_id and m.get("tg_id") == p_tg_id), None)
+    if haiku is None:
+        return None
+    history = {row["id"]: row for row in chat_history_view(db)}
+    sources = [
+        {key: history[source_id][key] for key in ("id", "tg_id", "from_user", "text", "created_at")}
+        for source_id in haiku.get("haiku_source_ids") or [] if source_id in history
+    ]
+    return {"haiku": {key: haiku.get(key) for key in ("id", "tg_id", "text", "created_at")}, "sources": sources}
+
+def set_message_embeddings(db: "FakeSupabase", p_rows: List[Dict[str, Any]]) -> None:
+    """
+    The set_message_embeddings RPC
+    """
+    embeddings = {row["id"]: row["embedding"] for row in p_rows}
+    for message in db.tables["messages"]:
+        if message["id"] in embeddings:
+            message["embedding"] = embeddings[message["id"]]
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return sum(x * y for x, y in zip(a, b)) / norm if norm else 0.0
+
+def match_chat_messages(db: "FakeSupabase", p_chat_id: int, p_embedding: List[float], p_start: str, p_end: str,
+                        p_match_count: int = 20, p_neighbours: int = 2) -> List[Dict[str, Any]]:
+    """
+    The match_chat_messages RPC
+    """
+    start, end = _normalize(p_start), _normalize(p_end)
+    period = sorted(
+        (row for row in chat_history_view(db)
+         if row["chat_id"] == p_chat_id and start <= _normalize(row["created_at"]) < end and not row["is_bot"]),
+        key=lambda row: (row["created_at"], row["id"])
+    )
+    embeddings = {message["id"]: message.get("embedding") for message in db.tables["messages"]}
+    scored = sorted(
+        ((_cosine(embeddings[row["id"]], p_embedding), position) for position, row in enumerate(period, 1)
+         if embeddings.get(row["id"])),
+        reverse=True
+    )[:p_match_count]
+    similarity: Dict[int, float] = {}
+    for score, position in scored:
+        for neighbour in range(max(1, position - p_neighbours), min(len(period), position + p_neighbours) + 1):
+            similarity[neighbour] = max(similarity.get(neighbour, -1.0), score)
+    return [
+        dict({key: period[position - 1][key] for key in ("id", "tg_id", "from_user", "text", "created_at")},
+             position=position, similarity=similarity[position])
+        for position in sorted(similarity)
+    ]
+
+def chat_embedding_coverage(db: "FakeSupabase", p_chat_id: int, p_start: str, p_end: str) -> List[Dict[str, Any]]:
+    """
+    The chat_embedding_coverage RPC
+    """
+    start, end = _normalize(p_start), _normalize(p_end)
+    embedded = {message["id"] for message in db.tables["messages"] if message.get("embedding")}
+    period = [
+        row["id"] for row in chat_history_view(db)
+        if row["chat_id"] == p_chat_id and start <= _normalize(row["created_at"]) < end and not row["is_bot"]
+    ]
+    return [{"total": len(period), "embedded": sum(1 for message_id in period if message_id in embedded)}]
+
+def search_chat_messages(db: "FakeSupabase", p_chat_id: int, p_query: str, p_start: Optional[str] = None,
+                         p_end: Optional[str] = None, p_limit: int = 200) -> List[Dict[str, Any]]:
+    """
+    The search_chat_messages RPC: every query word must start a word of the message
+    """
+    words = [word[:-2] if len(word) > 5 else word for word in re.findall(r"\w+", p_query.lower())]
+    if not words:
+        return []
+    rows = []
+    for row in chat_history_view(db):
+        created_at = _normalize(row["created_at"])
+        if row["chat_id"] != p_chat_id or row["is_bot"]:
+            continue
+        if (p_start and created_at < _normalize(p_start)) or (p_end and created_at >= _normalize(p_end)):
+            continue
+        text_words = re.findall(r"\w+", (row.get("text") or "").lower())
+        if all(any(text_word.startswith(word) for text_word in text_words) for word in words):
+            rows.append(dict({key: row[key] for key in ("id", "tg_id", "from_user", "text", "created_at")}, rank=1.0))
+    rows.sort(key=lambda row: row["created_at"], reverse=True)
+    return rows[:p_limit]
+
+class FakeSupabase:
+    """
+    In-memory stand-in for supabase's AsyncClient that counts the queries it serves.
+    Can be assigned to db_service._supabase.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        """
+        Args:
+            latency: Seconds every query waits, to emulate a network round trip
+        """
+        self.latency = latency
+        self.tables: Dict[str, List[Dict[str, Any]]] = {"users": [], "messages": []}
+        self.ids: Dict[str, Any] = {}
+        self.calls = 0
+        self.calls_by_table: Dict[str, int] = {}
+        self.views = {"chat_history": chat_history_view}
+        self.rpcs: Dict[str, Callable[..., Any]] = {
+            "get_haiku_with_sources": get_haiku_with_sources,
+            "set_message_embeddings": set_message_embeddings,
+            "match_chat_messages": match_chat_messages,
+            "chat_embedding_coverage": chat_embedding_coverage,
+            "search_chat_messages": search_chat_messages,
+        }
+        self.postgrest = SimpleNamespace(aclose=self._aclose)
+
+    async def _aclose(self) -> None:
+        pass
+
+    def table(self, name: str) -> FakeQuery:
+        self.ids.setdefault(name, itertools.count(1))
+        return FakeQuery(self, name)
+
+    from_ = table
+
+    def rpc(self, name: str, params: Optional[Dict[str, Any]] = None) -> SimpleNamespace:
+        async def execute() -> FakeResponse:
+            self.calls += 1
+            key = f"rpc:{name}"
+            self.calls_by_table[key] = self.calls_by_table.get(key, 0) + 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return FakeResponse(self.rpcs[name](self, **(params or {})))
+
+        return SimpleNamespace(execute=execute)
+
+class SyncFakeQuery(FakeQuery):
+    """
+    FakeQuery with a blocking execute(), like the request builder of supabase's sync Client
+    """
+
+    def execute(self) -> FakeResponse:
+        # The sync client is also used from worker threads (see sync_data.BatchWriter)
+        with self.db.lock:
+            return asyncio.run(FakeQuery.execute(self))
+
+class SyncFakeSupabase(FakeSupabase):
+    """
+    In-memory stand-in for supabase's sync Client, as used by sync_data and snapshot
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.lock = threading.Lock()
+
+    def table(self, name: str) -> SyncFakeQuery:
+        self.ids.setdefault(name, itertools.count(1))
+        return SyncFakeQuery(self, name)
+
+    from_ = table
+
+# --- OpenAI
+
+def _fake_embedding(text: str, dimensions: int = 8) -> List[float]:
+    # Bag of words hashed into a few dimensions, so texts sharing words are similar
+    vector = [0.0] * dimensions
+    for word in re.findall(r"\w+", text.lower()):
+        vector[zlib.crc32(word.encode()) % dimensions] += 1.0
+    return vector
+
+class FakeOpenAI:
+    """
+    httpx transport answering chat completion (plain and streamed) and embedding requests
+    """
+
+    def __init__(self, latency: float = 0.0, stream_chunks: int = 5):
+        """
+        Args:
+            latency: Seconds before a response is returned
+            stream_chunks: Number of chunks in a streamed response
+        """
+        self.latency = latency
+        self.stream_chunks = stream_chunks
+        self.calls = 0
+        self.requests: List[Dict[str, Any]] = []
+
+    def transport(self) -> httpx.AsyncBaseTransport:
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        body = json.loads(request.content)
+        self.requests.append(body)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.url.path.endswith("/embeddings"):
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            return httpx.Response(200, json={
+                "object": "list", "model": body["model"],
+                "data": [{"object": "embedding", "index": i, "embedding": _fake_embedding(text)}
+                         for i, text in enumerate(inputs)],
+                "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+            })
+        text = f"Відповідь {self.calls}"
+        if body.get("stream"):
+            events = []
+            for i in range(self.stream_chunks):
+                chunk = {"id": "fake", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                         "choices": [{"index": 0, "delta": {"content": f"{text} ({i}) "}, "finish_reason": None}]}
+                events.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+            events.append("data: [DONE]\n\n")
+            return httpx.Response(200, content="".join(events).encode(), headers={"content-type": "text/event-stream"})
+        return httpx.Response(200, json={
+            "id": "fake", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 3, "total_tokens": 13},
+        })
+
+# --- Telegram
+
+class FakeBot:
+    """
+    Stand-in for telegram.Bot that records sent and edited messages, and when each
+    message was last answered (a reply to it sent, or such a reply edited)
+    """
+
+    def __init__(self, latency: float = 0.0):
+        """
+        Args:
+            latency: Seconds every Bot API call waits
+        """
+        self.latency = latency
+        self.user = User(id=1, first_name="Haiku", is_bot=True, username="haikubot")
+        self.sent: List[Message] = []
+        self.edits = 0
+        # (chat_id, message_id) -> perf_counter() of the last reply to it or edit of that reply, and its text
+        self.answered_at: Dict[tuple, float] = {}
+        self.answers: Dict[tuple, str] = {}
+        # (chat_id, message_id) -> current text of every sent message
+        self.texts: Dict[tuple, str] = {}
+        # (chat_id, reply message_id) -> message_id it replies to
+        self._replies_to: Dict[tuple, int] = {}
+        self._message_ids = itertools.count(10_000_000)
+        self.max_message_length = 4096
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> Message:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self._check_length(text)
+        message = Message(message_id=next(self._message_ids), date=datetime.datetime.now(datetime.timezone.utc),
+                          chat=Chat(chat_id, Chat.SUPERGROUP), from_user=self.user, text=text)
+        message.set_bot(self)
+        self.sent.append(message)
+        self.texts[(chat_id, message.message_id)] = text
+        reply_parameters = kwargs.get("reply_parameters")
+        if reply_parameters is not None:
+            self._replies_to[(chat_id, message.message_id)] = reply_parameters.message_id
+            self.answered_at[(chat_id, reply_parameters.message_id)] = time.perf_counter()
+            self.answers[(chat_id, reply_parameters.message_id)] = text
+        return message
+
+    async def edit_message_text(self, text: str, chat_id: Optional[int] = None,
+                                message_id: Optional[int] = None, **kwargs) -> bool:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self._check_length(text)
+        self.edits += 1
+        self.texts[(chat_id, message_id)] = text
+        replied = self._replies_to.get((chat_id, message_id))
+        if replied is not None:
+            self.answered_at[(chat_id, replied)] = time.perf_counter()
+            self.answers[(chat_id, replied)] = text
+        return True
+
+    def _check_length(self, text: str) -> None:
+        # Like the Bot API, reject texts over the message length limit instead of cutting them
+        if len(text) > self.max_message_length:
+            raise BadRequest("Message is too long")
+
+    async def delete_message(self, chat_id: int, message_id: int, **kwargs) -> bool:
+        return True
+
+def make_update(bot: FakeBot, update_id: int, chat_id: int, user_id: int, text: str,
+                reply_to: Optional[Message] = None) -> Update:
+    """
+    Build a group chat text message update
+
+    Args:
+        bot: Bot the message is bound to (used by reply_text)
+        update_id: Update ID, also used as the message ID
+        chat_id: Telegram chat ID
+        user_id: Telegram user ID of the author
+        text: Message text
+        reply_to: Message this one replies to
+
+    Returns:
+        Update with the message
+    """
+    message = Message(
+        message_id=update_id,
+        date=datetime.datetime.now(datetime.timezone.utc),
+        chat=Chat(chat_id, Chat.SUPERGROUP),
+        from_user=User(id=user_id, first_name=f"User{user_id}", last_name="Test", is_bot=False),
+        text=text,
+        reply_to_message=reply_to,
+    )
+    message.set_bot(bot)
+    return Update(update_id=update_id, message=message)
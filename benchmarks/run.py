@@ -0,0 +1,264 @@
+"""
+Offline throughput benchmark of the message and /ask hot paths.
+
+Synthetic updates are fed straight into haikubot.handle_message and
+handle_query_command, with Supabase, OpenAI and Telegram replaced by the
+in-memory stand-ins from benchmarks.fakes. Run from the repository root:
+
+    python -m benchmarks.run --messages 2000 --chats 5 --db-latency 0.02 --llm-latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional, Set
+
+# The application reads these at import time; the benchmark never talks to real services
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_KEY", "benchmark")
+os.environ.setdefault("TELEGRAM_TOKEN", "benchmark")
+
+import httpx
+from openai import AsyncOpenAI
+import db_service
+import haikubot
+from handlers.query_handler import handle_query_command, BUSY_MESSAGE
+from utils import openai_client
+from utils.ingestion import ingestor
+from utils.llm_jobs import llm_jobs
+from utils.response_cache import response_cache
+from utils.update_processor import ChatOrderedUpdateProcessor
+from benchmarks.fakes import FakeBot, FakeOpenAI, FakeSupabase, make_update
+
+ASK_QUERIES = [
+    "/ask 1h Про що говорили?",
+    "/ask 30m Хто був найактивнішим?",
+    "/ask 2h Які були головні теми?",
+]
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Get the q-th percentile (nearest rank) of values
+
+    Args:
+        values: Measurements
+        q: Percentile, 0-100
+
+    Returns:
+        float: The percentile, 0 if there are no values
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def latency_stats(latencies: List[float], prefix: str = "") -> Dict[str, float]:
+    return {
+        f"{prefix}p50_ms": percentile(latencies, 50) * 1000,
+        f"{prefix}p99_ms": percentile(latencies, 99) * 1000,
+        f"{prefix}max_ms": max(latencies, default=0.0) * 1000,
+    }
+
+class Timings:
+    """
+    Per-update timings of a run_handlers call, in seconds
+    """
+
+    def __init__(self):
+        # Time from submitting an update to the processor until its handler started
+        self.waits: List[float] = []
+        # Time the handler itself ran
+        self.handler: List[float] = []
+        # (chat_id, message_id) -> perf_counter() when the update's handler started and finished
+        self.started: Dict[tuple, float] = {}
+        self.finished: Dict[tuple, float] = {}
+
+async def run_handlers(handler, updates: List[Any], concurrency: int, timings: Optional[Timings] = None) -> Timings:
+    """
+    Run a handler over updates through the bot's update processor, with at most
+    `concurrency` updates in flight and updates of one chat in order.
+    All updates are submitted at once, so waiting for a turn is measured apart
+    from the handler's own latency.
+
+    Args:
+        timings: Timings to add to, e.g. of an earlier round
+
+    Returns:
+        Queue wait and handler latency of every update
+    """
+    processor = ChatOrderedUpdateProcessor(concurrency)
+    timings = timings if timings is not None else Timings()
+
+    async def run(update) -> None:
+        submitted = time.perf_counter()
+
+        async def timed() -> None:
+            started = time.perf_counter()
+            key = (update.effective_chat.id, update.message.message_id)
+            timings.waits.append(started - submitted)
+            timings.started[key] = started
+            try:
+                await handler(update, None)
+            finally:
+                timings.finished[key] = time.perf_counter()
+                timings.handler.append(timings.finished[key] - started)
+
+        await processor.process_update(update, timed())
+
+    async with processor:
+        await asyncio.gather(*(run(update) for update in updates))
+    return timings
+
+async def benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    random.seed(args.seed)
+    db = FakeSupabase(latency=args.db_latency)
+    llm = FakeOpenAI(latency=args.llm_latency)
+    bot = FakeBot(latency=args.telegram_latency)
+    db_service._supabase = db
+    openai_client.client = AsyncOpenAI(
+        api_key="benchmark", max_retries=0,
+        http_client=httpx.AsyncClient(transport=llm.transport())
+    )
+
+    chats = [-1000000000000 - i for i in range(args.chats)]
+    updates = [
+        make_update(bot, i + 1, random.choice(chats), random.randint(1, args.users),
+                    f"Повідомлення {i} про щось цікаве")
+        for i in range(args.messages)
+    ]
+
+    await haikubot.init(None)
+    started = time.perf_counter()
+    message_timings = await run_handlers(haikubot.handle_message, updates, args.concurrency)
+    # Haikus and messages are written in the background, so include them in the run
+    await llm_jobs.join()
+    await ingestor.flush()
+    messages_elapsed = time.perf_counter() - started
+    message_db_calls = db.calls
+    message_llm_calls = llm.calls
+
+    # Every /ask is a different question unless the cache-hit scenario is asked for
+    asks = [
+        make_update(bot, args.messages + i + 1, chats[i % len(chats)], 1,
+                    ASK_QUERIES[i % len(ASK_QUERIES)] + ("" if args.repeat_asks else f" ({i + 1})"))
+        for i in range(args.asks)
+    ]
+    # Repeated questions are asked once the first ones are answered, so they can hit the cache
+    # instead of being deduplicated while the first answer is still in progress
+    seen: Set[tuple] = set()
+    rounds: List[List[Any]] = [[], []]
+    for ask in asks:
+        pair = (ask.effective_chat.id, ask.message.text)
+        rounds[pair in seen].append(ask)
+        seen.add(pair)
+    cache_hits, cache_misses = response_cache.hits, response_cache.misses
+    started = time.perf_counter()
+    ask_timings = Timings()
+    for ask_round in rounds:
+        await run_handlers(handle_query_command, ask_round, args.concurrency, ask_timings)
+        await llm_jobs.join()
+    asks_elapsed = time.perf_counter() - started
+    # The handler only queues the answer; an /ask takes until its reply is sent (or last edited).
+    # Answers sent before the handler returned were served from the response cache
+    answer_latencies, hit_latencies, busy = [], [], 0
+    for key, started_at in ask_timings.started.items():
+        if bot.answers.get(key) == BUSY_MESSAGE:
+            busy += 1
+        elif key in bot.answered_at:
+            latencies = hit_latencies if bot.answered_at[key] <= ask_timings.finished[key] else answer_latencies
+            latencies.append(bot.answered_at[key] - started_at)
+
+    await haikubot.stop(None)
+    await haikubot.shutdown(None)
+
+    return {
+        "messages": {
+            "count": len(updates),
+            "elapsed_s": messages_elapsed,
+            "per_second": len(updates) / messages_elapsed if messages_elapsed else 0.0,
+            **latency_stats(message_timings.handler),
+            **latency_stats(message_timings.waits, "wait_"),
+            "db_calls_per_message": message_db_calls / len(updates) if updates else 0.0,
+            "llm_calls": message_llm_calls,
+        },
+        "ask": {
+            "count": len(asks),
+            "elapsed_s": asks_elapsed,
+            **latency_stats(answer_latencies),
+            "busy": busy,
+            "unanswered": len(asks) - len(answer_latencies) - len(hit_latencies) - busy,
+            "cache_hits": response_cache.hits - cache_hits,
+            "cache_misses": response_cache.misses - cache_misses,
+            **latency_stats(hit_latencies, "hit_"),
+            **latency_stats(ask_timings.handler, "handler_"),
+            **latency_stats(ask_timings.waits, "wait_"),
+            "db_calls_per_ask": (db.calls - message_db_calls) / len(asks) if asks else 0.0,
+            "llm_calls": llm.calls - message_llm_calls,
+        },
+        "db_calls_by_table": db.calls_by_table,
+        "telegram": {"sent": len(bot.sent), "edits": bot.edits},
+    }
+
+def print_report(result: Dict[str, Any]) -> None:
+    messages, ask = result["messages"], result["ask"]
+    print(f"Messages: {messages['count']} in {messages['elapsed_s']:.2f}s "
+          f"({messages['per_second']:.1f} msgs/sec)")
+    print(f"  handler latency p50={messages['p50_ms']:.1f}ms p99={messages['p99_ms']:.1f}ms "
+          f"max={messages['max_ms']:.1f}ms")
+    print(f"  queue wait p50={messages['wait_p50_ms']:.1f}ms p99={messages['wait_p99_ms']:.1f}ms "
+          f"max={messages['wait_max_ms']:.1f}ms")
+    print(f"  DB calls per message: {messages['db_calls_per_message']:.3f}, LLM calls: {messages['llm_calls']}")
+    print(f"/ask: {ask['count']} in {ask['elapsed_s']:.2f}s")
+    print(f"  response cache: {ask['cache_misses']} misses, {ask['cache_hits']} hits"
+          + (f", {ask['busy']} busy" if ask['busy'] else "")
+          + (f", {ask['unanswered']} unanswered" if ask['unanswered'] else ""))
+    print(f"  time to answer (miss) p50={ask['p50_ms']:.1f}ms p99={ask['p99_ms']:.1f}ms max={ask['max_ms']:.1f}ms")
+    if ask['cache_hits']:
+        print(f"  time to answer (hit) p50={ask['hit_p50_ms']:.1f}ms p99={ask['hit_p99_ms']:.1f}ms "
+              f"max={ask['hit_max_ms']:.1f}ms")
+    print(f"  handler latency p50={ask['handler_p50_ms']:.1f}ms p99={ask['handler_p99_ms']:.1f}ms "
+          f"max={ask['handler_max_ms']:.1f}ms")
+    print(f"  queue wait p50={ask['wait_p50_ms']:.1f}ms p99={ask['wait_p99_ms']:.1f}ms "
+          f"max={ask['wait_max_ms']:.1f}ms")
+    print(f"  DB calls per /ask: {ask['db_calls_per_ask']:.1f}, LLM calls: {ask['llm_calls']}")
+    print(f"DB calls by table: {result['db_calls_by_table']}")
+    print(f"Telegram: {result['telegram']['sent']} sent, {result['telegram']['edits']} edits")
+
+def main():
+    """
+    Entry point of the benchmark
+    """
+    parser = argparse.ArgumentParser(description="Offline benchmark of haikubot's message and /ask handlers")
+    parser.add_argument("--messages", type=int, default=1000, help="Number of chat messages (default: 1000)")
+    parser.add_argument("--chats", type=int, default=5, help="Number of chats (default: 5)")
+    parser.add_argument("--users", type=int, default=20, help="Number of distinct authors (default: 20)")
+    parser.add_argument("--asks", type=int, default=20, help="Number of /ask commands (default: 20)")
+    parser.add_argument("--repeat-asks", action="store_true",
+                        help="Cycle through the same few questions per chat, "
+                             "asking repeats once the first answers are cached")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Updates processed at the same time (default: 1)")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="Seconds per database query")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds per OpenAI request")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="Seconds per Bot API call")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Keep the bot's INFO logs")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    result = asyncio.run(benchmark(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 import os
+import re
+import asyncio
 import datetime
-from supabase import create_client, Client
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, AsyncIterator, Optional, List, Tuple
 from dotenv import load_dotenv
+from utils.config import DB_TIMEOUT, HISTORY_PAGE_SIZE, HISTORY_MAX_ROWS
+from utils.user_cache import user_cache
+from utils.metrics import observe_db
 
 # Load environment variables
 load_dotenv()
@@ -16,32 +21,71 @@ SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("SUPABASE_URL and SUPABASE_KEY environment variables must be set")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Shared async client, created lazily inside the running event loop.
+# Its PostgREST session is a single keep-alive HTTP/2 connection pool reused by every call.
+_supabase: Optional[AsyncClient] = None
+_supabase_lock: Optional[asyncio.Lock] = None
 
-def get_or_create_user(user_id: int, username: str, first_name: str, 
-                      last_name: Optional[str], is_bot: bool = False) -> Dict[str, Any]:
+async def get_client() -> AsyncClient:
     """
-    Get or create a user in the database
+    Get the shared async Supabase client, creating it on first use
+    
+    Returns:
+        Async Supabase client instance
+    """
+    global _supabase, _supabase_lock
+    if _supabase is not None:
+        return _supabase
+    if _supabase_lock is None:
+        _supabase_lock = asyncio.Lock()
+    async with _supabase_lock:
+        if _supabase is None:
+            _supabase = await acreate_client(
+                SUPABASE_URL,
+                SUPABASE_KEY,
+                options=AsyncClientOptions(postgrest_client_timeout=DB_TIMEOUT)
+            )
+    return _supabase
+
+async def close_client() -> None:
+    """
+    Close the shared Supabase client and its HTTP connections
+    """
+    global _supabase
+    if _supabase is not None:
+        await _supabase.postgrest.aclose()
+        _supabase = None
+
+def format_user_name(first_name: Optional[str], last_name: Optional[str]) -> str:
+    """
+    Format a user's display name the way it is shown in prompts
+    
+    Args:
+        first_name: User's first name
+        last_name: User's last name (can be None)
+        
+    Returns:
+        'First Last' string
+    """
+    return f"{first_name or ''} {last_name or ''}".strip()
+
+def build_user_data(user_id: int, username: str, first_name: str,
+                    last_name: Optional[str], is_bot: bool = False) -> Dict[str, Any]:
+    """
+    Build a users row for a newly seen Telegram user
     
     Args:
         user_id: Telegram user ID
         username: Telegram username
         first_name: User's first name
         last_name: User's last name (can be None)
+        is_bot: Whether the user is a bot
         
     Returns:
         Dictionary with the user data
     """
-    # Check if user exists
-    result = supabase.table("users").select("*").eq("user_id", user_id).execute()
-    
-    if result.data and len(result.data) > 0:
-        # User exists, return the user data
-        return result.data[0]
-    
-    # User doesn't exist, create new user
     now_iso = datetime.datetime.now().isoformat()
-    user_data = {
+    return {
         "user_id": user_id,
         "username": username,
         "first_name": first_name,
@@ -50,46 +94,125 @@ def get_or_create_user(user_id: int, username: str, first_name: str,
         "last_activity": now_iso,
         "isBot": is_bot
     }
+
+async def get_or_create_user(user_id: int, username: str, first_name: str, 
+                      last_name: Optional[str], is_bot: bool = False) -> Dict[str, Any]:
+    """
+    Get or create a user in the database
+    
+    Args:
+        user_id: Telegram user ID
+        username: Telegram username
+        first_name: User's first name
+        last_name: User's last name (can be None)
+        
+    Returns:
+        Dictionary with the user data
+    """
+    # Users almost never change once created, so known users skip the lookup
+    cached_user = user_cache.get(user_id)
+    if cached_user is not None:
+        return cached_user
+    
+    supabase = await get_client()
+    # Check if user exists
+    with observe_db("get_or_create_user"):
+        result = await supabase.table("users").select("*").eq("user_id", user_id).execute()
+    
+    if result.data and len(result.data) > 0:
+        # User exists, return the user data
+        user_cache.put(result.data[0])
+        return result.data[0]
+    
+    # User doesn't exist, create new user
+    user_data = build_user_data(user_id, username, first_name, last_name, is_bot)
     
     try:
         # Try to insert or update the user (upsert)
-        create_result = supabase.table("users").upsert(user_data, on_conflict=["user_id"]).execute()
-        return create_result.data[0] if create_result.data else user_data
+        with observe_db("get_or_create_user"):
+            create_result = await supabase.table("users").upsert(user_data, on_conflict="user_id").execute()
+        created_user = create_result.data[0] if create_result.data else user_data
+        user_cache.put(created_user, activity_written=True)
+        return created_user
     except Exception as e:
         # If duplicate error or any other, try to fetch and return the user
         logging.warning(f"get_or_create_user: {e}, trying to fetch existing user")
-        result = supabase.table("users").select("*").eq("user_id", user_id).execute()
+        with observe_db("get_or_create_user"):
+            result = await supabase.table("users").select("*").eq("user_id", user_id).execute()
         if result.data and len(result.data) > 0:
             return result.data[0]
         raise
 
-def update_user_last_activity(user_id: int) -> None:
+async def update_user_last_activity(user_id: int) -> None:
     """
-    Update user's last activity timestamp
+    Update user's last activity timestamp (at most once per configured interval)
     
     Args:
         user_id: Telegram user ID
     """
-    supabase.table("users").update({
-        "last_activity": datetime.datetime.now().isoformat()
-    }).eq("user_id", user_id).execute()
+    if not user_cache.should_update_activity(user_id):
+        return
+    supabase = await get_client()
+    with observe_db("update_user_last_activity"):
+        await supabase.table("users").update({
+            "last_activity": datetime.datetime.now().isoformat()
+        }).eq("user_id", user_id).execute()
 
-import json
+async def upsert_users(users: List[Dict[str, Any]]) -> None:
+    """
+    Create all users that don't exist yet in a single request (existing rows are left untouched).
+    Users already in the user cache are skipped.
+    
+    Args:
+        users: List of user rows built with build_user_data
+    """
+    users = [user for user in users if user_cache.get(user["user_id"]) is None]
+    if not users:
+        return
+    supabase = await get_client()
+    with observe_db("upsert_users"):
+        result = await supabase.table("users") \
+            .upsert(users, on_conflict="user_id", ignore_duplicates=True) \
+            .execute()
+    # Only newly created rows are returned; their last_activity is already fresh
+    created_ids = {user["user_id"] for user in result.data or []}
+    for user in users:
+        user_cache.put(user, activity_written=user["user_id"] in created_ids)
 
-def save_message(chat_id: int, user_id: int, text: str, haiku_source_ids: Optional[List[int]] = None, tg_id: Optional[int] = None) -> List[Dict[str, Any]]:
-    # TODO: Якщо повідомлення містить повідомлення бота, зберігати серіалізовані id повідомлень, для яких воно згенероване, в окремому полі (наприклад, 'generated_for_message_ids')
+async def update_users_last_activity(user_ids: List[int]) -> None:
     """
-    Save a message to the database
+    Update last activity timestamp for several users in a single request
+    (users updated less than the configured interval ago are skipped)
+    
+    Args:
+        user_ids: Telegram user IDs
+    """
+    user_ids = [user_id for user_id in user_ids if user_cache.should_update_activity(user_id)]
+    if not user_ids:
+        return
+    supabase = await get_client()
+    with observe_db("update_users_last_activity"):
+        await supabase.table("users").update({
+            "last_activity": datetime.datetime.now().isoformat()
+        }).in_("user_id", user_ids).execute()
+
+# Unique key of a Telegram message (messages_chat_id_tg_id_key)
+MESSAGE_CONFLICT_COLUMNS = "chat_id,tg_id"
+
+def build_message_data(chat_id: int, user_id: int, text: str, haiku_source_ids: Optional[List[int]] = None, tg_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Build a messages row
     
     Args:
         chat_id: Telegram chat ID
         user_id: Telegram user ID
         text: Message text
+        haiku_source_ids: IDs of the messages a haiku was generated from
+        tg_id: Telegram message ID
         
     Returns:
-        List containing the created message data
+        Dictionary with the message data
     """
-    # Create message data object
     message_data = {
         "chat_id": chat_id,
         "user_id": user_id,
@@ -97,91 +220,249 @@ def save_message(chat_id: int, user_id: int, text: str, haiku_source_ids: Option
         "created_at": datetime.datetime.now().isoformat()
     }
     if haiku_source_ids is not None:
-        message_data["haiku_source_ids"] = json.dumps(haiku_source_ids)
+        message_data["haiku_source_ids"] = haiku_source_ids
     if tg_id is not None:
         message_data["tg_id"] = tg_id
+    return message_data
+
+async def save_message(chat_id: int, user_id: int, text: str, haiku_source_ids: Optional[List[int]] = None, tg_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    # TODO: Якщо повідомлення містить повідомлення бота, зберігати серіалізовані id повідомлень, для яких воно згенероване, в окремому полі (наприклад, 'generated_for_message_ids')
+    """
+    Save a message to the database (nothing is written if the chat already has a message with this tg_id)
+    
+    Args:
+        chat_id: Telegram chat ID
+        user_id: Telegram user ID
+        text: Message text
+        
+    Returns:
+        List containing the created message data (empty for a duplicate)
+    """
+    # Create message data object
+    message_data = build_message_data(chat_id, user_id, text, haiku_source_ids, tg_id)
     
     # Insert data into the messages table
-    result = supabase.table("messages").insert(message_data).execute()
+    supabase = await get_client()
+    with observe_db("save_message"):
+        result = await supabase.table("messages") \
+            .upsert(message_data, on_conflict=MESSAGE_CONFLICT_COLUMNS, ignore_duplicates=True) \
+            .execute()
     
     # Return the result data (should be a list with the single created record)
     return result.data
 
+async def save_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Save several messages to the database with a single bulk insert,
+    skipping messages already stored (same chat_id and tg_id)
+    
+    Args:
+        messages: List of message rows built with build_message_data
+        
+    Returns:
+        List containing the created message data (duplicates are not included)
+    """
+    if not messages:
+        return []
+    supabase = await get_client()
+    with observe_db("save_messages"):
+        result = await supabase.table("messages") \
+            .upsert(messages, on_conflict=MESSAGE_CONFLICT_COLUMNS, ignore_duplicates=True) \
+            .execute()
+    return result.data
+
 
-def get_message_by_tg_id(tg_id: int) -> Optional[Dict[str, Any]]:
+async def get_haiku_with_sources(chat_id: int, tg_id: int) -> Optional[Dict[str, Any]]:
     """
-    Get a single message by its Telegram message ID (tg_id)
+    Get a haiku message together with the messages it was generated from in a single call
+    
+    Args:
+        chat_id: Telegram chat ID
+        tg_id: Telegram message ID of the haiku
+        
+    Returns:
+        None if the haiku is not found, otherwise:
+        {
+            'haiku': {'id', 'tg_id', 'text', 'created_at'},
+            'sources': [{'id', 'tg_id', 'from_user', 'text', 'created_at'}, ...]
+        }
     """
-    result = supabase.table("messages").select("*").eq("tg_id", tg_id).single().execute()
+    supabase = await get_client()
+    with observe_db("get_haiku_with_sources"):
+        result = await supabase.rpc("get_haiku_with_sources", {"p_chat_id": chat_id, "p_tg_id": tg_id}).execute()
     return result.data if result.data else None
 
+# Columns of the chat_history view returned by history queries
+CHAT_HISTORY_COLUMNS = "id, tg_id, from_user, text, created_at"
+
+async def get_message_ids(chat_id: int, tg_ids: List[int]) -> Dict[int, int]:
+    """
+    Get database IDs of a chat's messages by their Telegram message IDs
+    
+    Args:
+        chat_id: Telegram chat ID
+        tg_ids: Telegram message IDs
+        
+    Returns:
+        Dict of tg_id -> id for the messages found
+    """
+    if not tg_ids:
+        return {}
+    supabase = await get_client()
+    with observe_db("get_message_ids"):
+        result = await supabase.table("messages").select("id, tg_id") \
+            .eq("chat_id", chat_id).in_("tg_id", tg_ids).execute()
+    return {row["tg_id"]: row["id"] for row in result.data or []}
+
+async def get_recent_tg_ids(chat_id: int, limit: int) -> List[int]:
+    """
+    Get Telegram message IDs of a chat's latest messages from all authors, bots included
+    
+    Args:
+        chat_id: Telegram chat ID
+        limit: Maximum number of messages
+        
+    Returns:
+        List of tg_id, newest first
+    """
+    supabase = await get_client()
+    with observe_db("get_recent_tg_ids"):
+        result = await supabase.table("messages").select("tg_id") \
+            .eq("chat_id", chat_id) \
+            .order("created_at", desc=True) \
+            .order("id", desc=True) \
+            .limit(limit) \
+            .execute()
+    return [row["tg_id"] for row in result.data or [] if row.get("tg_id") is not None]
 
-def get_messages_by_ids(message_ids: List[int]) -> List[Dict[str, Any]]:
+def _keyset_filter(cursor: Tuple[str, int], descending: bool) -> str:
     """
-    Get multiple messages by their IDs (order preserved as in input list)
+    Build a PostgREST filter selecting rows strictly after a (created_at, id) cursor
     """
-    if not message_ids:
-        return []
-    # Supabase 'in_' operator expects a string of comma-separated values
-    ids_str = ','.join(str(mid) for mid in message_ids)
-    result = supabase.table("messages").select("*").in_("id", message_ids).execute()
-    # Preserve order as in input list
-    messages_by_id = {msg["id"]: msg for msg in result.data}
-    return [messages_by_id[mid] for mid in message_ids if mid in messages_by_id]
+    created_at, message_id = cursor
+    op = "lt" if descending else "gt"
+    # Timestamps contain reserved characters (':', '+', '.') and must be quoted
+    return f'created_at.{op}."{created_at}",and(created_at.eq."{created_at}",id.{op}.{message_id})'
 
-def get_chat_messages(chat_id: int, limit: int = 100, before_message_id: int = None, exclude_bots: bool = False) -> List[Dict[str, Any]]:
+async def iter_chat_messages(chat_id: int, start: Optional[datetime.datetime] = None,
+                             end: Optional[datetime.datetime] = None, descending: bool = False,
+                             after: Optional[Tuple[str, int]] = None, page_size: int = HISTORY_PAGE_SIZE,
+                             max_rows: int = HISTORY_MAX_ROWS, exclude_bots: bool = True) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Iterate over a chat's messages page by page using a (created_at, id) keyset,
+    so arbitrarily long histories are walked with one page in memory and no cursor lookups
+    
+    Args:
+        chat_id: Telegram chat ID
+        start: Only messages created at or after this time
+        end: Only messages created before this time
+        descending: Walk from newest to oldest instead of oldest to newest
+        after: (created_at, id) cursor to continue from (exclusive), in walking direction
+        page_size: Rows fetched per request (capped at HISTORY_PAGE_SIZE)
+        max_rows: Hard cap on the number of rows yielded (capped at HISTORY_MAX_ROWS)
+        exclude_bots: Whether to exclude bot messages
+        
+    Yields:
+        Messages in the same format as get_chat_messages
+    """
+    supabase = await get_client()
+    page_size = max(1, min(page_size, HISTORY_PAGE_SIZE))
+    remaining = min(max_rows, HISTORY_MAX_ROWS)
+    cursor = after
+    while remaining > 0:
+        query = supabase.from_("chat_history") \
+            .select(CHAT_HISTORY_COLUMNS) \
+            .eq("chat_id", chat_id)
+        if exclude_bots:
+            query = query.eq("is_bot", False)
+        if start is not None:
+            query = query.gte("created_at", start.isoformat())
+        if end is not None:
+            query = query.lt("created_at", end.isoformat())
+        if cursor is not None:
+            query = query.or_(_keyset_filter(cursor, descending))
+        limit = min(page_size, remaining)
+        with observe_db("iter_chat_messages"):
+            result = await query \
+                .order("created_at", desc=descending) \
+                .order("id", desc=descending) \
+                .limit(limit) \
+                .execute()
+        
+        for row in result.data:
+            yield row
+        remaining -= len(result.data)
+        if len(result.data) < limit:
+            return
+        last = result.data[-1]
+        cursor = (last["created_at"], last["id"])
+
+async def get_chat_messages(chat_id: int, limit: int = 100, before: Optional[Tuple[str, int]] = None,
+                            exclude_bots: bool = False) -> List[Dict[str, Any]]:
     """
     Retrieve messages for a specific chat from the database
     
     Args:
         chat_id: Telegram chat ID
         limit: Maximum number of messages to retrieve
+        before: Optional (created_at, id) cursor; only older messages are returned
+        exclude_bots: Whether to exclude bot messages
         
     Returns:
-        List of messages with user information in format:
+        List of messages with user information in format (newest first):
         {
+            'id': 123,
+            'tg_id': 456,
             'from_user': 'First Last',
             'text': 'message text',
             'created_at': 'ISO datetime string'
         }
     """
-    # Get messages and join with users table using a subquery
-    query = supabase.from_("messages") \
-        .select("*, users!messages_user_id_fkey(first_name, last_name, isBot)") \
-        .eq("chat_id", chat_id)
-    if exclude_bots:
-        query = query.eq("users.isBot", False)
-    if before_message_id is not None:
-        # Get created_at for before_message_id
-        msg = supabase.from_("messages").select("created_at").eq("id", before_message_id).single().execute()
-        logging.info(f"[get_chat_messages] before_message_id={before_message_id}, msg={msg}")
-        if msg.data and msg.data.get("created_at"):
-            before_created_at = msg.data["created_at"]
-            query = query.lt("created_at", before_created_at)
-    result = query.order("created_at", desc=True).limit(limit).execute()
-    
-    # Format the result to match the expected structure for haiku generation
-    formatted_data = []
-    for item in result.data:
-        message = dict(item)
-        msg_id = message.get('id')
-        if "users" in message and message["users"]:
-            user_data = message.pop("users")
-            first_name = user_data.get("first_name", "")
-            last_name = user_data.get("last_name", "")
-            formatted_data.append({
-                'id': msg_id,
-                'from_user': f"{first_name} {last_name}".strip(),
-                'text': message.get('text', ''),
-                'created_at': message.get('created_at', '')
-            })
-    if not formatted_data:
+    messages = [
+        msg async for msg in iter_chat_messages(
+            chat_id, descending=True, after=before, page_size=limit, max_rows=limit, exclude_bots=exclude_bots
+        )
+    ]
+    if not messages:
         logging.info(f"No chat messages found for chat_id={chat_id} (get_chat_messages)")
-        return []
-    return formatted_data
+    return messages
 
 
-def get_chat_messages_by_period(chat_id: int, minutes: int = 60, exclude_bots: bool = True) -> List[Dict[str, Any]]:
+def get_current_time() -> datetime.datetime:
+    """
+    Get the current time (TEST_CURRENT_TIME if configured for local testing)
+    
+    Returns:
+        Naive datetime of "now"
+    """
+    try:
+        from utils.config import TEST_CURRENT_TIME
+        current_time = TEST_CURRENT_TIME if TEST_CURRENT_TIME else datetime.datetime.now()
+        if TEST_CURRENT_TIME:
+            logging.info(f"[get_current_time] Using test current time: {current_time}")
+    except ImportError:
+        current_time = datetime.datetime.now()
+    return current_time
+
+def parse_timestamp(value: str) -> datetime.datetime:
+    """
+    Parse a created_at value returned by the database into a naive datetime
+    
+    Args:
+        value: ISO datetime string, with or without timezone and with any number of fraction digits
+        
+    Returns:
+        Naive datetime
+    """
+    value = value.replace("Z", "+00:00").replace(" ", "T")
+    # Python < 3.11 only accepts 3 or 6 fraction digits
+    match = re.match(r"^(.*T\d\d:\d\d:\d\d)(?:\.(\d+))?(.*)$", value)
+    if match:
+        fraction = (match.group(2) or "0")[:6].ljust(6, "0")
+        value = f"{match.group(1)}.{fraction}{match.group(3)}"
+    return datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+
+async def get_chat_messages_by_period(chat_id: int, minutes: int = 60, exclude_bots: bool = True) -> List[Dict[str, Any]]:
     """
     Retrieve messages for a specific chat from the database within a time period
     
@@ -193,48 +474,127 @@ def get_chat_messages_by_period(chat_id: int, minutes: int = 60, exclude_bots: b
     Returns:
         List of messages with user information in format:
         {
+            'id': 123,
+            'tg_id': 456,
             'from_user': 'First Last',
             'text': 'message text',
             'created_at': 'ISO datetime string'
         }
     """
-    # Get current time (use test time if configured)
-    try:
-        from utils.config import TEST_CURRENT_TIME
-        current_time = TEST_CURRENT_TIME if TEST_CURRENT_TIME else datetime.datetime.now()
-        if TEST_CURRENT_TIME:
-            logging.info(f"[get_chat_messages_by_period] Using test current time: {current_time}")
-    except ImportError:
-        current_time = datetime.datetime.now()
-    
     # Calculate the time threshold
-    time_threshold = current_time - datetime.timedelta(minutes=minutes)
-    time_threshold_iso = time_threshold.isoformat()
-    
-    # Get messages and join with users table using a subquery
-    query = supabase.from_("messages") \
-        .select("*, users!messages_user_id_fkey(first_name, last_name, isBot)") \
-        .eq("chat_id", chat_id) \
-        .gte("created_at", time_threshold_iso)
-    
-    if exclude_bots:
-        query = query.eq("users.isBot", False)
-    
-    result = query.order("created_at", desc=False).execute()
-    
-    # Format the result to match the expected structure
-    formatted_data = []
-    for item in result.data:
-        message = dict(item)
-        if "users" in message and message["users"]:
-            user_data = message.pop("users")
-            first_name = user_data.get("first_name", "")
-            last_name = user_data.get("last_name", "")
-            formatted_data.append({
-                'from_user': f"{first_name} {last_name}".strip(),
-                'text': message.get('text', ''),
-                'created_at': message.get('created_at', '')
-            })
+    time_threshold = get_current_time() - datetime.timedelta(minutes=minutes)
+    
+    formatted_data = await get_chat_messages_between(chat_id, time_threshold, exclude_bots=exclude_bots)
     
     logging.info(f"Found {len(formatted_data)} messages for chat_id={chat_id} in last {minutes} minutes")
-    return formatted_data
\ No newline at end of file
+    return formatted_data
+
+async def get_chat_messages_between(chat_id: int, start: datetime.datetime, end: Optional[datetime.datetime] = None,
+                                    exclude_bots: bool = True) -> List[Dict[str, Any]]:
+    """
+    Retrieve messages for a specific chat created in [start, end), oldest first
+    
+    Args:
+        chat_id: Telegram chat ID
+        start: Start of the time range (inclusive)
+        end: End of the time range (exclusive), or None for no upper bound
+        exclude_bots: Whether to exclude bot messages
+        
+    Returns:
+        List of messages in the same format as get_chat_messages_by_period
+        (at most HISTORY_MAX_ROWS; use iter_chat_messages to stream long ranges)
+    """
+    return [msg async for msg in iter_chat_messages(chat_id, start=start, end=end, exclude_bots=exclude_bots)]
+
+async def set_message_embeddings(rows: List[Dict[str, Any]]) -> None:
+    """
+    Store embeddings of saved messages with a single call
+    
+    Args:
+        rows: List of {'id': message id, 'embedding': list of floats}
+    """
+    if not rows:
+        return
+    supabase = await get_client()
+    with observe_db("set_message_embeddings"):
+        await supabase.rpc("set_message_embeddings", {"p_rows": rows}).execute()
+
+async def match_chat_messages(chat_id: int, embedding: List[float], start: datetime.datetime,
+                              end: datetime.datetime, match_count: int, neighbours: int) -> List[Dict[str, Any]]:
+    """
+    Find the messages of a period most similar to an embedding, together with their neighbours
+    
+    Args:
+        chat_id: Telegram chat ID
+        embedding: Embedding of the query
+        start: Start of the period (inclusive)
+        end: End of the period (exclusive)
+        match_count: Number of best matching messages
+        neighbours: Number of messages before and after each match to include as context
+        
+    Returns:
+        List of messages oldest first, in the format of get_chat_messages_by_period plus
+        'position' (index of the message within the period) and 'similarity'
+    """
+    supabase = await get_client()
+    with observe_db("match_chat_messages"):
+        result = await supabase.rpc("match_chat_messages", {
+            "p_chat_id": chat_id,
+            "p_embedding": embedding,
+            "p_start": start.isoformat(),
+            "p_end": end.isoformat(),
+            "p_match_count": match_count,
+            "p_neighbours": neighbours,
+        }).execute()
+    return result.data or []
+
+async def get_embedding_coverage(chat_id: int, start: datetime.datetime,
+                                 end: datetime.datetime) -> Tuple[int, int]:
+    """
+    Count a period's messages and how many of them have an embedding
+    
+    Args:
+        chat_id: Telegram chat ID
+        start: Start of the period (inclusive)
+        end: End of the period (exclusive)
+        
+    Returns:
+        Tuple of the number of messages and the number of embedded messages
+    """
+    supabase = await get_client()
+    with observe_db("get_embedding_coverage"):
+        result = await supabase.rpc("chat_embedding_coverage", {
+            "p_chat_id": chat_id,
+            "p_start": start.isoformat(),
+            "p_end": end.isoformat(),
+        }).execute()
+    row = result.data[0] if result.data else {}
+    return row.get("total") or 0, row.get("embedded") or 0
+
+async def search_chat_messages(chat_id: int, query: str, start: Optional[datetime.datetime] = None,
+                               end: Optional[datetime.datetime] = None, limit: int = 200) -> List[Dict[str, Any]]:
+    """
+    Full-text search of a chat's messages, ranked by relevance and recency
+    
+    Every word of the query must match (as a prefix, so inflected forms are found).
+    
+    Args:
+        chat_id: Telegram chat ID
+        query: Search words
+        start: Start of the period (inclusive), or None
+        end: End of the period (exclusive), or None
+        limit: Maximum number of messages
+        
+    Returns:
+        List of messages, best first, in the format of get_chat_messages_by_period plus 'rank'
+    """
+    supabase = await get_client()
+    with observe_db("search_chat_messages"):
+        result = await supabase.rpc("search_chat_messages", {
+            "p_chat_id": chat_id,
+            "p_query": query,
+            "p_start": start.isoformat() if start else None,
+            "p_end": end.isoformat() if end else None,
+            "p_limit": limit,
+        }).execute()
+    return result.data or []
@@ -2,13 +2,29 @@ import os
 import json
 import logging
 from dotenv import load_dotenv
-from openai import OpenAI
-from telegram.ext import ApplicationBuilder, MessageHandler, filters, CommandHandler
+from telegram import Update
+from telegram.ext import (
+    ApplicationBuilder, ApplicationHandlerStop, MessageHandler, TypeHandler, filters, CommandHandler
+)
 from handlers.message_handler import store_message
 from handlers.haiku_handler import process_haiku_answer
 from handlers.response_handler import process_bot_response
 from handlers.query_handler import handle_query_command
-from utils.config import TELEGRAM_TOKEN
+from utils.config import (
+    TELEGRAM_TOKEN, METRICS_PORT, METRICS_HOST, UPDATES_MAX_CONCURRENT,
+    WEBHOOK_URL, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+)
+from utils.openai_client import close_client
+from utils.context_builder import load_tokenizer
+import db_service
+from utils.ingestion import ingestor
+from utils.llm_jobs import llm_jobs
+from utils.embedding_index import embedding_index
+from utils.user_cache import user_cache
+from utils.response_cache import response_cache
+from utils.seen_updates import seen_updates, seen_messages
+from utils.metrics import start_metrics_server, register_queue, DUPLICATE_UPDATES
+from utils.update_processor import ChatOrderedUpdateProcessor
 
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -19,8 +35,6 @@ load_dotenv()
 # Tokens from the environment
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 
-client = OpenAI()
-
 # Load configuration from config.json
 with open('config.json', 'r', encoding='utf-8') as config_file:
     config = json.load(config_file)
@@ -28,18 +42,23 @@ with open('config.json', 'r', encoding='utf-8') as config_file:
 message_limit = config.get('message_limit')
 model = config.get('model')  # Use model from config file
 
-def invoke_model(prompt):
-    completion = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}]
-    )
-
-    return completion.choices[0].message.content.strip()
-
 # Dictionary to track message counts per chat
 message_counts = {}
 
 
+async def drop_duplicate_updates(update, context):
+    """
+    Stop processing of updates Telegram delivers again, before they are stored or answered
+    
+    Args:
+        update: Telegram update
+        context: Callback context
+    """
+    if not seen_updates.add(update.update_id):
+        DUPLICATE_UPDATES.inc()
+        logging.info(f"[haikubot] Dropping duplicate update {update.update_id}")
+        raise ApplicationHandlerStop
+
 async def handle_message(update, context):
     """
     Main message handler that orchestrates all other handlers
@@ -48,12 +67,68 @@ async def handle_message(update, context):
         update: Telegram update
         context: Callback context
     """
-    await store_message(update, context)
+    if not await store_message(update, context):
+        return
     await process_haiku_answer(update, context)
     await process_bot_response(update, context)
 
-if __name__ == "__main__":
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+async def init(application):
+    """
+    Prepare shared resources before the bot starts receiving updates
+    
+    Args:
+        application: Telegram application
+    """
+    await load_tokenizer()
+
+async def stop(application):
+    """
+    Finish background work while the bot can still send messages: PTB calls this
+    after it stops receiving updates and before it closes the bot's HTTP client
+    
+    Args:
+        application: Telegram application
+    """
+    await llm_jobs.close()
+    await ingestor.close()
+    await embedding_index.close()
+    logging.info(f"[haikubot] User cache stats: {user_cache.stats()}")
+    logging.info(f"[haikubot] Response cache stats: {response_cache.stats()}")
+    logging.info(f"[haikubot] Duplicate updates dropped: {seen_updates.duplicates}, "
+                 f"duplicate messages dropped: {seen_messages.duplicates}")
+
+async def shutdown(application):
+    """
+    Release shared resources when the bot stops
+    
+    Args:
+        application: Telegram application
+    """
+    await close_client()
+    await db_service.close_client()
+
+def main():
+    """
+    Build the Telegram application and start receiving updates
+    (through a webhook if WEBHOOK_URL is set, otherwise by polling)
+    """
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT, METRICS_HOST)
+    
+    # Different chats are handled concurrently, updates of one chat in order
+    update_processor = ChatOrderedUpdateProcessor(UPDATES_MAX_CONCURRENT)
+    register_queue("updates", lambda: update_processor.pending)
+    
+    application = ApplicationBuilder() \
+        .token(TELEGRAM_TOKEN) \
+        .concurrent_updates(update_processor) \
+        .post_init(init) \
+        .post_stop(stop) \
+        .post_shutdown(shutdown) \
+        .build()
+    
+    # Runs before all other handlers (group -1) and stops re-delivered updates
+    application.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-1)
     
     # Add command handlers
     application.add_handler(CommandHandler("ask", handle_query_command))
@@ -61,5 +136,17 @@ if __name__ == "__main__":
     # Add message handler
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
-    application.run_polling()
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        application.run_polling()
+
+if __name__ == "__main__":
+    main()
 
@@ -1,12 +1,18 @@
 """
 Handler for generating haikus
 """
+from typing import Any, Dict, List
 from telegram import Update
 from telegram.ext import CallbackContext
 import db_service
-from utils.config import IS_DEBUG, MESSAGE_LIMIT, BOT_USER
+from utils.config import MESSAGE_LIMIT, BOT_USER
 from utils.openai_client import invoke_model
 from utils.prompts import PROMPT_HAIKU
+from utils.prompt_encoder import encode_messages
+from utils.ingestion import ingestor
+from utils.chat_history import chat_history
+from utils.metrics import track_handler, record_handler_error
+from utils.llm_jobs import llm_jobs
 import logging
 
 # Dictionary to track message counts per chat
@@ -15,6 +21,7 @@ message_counts = {}
 # Dictionary to track bot's last haiku messages per chat
 last_bot_haikus = {}
 
+@track_handler("haiku")
 async def process_haiku_answer(update: Update, context: CallbackContext):
     """
     Process messages and generate haiku when message limit is reached
@@ -35,57 +42,84 @@ async def process_haiku_answer(update: Update, context: CallbackContext):
         
         # Check if we've reached the message limit
         if message_counts[chat_id] >= MESSAGE_LIMIT:
-            try:
-                # Get the last N messages from the database, excluding bot messages
-                messages = db_service.get_chat_messages(chat_id, limit=MESSAGE_LIMIT, exclude_bots=True)
-                if not messages:
-                    logging.info(f"[haiku_handler] No chat history found for chat_id={chat_id}")
-                
-                # Format messages for the prompt with structured data
-                messages_text = "\n".join([
-                    f"Автор: {msg['from_user']}\n"
-                    f"Дата: {msg.get('created_at', '')}\n"
-                    f"Текст: {msg['text']}\n"
-                    f"---"
-                    for msg in messages
-                ])
+            # Get the last N human messages from the in-memory history
+            messages = chat_history.recent(chat_id, MESSAGE_LIMIT)
+            # Reset counter; the haiku is generated in the background
+            message_counts[chat_id] = 0
+            if not llm_jobs.submit("haiku", chat_id, lambda: generate_haiku(update, messages),
+                                   on_shed=lambda: retry_haiku_later(chat_id)):
+                await retry_haiku_later(chat_id)
+
+async def retry_haiku_later(chat_id: int):
+    """
+    Make the next message in the chat trigger a haiku again (after a failed or dropped attempt)
+    
+    Args:
+        chat_id: Telegram chat ID
+    """
+    message_counts[chat_id] = max(message_counts.get(chat_id, 0), MESSAGE_LIMIT - 1)
 
-                # Логування початку генерації хайку
-                logging.info(f"[haiku_handler] Початок генерації хайку для chat_id={chat_id}")
+async def generate_haiku(update: Update, messages: List[Dict[str, Any]]):
+    """
+    Generate a haiku from chat messages, reply with it and store it
+    
+    Args:
+        update: Telegram update with the message that triggered the haiku
+        messages: The last human messages of the chat, newest first
+    """
+    chat_id = update.effective_chat.id
+    try:
+        # Messages still waiting in the write-behind buffer get their ids on flush
+        if any(msg.get('id') is None for msg in messages):
+            await ingestor.flush()
+            # The flush fills in ids through the chat's buffer, which may have dropped
+            # these messages (rolled over or evicted chat) since they were taken
+            missing = [msg['tg_id'] for msg in messages if msg.get('id') is None and msg.get('tg_id') is not None]
+            if missing:
+                ids = await db_service.get_message_ids(chat_id, missing)
+                for msg in messages:
+                    if msg.get('id') is None:
+                        msg['id'] = ids.get(msg.get('tg_id'))
+        if not messages:
+            logging.info(f"[haiku_handler] No chat history found for chat_id={chat_id}")
+        
+        # Compact prompt format, oldest message first
+        messages_text = encode_messages(reversed(messages))
 
-                # Generate haiku
-                prompt = PROMPT_HAIKU.format(messages=messages_text)
-                haiku = invoke_model(prompt)
-                logging.info(f"[haiku_handler] Згенеровано хайку для chat_id={chat_id}: {haiku}")
-                sent_message = await update.message.reply_text(haiku)
+        # Логування початку генерації хайку
+        logging.info(f"[haiku_handler] Початок генерації хайку для chat_id={chat_id}")
 
-                # Store the message ID of the last haiku
-                last_bot_haikus[chat_id] = sent_message.message_id
+        # Generate haiku
+        prompt = PROMPT_HAIKU.format(messages=messages_text)
+        haiku = await invoke_model(prompt, task="haiku")
+        logging.info(f"[haiku_handler] Згенеровано хайку для chat_id={chat_id}: {haiku}")
+        sent_message = await update.message.reply_text(haiku)
 
-                # --- Store haiku as bot message in database ---
-                # Define synthetic bot user (make sure user_id is unique and consistent for the bot)
-                # Use bot info from config
-                db_service.get_or_create_user(
-                    user_id=BOT_USER['user_id'],
-                    username=BOT_USER['username'],
-                    first_name=BOT_USER['first_name'],
-                    last_name=BOT_USER['last_name'],
-                    is_bot=True
-                )
-                db_service.update_user_last_activity(BOT_USER['user_id'])
-                # Зберігаємо id всіх повідомлень, на основі яких створено хайку (беремо з get_chat_messages)
-                source_ids = [msg.get('id') for msg in messages if msg.get('id')]
-                db_service.save_message(
-                    chat_id=chat_id,
-                    user_id=BOT_USER['user_id'],
-                    tg_id=sent_message.message_id,
-                    text=haiku,
-                    haiku_source_ids=source_ids
-                )
+        # Store the message ID of the last haiku
+        last_bot_haikus[chat_id] = sent_message.message_id
 
-                # Reset counter
-                message_counts[chat_id] = 0
-                
-            except Exception as e:
-                if IS_DEBUG:
-                    print(f"Error generating haiku: {e}") 
\ No newline at end of file
+        # --- Store haiku as bot message in database ---
+        # Define synthetic bot user (make sure user_id is unique and consistent for the bot)
+        # Use bot info from config
+        await db_service.get_or_create_user(
+            user_id=BOT_USER['user_id'],
+            username=BOT_USER['username'],
+            first_name=BOT_USER['first_name'],
+            last_name=BOT_USER['last_name'],
+            is_bot=True
+        )
+        await db_service.update_user_last_activity(BOT_USER['user_id'])
+        # Зберігаємо id всіх повідомлень, на основі яких створено хайку (беремо з get_chat_messages)
+        source_ids = [msg.get('id') for msg in messages if msg.get('id')]
+        await db_service.save_message(
+            chat_id=chat_id,
+            user_id=BOT_USER['user_id'],
+            tg_id=sent_message.message_id,
+            text=haiku,
+            haiku_source_ids=source_ids
+        )
+        
+    except Exception as e:
+        record_handler_error()
+        await retry_haiku_later(chat_id)
+        logging.error(f"[haiku_handler] Error generating haiku for chat_id={chat_id}: {e}")
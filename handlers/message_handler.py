@@ -1,11 +1,18 @@
 """
 Handler for storing messages in the database
 """
+import logging
 from telegram import Update
 from telegram.ext import CallbackContext
 import db_service
 from utils.config import IS_DEBUG
+from utils.ingestion import ingestor
+from utils.chat_history import chat_history
+from utils.response_cache import response_cache
+from utils.seen_updates import seen_messages
+from utils.metrics import track_handler, record_handler_error, DUPLICATE_UPDATES
 
+@track_handler("store")
 async def store_message(update: Update, context: CallbackContext):
     """
     Store message in the database
@@ -13,9 +20,12 @@ async def store_message(update: Update, context: CallbackContext):
     Args:
         update: Telegram update
         context: Callback context
+        
+    Returns:
+        bool: False if the message was already stored and must not be processed again
     """
     if update.message.text is None:
-        return
+        return True
 
     if IS_DEBUG:
         print(f"Chat {update.message.chat_id}: {update.message.text}")
@@ -24,30 +34,59 @@ async def store_message(update: Update, context: CallbackContext):
     user = update.message.from_user
     text = update.message.text
     
-    # Save to database
+    # Re-delivered after a restart, when the seen update IDs are gone
     try:
-        # Get or create user
-        db_service.get_or_create_user(
-            user_id=user.id,
-            username=user.username if user.username else '',
-            first_name=user.first_name,
-            last_name=user.last_name,
-            is_bot=user.is_bot
-        )
-        
-        # Update user's last activity
-        db_service.update_user_last_activity(user.id)
-        
-        # Save message
-        db_service.save_message(
-            chat_id=chat_id,
-            user_id=user.id,
-            text=text,
-            tg_id=update.message.message_id
+        is_new = await seen_messages.add(chat_id, update.message.message_id)
+    except Exception as e:
+        logging.warning(f"[message_handler] Failed to check for duplicates in chat_id={chat_id}: {e}")
+        is_new = True
+    if not is_new:
+        DUPLICATE_UPDATES.inc()
+        logging.info(f"[message_handler] Message {update.message.message_id} of chat_id={chat_id} "
+                     f"is already stored, skipping")
+        return False
+    
+    # Any new message makes cached /ask answers for this chat stale
+    response_cache.note_message(chat_id, update.message.message_id)
+    
+    message_data = db_service.build_message_data(
+        chat_id=chat_id,
+        user_id=user.id,
+        text=text,
+        tg_id=update.message.message_id
+    )
+    
+    # Keep human messages in the recent history used for haiku generation;
+    # the database id is filled in once the message is flushed
+    if not user.is_bot:
+        try:
+            await chat_history.add(chat_id, {
+                'id': None,
+                'tg_id': message_data['tg_id'],
+                'from_user': db_service.format_user_name(user.first_name, user.last_name),
+                'text': text,
+                'created_at': message_data['created_at']
+            })
+        except Exception as e:
+            logging.warning(f"[message_handler] Failed to buffer message for chat_id={chat_id}: {e}")
+    
+    # Queue for the next batched write to the database
+    try:
+        await ingestor.add(
+            db_service.build_user_data(
+                user_id=user.id,
+                username=user.username if user.username else '',
+                first_name=user.first_name,
+                last_name=user.last_name,
+                is_bot=user.is_bot
+            ),
+            message_data
         )
 
         if IS_DEBUG:
-            print(f"Saved message to database: {text}")
+            print(f"Queued message for database: {text}")
     except Exception as e:
+        record_handler_error()
         if IS_DEBUG:
-            print(f"Error saving to database: {e}") 
\ No newline at end of file
+            print(f"Error saving to database: {e}") 
+    return True
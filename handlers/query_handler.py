@@ -1,13 +1,30 @@
 """
 Handler for processing user queries with chat history context
 """
+import asyncio
+import datetime
 import logging
 import re
+from typing import Any, Dict, List, Tuple
 from telegram import Update
 from telegram.ext import CallbackContext
 import db_service
-from utils.config import IS_DEBUG, TEST_CHAT_ID
-from utils.openai_client import invoke_model
+from utils.config import (
+    IS_DEBUG, TEST_CHAT_ID, STREAMING_ENABLED, ASK_CONTEXT_TOKEN_BUDGET, ASK_CHUNK_TOKEN_BUDGET,
+    ASK_SUMMARY_MIN_WINDOW, ASK_RETRIEVAL_MIN_WINDOW, ASK_RETRIEVAL_TAIL_MINUTES, ASK_SEARCH_MAX_RESULTS
+)
+from utils.openai_client import invoke_model, stream_model
+from utils.telegram_stream import reply_streaming, reply_long
+from utils.ingestion import ingestor
+from utils.context_builder import build_history, count_tokens
+from utils.prompt_encoder import PromptEncoder
+from utils.embedding_index import embedding_index
+from utils.summary_store import summary_store
+from utils.response_cache import response_cache, normalize_query
+from utils.llm_jobs import llm_jobs
+from utils.model_router import model_router
+from utils.prompts import HISTORY_FORMAT
+from utils.metrics import track_handler, record_handler_error
 
 def parse_time_period(time_str: str) -> int:
     """
@@ -52,25 +69,220 @@ EXAMPLE_TIME_PERIODS = {
     '1d': 1440,  # 24 hours in minutes
 }
 
+# Static instructions first, so the shared prefix is cached by the provider
 QUERY_PROMPT_TEMPLATE = """
 Ти розумний асистент, який допомагає аналізувати історію чату і відповідати на запити користувачів.
 
-ІСТОРІЯ ПОВІДОМЛЕНЬ:
-{history}
-
-ЗАПИТ КОРИСТУВАЧА:
-{user_query}
-
 ІНСТРУКЦІЇ:
-1. Проаналізуй історію повідомлень вище
+1. Проаналізуй історію повідомлень нижче
 2. Відповідь на запит користувача, використовуючи контекст з історії
 3. Відповідай українською мовою
 4. Будь конкретним і корисним
 5. Якщо в історії недостатньо інформації для відповіді, так і скажи
+6. Називай учасників повними іменами, а не позначками з історії
+""" + HISTORY_FORMAT + """
+ІСТОРІЯ ПОВІДОМЛЕНЬ:
+{history}
+
+ЗАПИТ КОРИСТУВАЧА:
+{user_query}
 
 ВІДПОВІДЬ:
 """
 
+# Reply when the model returned nothing
+EMPTY_RESPONSE_MESSAGE = "Не вдалося отримати відповідь. Спробуйте пізніше."
+
+# Reply when the query can't be queued (the same query is already being answered, or the bot is overloaded)
+BUSY_MESSAGE = "Цей запит уже обробляється або бот зараз перевантажений. Спробуйте трохи пізніше."
+
+def extract_search_terms(user_query: str) -> List[str]:
+    """
+    Get the quoted search terms of a query, e.g. 'Що казали про "новий офіс"?' -> ['новий офіс']
+    
+    Args:
+        user_query: The user's question
+        
+    Returns:
+        List of terms in "..." or «...» quotes
+    """
+    return [
+        term.strip()
+        for pair in re.findall(r'"([^"]+)"|«([^»]+)»|“([^”]+)”', user_query)
+        for term in pair if term.strip()
+    ]
+
+# Questions about the whole period (summaries, topics, activity) need all of it, not the most relevant messages
+SUMMARY_QUERY_RE = re.compile(
+    r"підсум|резюм|узагальн|огляд|коротко|\bтем[аиі]?\b|про що|що обговорювал|що відбувал|"
+    r"найактивн|хто найбільше|summar|tl;?dr|recap",
+    re.IGNORECASE
+)
+
+def is_summary_query(user_query: str) -> bool:
+    """
+    Check whether a query asks about the whole period (e.g. 'Підсумуй обговорення')
+    rather than about something specific
+    """
+    return bool(SUMMARY_QUERY_RE.search(user_query))
+
+def with_header(encoder: PromptEncoder, history: str) -> str:
+    """
+    Put the encoder's header (current time and author aliases) in front of the history
+    and report the tokens saved by the compact encoding
+    """
+    if not history:
+        return ""
+    history = encoder.header() + history
+    encoder.report(history)
+    return history
+
+async def search_history(chat_id: int, start: datetime.datetime, now: datetime.datetime,
+                         terms: List[str], user_query: str) -> str:
+    """
+    Build the history section from messages containing the search terms, found by the database
+    
+    A message matches a term if it contains all of the term's words; messages
+    matching any of the terms are used.
+    
+    Args:
+        chat_id: Telegram chat ID
+        start: Start of the period
+        now: Current time
+        terms: Quoted search terms
+        user_query: The user's question
+        
+    Returns:
+        str: History text, or an empty string if no message matches
+    """
+    results = await asyncio.gather(*(
+        db_service.search_chat_messages(chat_id, term, start=start, limit=ASK_SEARCH_MAX_RESULTS)
+        for term in terms
+    ))
+    messages = {msg['id']: msg for rows in results for msg in rows}
+    logging.info(f"[query_handler] Found {len(messages)} messages matching {terms} for chat_id={chat_id}")
+    ordered = sorted(messages.values(), key=lambda msg: (msg['created_at'], msg['id']))
+    encoder = PromptEncoder(now)
+    return with_header(encoder, await build_history(ordered, user_query, encoder=encoder))
+
+def format_excerpts(excerpts: List[List[Dict[str, Any]]], budget: int, encoder: PromptEncoder) -> str:
+    """
+    Format retrieved excerpts for the prompt, dropping the least relevant ones beyond the budget
+    
+    Args:
+        excerpts: Excerpts in chronological order, each a list of consecutive messages
+        budget: Token budget for the excerpts
+        encoder: Encoder of the prompt
+        
+    Returns:
+        str: Excerpts text
+    """
+    blocks = []
+    for excerpt in excerpts:
+        encoder.break_run()
+        blocks.append(encoder.encode(excerpt))
+    sizes = [count_tokens(block) for block in blocks]
+    by_relevance = sorted(range(len(excerpts)), key=lambda i: -max(msg['similarity'] for msg in excerpts[i]))
+    kept, total = set(), 0
+    for i in by_relevance:
+        if total + sizes[i] <= budget:
+            kept.add(i)
+            total += sizes[i]
+    return "".join(
+        f"Фрагмент {n + 1}:\n{blocks[i]}" for n, i in enumerate(i for i in range(len(blocks)) if i in kept)
+    )
+
+async def retrieve_history(chat_id: int, start: datetime.datetime, now: datetime.datetime, user_query: str) -> str:
+    """
+    Build the history section from the messages relevant to the query plus the latest messages
+    
+    Args:
+        chat_id: Telegram chat ID
+        start: Start of the period
+        now: Current time
+        user_query: The user's question
+        
+    Returns:
+        str: History text, or an empty string if nothing relevant was found
+    """
+    tail_start = max(start, now - datetime.timedelta(minutes=ASK_RETRIEVAL_TAIL_MINUTES))
+    excerpts = await embedding_index.search(chat_id, user_query, start, tail_start)
+    if not excerpts:
+        return ""
+    encoder = PromptEncoder(now)
+    excerpts_text = format_excerpts(excerpts, ASK_CONTEXT_TOKEN_BUDGET - ASK_CHUNK_TOKEN_BUDGET, encoder)
+    tail_budget = max(ASK_CONTEXT_TOKEN_BUDGET - count_tokens(excerpts_text), ASK_CHUNK_TOKEN_BUDGET)
+    encoder.break_run()
+    tail_text = await build_history(
+        db_service.iter_chat_messages(chat_id, start=tail_start), user_query, budget=tail_budget, encoder=encoder
+    )
+    logging.info(f"[query_handler] Using {len(excerpts)} retrieved excerpts for chat_id={chat_id}")
+    history = f"Фрагменти розмови, що стосуються запиту:\n{excerpts_text}"
+    if tail_text:
+        history += f"\nОстанні повідомлення:\n{tail_text}"
+    return with_header(encoder, history)
+
+async def collect_history(chat_id: int, minutes: int, user_query: str) -> Tuple[str, bool]:
+    """
+    Build the history section of the /ask prompt for the given period
+    
+    If the query has quoted terms, only the messages containing them are used.
+    Questions about something specific over windows of at least
+    retrieval_min_window_minutes use the messages most relevant to the query
+    (with their neighbours) plus the latest messages, if the period is embedded.
+    Otherwise short windows use raw messages and long windows use cached
+    summaries of closed time buckets plus the raw messages of the current
+    bucket, so their cost doesn't grow with the length of the period.
+    
+    Args:
+        chat_id: Telegram chat ID
+        minutes: Length of the period in minutes
+        user_query: The user's question
+        
+    Returns:
+        Tuple of:
+        - history text, or an empty string if there are no messages
+        - False if older buckets of the period aren't summarised yet and are left out
+    """
+    now = db_service.get_current_time()
+    terms = extract_search_terms(user_query)
+    if terms:
+        return await search_history(chat_id, now - datetime.timedelta(minutes=minutes), now, terms, user_query), True
+    
+    if embedding_index.enabled and minutes >= ASK_RETRIEVAL_MIN_WINDOW and not is_summary_query(user_query):
+        try:
+            history = await retrieve_history(chat_id, now - datetime.timedelta(minutes=minutes), now, user_query)
+            if history:
+                return history, True
+        except Exception as e:
+            logging.warning(f"[query_handler] Retrieval failed for chat_id={chat_id}, using full history: {e}")
+    
+    if minutes < ASK_SUMMARY_MIN_WINDOW:
+        # Stream the period's messages, summarising them if they exceed the token budget
+        messages = db_service.iter_chat_messages(chat_id, start=now - datetime.timedelta(minutes=minutes))
+        encoder = PromptEncoder(now)
+        return with_header(encoder, await build_history(messages, user_query, encoder=encoder)), True
+    
+    tail_start = summary_store.bucket_start(now)
+    summaries, uncovered = await summary_store.get_summaries(
+        chat_id, now - datetime.timedelta(minutes=minutes), tail_start
+    )
+    # Leave at least one chunk of the budget for the raw tail
+    summaries_text = await summary_store.format_summaries(
+        summaries, user_query, ASK_CONTEXT_TOKEN_BUDGET - ASK_CHUNK_TOKEN_BUDGET
+    )
+    tail_budget = max(ASK_CONTEXT_TOKEN_BUDGET - count_tokens(summaries_text), ASK_CHUNK_TOKEN_BUDGET)
+    encoder = PromptEncoder(now)
+    tail_text = await build_history(
+        db_service.iter_chat_messages(chat_id, start=tail_start), user_query, budget=tail_budget, encoder=encoder
+    )
+    logging.info(f"[query_handler] Using {len(summaries)} bucket summaries for chat_id={chat_id}")
+    history = summaries_text + with_header(encoder, tail_text)
+    if history and uncovered is not None:
+        history = f"(Повідомлення до {uncovered:%Y-%m-%d %H:%M} ще не підсумовані, їх тут немає.)\n" + history
+    return history, uncovered is None
+
+@track_handler("ask")
 async def handle_query_command(update: Update, context: CallbackContext):
     """
     Handle the /ask command with time period and query
@@ -110,7 +322,9 @@ async def handle_query_command(update: Update, context: CallbackContext):
             "• /ask 30m Хто був найактивніший?\n"
             "• /ask 2h Підсумуй обговорення за 2 години\n"
             "• /ask 45m Які питання обговорювали?\n"
-            "• /ask 1d Підсумуй обговорення за день"
+            "• /ask 1d Підсумуй обговорення за день\n\n"
+            "Слова в лапках шукаються в історії, і до запиту потрапляють лише повідомлення з ними:\n"
+            "• /ask 7d Що вирішили щодо \"відпустки\"?"
         )
         return
     
@@ -138,30 +352,58 @@ async def handle_query_command(update: Update, context: CallbackContext):
         time_period_str = '1h'
         user_query = query_part
     
+    logging.info(f"[query_handler] Processing query for chat_id={chat_id}, period={time_period_str}, query='{user_query}'")
+    
+    # Serve a repeated question from the cache if no new messages arrived since
+    response = response_cache.get(chat_id, minutes, user_query, model_router.current("ask"))
+    if response is not None:
+        logging.info(f"[query_handler] Serving cached response for chat_id={chat_id}")
+        await reply_long(update.message, f"📊 Аналіз за останні {time_period_str}:\n\n{response}")
+        return
+    
+    # The answer is generated in the background, the handler returns right away
+    queued = llm_jobs.submit(
+        "ask", chat_id,
+        lambda: answer_query(update, chat_id, minutes, time_period_str, user_query),
+        dedupe_key=(minutes, normalize_query(user_query)),
+        on_shed=lambda: update.message.reply_text(BUSY_MESSAGE)
+    )
+    if not queued:
+        await update.message.reply_text(BUSY_MESSAGE)
+
+async def answer_query(update: Update, chat_id: int, minutes: int, time_period_str: str, user_query: str):
+    """
+    Answer an /ask query from the chat history and reply with the answer
+    
+    Args:
+        update: Telegram update with the /ask command
+        chat_id: Telegram chat ID
+        minutes: Length of the period in minutes
+        time_period_str: The period as written by the user (e.g. '2h')
+        user_query: The user's question
+    """
     try:
-        logging.info(f"[query_handler] Processing query for chat_id={chat_id}, period={time_period_str}, query='{user_query}'")
+        # An answer is only valid for the messages seen before its history is read
+        watermark = response_cache.watermark(chat_id)
+        
+        # Write buffered messages first so the history includes them
+        await ingestor.flush()
         
         # Get chat history for the specified period
-        messages = db_service.get_chat_messages_by_period(
-            chat_id=chat_id, 
-            minutes=minutes, 
-            exclude_bots=True
-        )
+        history_text, complete = await collect_history(chat_id, minutes, user_query)
         
-        if not messages:
-            await update.message.reply_text(
-                f"За останні {time_period_str} не знайдено повідомлень в цьому чаті."
-            )
+        if not history_text:
+            terms = extract_search_terms(user_query)
+            if terms:
+                await update.message.reply_text(
+                    f"За останні {time_period_str} не знайдено повідомлень зі словами: {', '.join(terms)}."
+                )
+            else:
+                await update.message.reply_text(
+                    f"За останні {time_period_str} не знайдено повідомлень в цьому чаті."
+                )
             return
         
-        # Format history for the prompt
-        history_text = ""
-        for msg in messages:
-            history_text += f"Автор: {msg['from_user']}\n"
-            history_text += f"Час: {msg['created_at']}\n"
-            history_text += f"Повідомлення: {msg['text']}\n"
-            history_text += "---\n"
-        
         # Create the prompt
         prompt = QUERY_PROMPT_TEMPLATE.format(
             history=history_text,
@@ -171,18 +413,35 @@ async def handle_query_command(update: Update, context: CallbackContext):
         if IS_DEBUG:
             print(f"[query_handler] Sending prompt to LLM: {prompt[:200]}...")
         
-        # Get response from LLM
-        response = invoke_model(prompt)
+        # The answer is cached under the model that produces it, primary or fallback
+        model, tier = model_router.choose("ask")
+        logging.info(f"[query_handler] Answering with {model} ({tier})")
         
-        # Send response to user
-        response_text = f"📊 Аналіз за останні {time_period_str}:\n\n{response}"
-        await update.message.reply_text(response_text)
+        response_prefix = f"📊 Аналіз за останні {time_period_str}:\n\n"
+        if STREAMING_ENABLED:
+            # Show the answer while it is being generated
+            response = await reply_streaming(
+                update.message, stream_model(prompt, task="ask", model=model), prefix=response_prefix
+            )
+            if response is None:
+                await update.message.reply_text(EMPTY_RESPONSE_MESSAGE)
+                return
+        else:
+            # Get response from LLM
+            response = await invoke_model(prompt, task="ask", model=model)
+            
+            # Send response to user
+            await reply_long(update.message, response_prefix + response)
+        # A partial answer is not cached: the missing summaries are being computed in the background
+        if complete:
+            response_cache.put(chat_id, minutes, user_query, model, response, watermark)
         
         if IS_DEBUG:
             print(f"[query_handler] Response sent: {response[:100]}...")
         
     except Exception as e:
+        record_handler_error()
         logging.error(f"[query_handler] Error processing query: {e}")
         await update.message.reply_text(
             "Вибачте, сталася помилка при обробці вашого запиту. Спробуйте пізніше."
-        ) 
\ No newline at end of file
+        )
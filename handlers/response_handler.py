@@ -3,15 +3,19 @@ Handler for processing bot responses to haiku comments
 """
 import random
 import logging
-import json
 from telegram import Update
 from telegram.ext import CallbackContext
 import db_service
-from utils.config import IS_DEBUG, MESSAGE_LIMIT, RESPONSE_TRIGGER_PROBABILITY
-from utils.openai_client import invoke_model
+from utils.config import MESSAGE_LIMIT, RESPONSE_TRIGGER_PROBABILITY, STREAMING_ENABLED
+from utils.openai_client import invoke_model, stream_model
+from utils.telegram_stream import reply_streaming
 from utils.prompts import PROMPT_RESPONSE_BASE
+from utils.prompt_encoder import encode_messages
 from handlers.haiku_handler import last_bot_haikus
+from utils.metrics import track_handler, record_handler_error
+from utils.llm_jobs import llm_jobs
 
+@track_handler("response")
 async def process_bot_response(update: Update, context: CallbackContext):
     """
     Process user's response to bot's haiku message with different styles based on probability
@@ -36,45 +40,47 @@ async def process_bot_response(update: Update, context: CallbackContext):
     # Check probability trigger
     if random.random() > RESPONSE_TRIGGER_PROBABILITY:
         return
-        
+    
+    # The response is generated in the background; it is the first job dropped under load
+    if not llm_jobs.submit("response", chat_id, lambda: respond_to_comment(update)):
+        logging.info(f"[response_handler] Skipped response for chat_id={chat_id}")
+
+async def respond_to_comment(update: Update):
+    """
+    Reply to a user's comment on a haiku, using the messages the haiku was based on
+    
+    Args:
+        update: Telegram update with the reply to the haiku
+    """
+    chat_id = update.effective_chat.id
     try:
         logging.info(f"[response_handler] Start response generation on message: {update.message.text}")
         # Отримуємо id повідомлень, на основі яких створено хайку
         bot_message_id = update.message.reply_to_message.message_id
+        # Хайку разом з повідомленнями-джерелами та їх авторами одним запитом
+        messages = []
         try:
-            haiku_msg = db_service.get_message_by_tg_id(bot_message_id)
-        except Exception as e:
-            logging.warning(f"[response_handler] Failed to get message by tg_id: {e}")
-            
-        source_ids = []
-        if haiku_msg and haiku_msg.get('haiku_source_ids'):
-            try:
-                source_ids = json.loads(haiku_msg['haiku_source_ids'])
-            except Exception as e:
-                logging.warning(f"[response_handler] Failed to parse haiku_source_ids: {e}")
-        try:
-            messages = db_service.get_messages_by_ids(source_ids) if source_ids else []
+            haiku_msg = await db_service.get_haiku_with_sources(chat_id, bot_message_id)
+            if haiku_msg:
+                messages = haiku_msg['sources']
         except Exception as e:
-            logging.warning(f"[response_handler] Failed to get messages by ids: {e}")
+            logging.warning(f"[response_handler] Failed to get haiku with sources: {e}")
         if not messages:
             logging.info(f"[response_handler] No haiku source messages found for haiku_msg_id={bot_message_id}")
-        # Формуємо повідомлення для промпту
-        messages_text = "\n".join([
-            f"Автор: {msg.get('from_user', '')}\n"
-            f"Дата: {msg.get('created_at', '')}\n"
-            f"Текст: {msg.get('text', '')}\n"
-            f"---"
-            for msg in messages
-        ])
+        # Формуємо повідомлення для промпту (компактно, від найстарішого)
+        messages_text = encode_messages(reversed(messages))
         prompt = PROMPT_RESPONSE_BASE.format(
             haiku=update.message.reply_to_message.text,
             user_comment=update.message.text,
             messages=messages_text
         )
             
-        response = invoke_model(prompt)
-        await update.message.reply_text(response)
+        if STREAMING_ENABLED:
+            await reply_streaming(update.message, stream_model(prompt, task="response"))
+        else:
+            response = await invoke_model(prompt, task="response")
+            await update.message.reply_text(response)
         
     except Exception as e:
-        if IS_DEBUG:
-            print(f"Error processing bot response: {e}") 
\ No newline at end of file
+        record_handler_error()
+        logging.error(f"[response_handler] Error processing bot response: {e}") 
\ No newline at end of file
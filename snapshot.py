@@ -0,0 +1,255 @@
+"""
+Compressed local snapshots of chat history: export from Supabase, import into any store
+"""
+import gzip
+import io
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, IO, Iterator, Optional, Set, Tuple
+from sync_data import get_supabase_client, iter_pages, BatchWriter, SyncProgress, TABLE_COLUMNS, SKIPPED_COLUMNS
+from utils.config import SYNC_PAGE_SIZE, SYNC_BATCH_SIZE, SYNC_CONCURRENCY
+
+SNAPSHOT_FORMAT = "haikubot-snapshot"
+SNAPSHOT_VERSION = 1
+
+# Unique columns the rows of each table are merged on when imported
+CONFLICT_COLUMNS = {
+    "users": "user_id",
+    "messages": "id",
+}
+
+def open_snapshot(path: str, mode: str) -> IO[str]:
+    """
+    Open a snapshot file as text, compressed with zstd (*.zst) or gzip (anything else)
+
+    Args:
+        path: Snapshot file path
+        mode: 'r' or 'w'
+
+    Returns:
+        Text stream of JSON lines
+    """
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("Install the zstandard package to use .zst snapshots, or use a .gz file")
+        if mode == "w":
+            stream = zstandard.ZstdCompressor(level=10).stream_writer(open(path, "wb"))
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return gzip.open(path, mode + "t", encoding="utf-8")
+
+def export_snapshot(path: str, days_back: int = 30, chat_id: Optional[int] = None, is_prod: bool = True,
+                    page_size: int = SYNC_PAGE_SIZE) -> None:
+    """
+    Stream messages and the users they reference into a snapshot file.
+
+    The file is JSON lines: a header, then chunks of up to page_size rows
+    ({"table": ..., "rows": [...]}). Users are written before the first chunk of
+    messages that references them, so the file can be imported in one pass.
+
+    Args:
+        path: Snapshot file path (*.jsonl.gz or *.jsonl.zst)
+        days_back: Number of days to look back (default: 30)
+        chat_id: Only export messages of this chat
+        is_prod: If True, export from production, otherwise from development
+        page_size: Number of rows read per request and written per chunk
+    """
+    client = get_supabase_client(is_prod=is_prod)
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=days_back)
+
+    progress = SyncProgress("messages")
+    exported_users: Set[int] = set()
+    users_count = 0
+    with open_snapshot(path, "w") as f:
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "created_at": end_date.isoformat(),
+            "filters": {"start_date": start_date.isoformat(), "end_date": end_date.isoformat(), "chat_id": chat_id},
+        }
+        f.write(json.dumps(header) + "\n")
+        for messages in iter_pages(client, "messages", start_date, end_date, page_size, chat_id=chat_id):
+            user_ids = list({message["user_id"] for message in messages} - exported_users)
+            if user_ids:
+                users = client.table("users") \
+                    .select(TABLE_COLUMNS["users"]) \
+                    .in_("user_id", user_ids) \
+                    .execute()
+                if users.data:
+                    f.write(json.dumps({"table": "users", "rows": users.data}, ensure_ascii=False) + "\n")
+                    users_count += len(users.data)
+                exported_users.update(user_ids)
+            f.write(json.dumps({"table": "messages", "rows": messages}, ensure_ascii=False) + "\n")
+            progress.add(len(messages))
+
+    elapsed = (datetime.now() - end_date).total_seconds()
+    print(f"Exported {progress.rows} messages and {users_count} users to {path} in {elapsed:.1f}s")
+
+def read_snapshot(path: str) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Read a snapshot file chunk by chunk
+
+    Args:
+        path: Snapshot file path
+
+    Yields:
+        Tuples of table name and rows (without columns that can't be imported,
+        which snapshots exported with all columns may contain)
+    """
+    with open_snapshot(path, "r") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"{path} is not a haikubot snapshot")
+        if header.get("version", 0) > SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {header['version']}")
+        for line in f:
+            if line.strip():
+                chunk = json.loads(line)
+                rows = [
+                    {column: value for column, value in row.items() if column not in SKIPPED_COLUMNS}
+                    for row in chunk["rows"]
+                ]
+                yield chunk["table"], rows
+
+def import_to_supabase(path: str, batch_size: int = SYNC_BATCH_SIZE, concurrency: int = SYNC_CONCURRENCY,
+                       is_prod: bool = False) -> Dict[str, int]:
+    """
+    Load a snapshot into Supabase (hosted or local, e.g. started with `supabase start`) with batched upserts
+
+    Args:
+        path: Snapshot file path
+        batch_size: Number of rows written per request
+        concurrency: Number of concurrent write requests
+        is_prod: If True, import into production, otherwise into development
+
+    Returns:
+        Number of imported rows per table
+    """
+    writer = BatchWriter(get_supabase_client(is_prod=is_prod), concurrency)
+    try:
+        for table, rows in read_snapshot(path):
+            # Messages reference users, so users must be written before the following messages
+            if table == "users":
+                writer.flush()
+            for i in range(0, len(rows), batch_size):
+                writer.submit(table, rows[i:i + batch_size], CONFLICT_COLUMNS[table])
+            if table == "users":
+                writer.flush()
+    finally:
+        writer.close()
+    return writer.written
+
+def _sqlite_value(value: Any) -> Any:
+    # Lists and objects (e.g. haiku_source_ids) are stored as JSON text
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+def import_to_sqlite(path: str, database: str) -> Dict[str, int]:
+    """
+    Load a snapshot into an embedded SQLite database, creating the tables and columns from the snapshot's rows
+
+    Args:
+        path: Snapshot file path
+        database: SQLite database file path
+
+    Returns:
+        Number of imported rows per table
+    """
+    written: Dict[str, int] = {}
+    columns: Dict[str, List[str]] = {}
+    connection = sqlite3.connect(database)
+    try:
+        for table, rows in read_snapshot(path):
+            if not rows:
+                continue
+            if table not in columns:
+                connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ("id" INTEGER PRIMARY KEY)')
+                columns[table] = [info[1] for info in connection.execute(f'PRAGMA table_info("{table}")')]
+            for row in rows:
+                for column in row:
+                    if column not in columns[table]:
+                        connection.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}"')
+                        columns[table].append(column)
+            # Rows are replaced on the same conflict columns as in Supabase
+            conflict = CONFLICT_COLUMNS[table]
+            connection.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{table}_{conflict}_idx" ON "{table}" ("{conflict}")')
+            names = ", ".join(f'"{column}"' for column in columns[table])
+            placeholders = ", ".join("?" for _ in columns[table])
+            connection.executemany(
+                f'INSERT OR REPLACE INTO "{table}" ({names}) VALUES ({placeholders})',
+                [tuple(_sqlite_value(row.get(column)) for column in columns[table]) for row in rows]
+            )
+            written[table] = written.get(table, 0) + len(rows)
+        connection.commit()
+    finally:
+        connection.close()
+    return written
+
+def import_snapshot(path: str, target: str = "dev", batch_size: int = SYNC_BATCH_SIZE,
+                    concurrency: int = SYNC_CONCURRENCY) -> None:
+    """
+    Load a snapshot file into a target store
+
+    Args:
+        path: Snapshot file path
+        target: 'dev' or 'prod' for Supabase (SUPABASE_URL/SUPABASE_KEY or their _PROD variants),
+            or 'sqlite:<file>' for an embedded SQLite database
+        batch_size: Number of rows written per request
+        concurrency: Number of concurrent write requests
+    """
+    started = datetime.now()
+    if target.startswith("sqlite:"):
+        written = import_to_sqlite(path, target[len("sqlite:"):])
+    elif target in ("dev", "prod"):
+        written = import_to_supabase(path, batch_size, concurrency, is_prod=target == "prod")
+    else:
+        raise ValueError(f"Unknown import target: {target}")
+    elapsed = (datetime.now() - started).total_seconds()
+    total = sum(written.values())
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"Imported {written} into {target} in {elapsed:.1f}s ({rate:.0f} rows/s)")
+
+def export_main():
+    """
+    Entry point of db-export
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export chat history into a compressed snapshot file")
+    parser.add_argument("path", nargs="?", default=f"snapshot-{datetime.now():%Y%m%d-%H%M%S}.jsonl.gz",
+                      help="Snapshot file, *.jsonl.gz or *.jsonl.zst (default: snapshot-<time>.jsonl.gz)")
+    parser.add_argument("--days", type=int, default=30,
+                      help="Number of days to look back (default: 30)")
+    parser.add_argument("--chat-id", type=int, default=None,
+                      help="Only export messages of this chat")
+    parser.add_argument("--source", choices=["prod", "dev"], default="prod",
+                      help="Database to export from (default: prod)")
+    parser.add_argument("--page-size", type=int, default=SYNC_PAGE_SIZE,
+                      help=f"Rows read per request (default: {SYNC_PAGE_SIZE})")
+
+    args = parser.parse_args()
+    export_snapshot(args.path, args.days, args.chat_id, args.source == "prod", args.page_size)
+
+def import_main():
+    """
+    Entry point of db-import
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import a snapshot file into a database")
+    parser.add_argument("path", help="Snapshot file created by db-export")
+    parser.add_argument("--target", default="dev",
+                      help="'dev' or 'prod' Supabase, or 'sqlite:<file>' (default: dev)")
+    parser.add_argument("--batch-size", type=int, default=SYNC_BATCH_SIZE,
+                      help=f"Rows written per request (default: {SYNC_BATCH_SIZE})")
+    parser.add_argument("--concurrency", type=int, default=SYNC_CONCURRENCY,
+                      help=f"Concurrent write requests (default: {SYNC_CONCURRENCY})")
+
+    args = parser.parse_args()
+    import_snapshot(args.path, args.target, args.batch_size, args.concurrency)
@@ -0,0 +1,18 @@
+-- Migration: Composite index and chat_history view for reading chat history
+-- Історія чату читається за (chat_id, created_at); id робить порядок однозначним
+CREATE INDEX IF NOT EXISTS messages_chat_id_created_at_idx ON messages (chat_id, created_at, id);
+
+-- Повідомлення з іменем автора, щоб фільтрувати ботів на сервері і не тягнути зайві колонки
+CREATE OR REPLACE VIEW chat_history
+WITH (security_invoker = true) AS
+SELECT
+    m.id,
+    m.chat_id,
+    m.tg_id,
+    m.user_id,
+    m.text,
+    m.created_at,
+    trim(concat_ws(' ', u.first_name, u.last_name)) AS from_user,
+    coalesce(u."isBot", false) AS is_bot
+FROM messages m
+JOIN users u ON u.user_id = m.user_id;
@@ -0,0 +1,52 @@
+-- Migration: Store haiku_source_ids as BIGINT[] instead of a JSON string
+BEGIN;
+
+ALTER TABLE messages ADD COLUMN haiku_source_ids_array BIGINT[];
+
+-- Переносимо наявні JSON-списки, зберігаючи порядок id
+UPDATE messages
+SET haiku_source_ids_array = ARRAY(
+    SELECT source_id::BIGINT
+    FROM jsonb_array_elements_text(haiku_source_ids::jsonb) WITH ORDINALITY AS sources(source_id, position)
+    ORDER BY position
+)
+WHERE haiku_source_ids IS NOT NULL AND haiku_source_ids <> '';
+
+ALTER TABLE messages DROP COLUMN haiku_source_ids;
+ALTER TABLE messages RENAME COLUMN haiku_source_ids_array TO haiku_source_ids;
+
+COMMIT;
+
+-- Хайку разом з повідомленнями-джерелами та їх авторами за один запит
+CREATE OR REPLACE FUNCTION get_haiku_with_sources(p_chat_id BIGINT, p_tg_id BIGINT)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT jsonb_build_object(
+        'haiku', jsonb_build_object(
+            'id', haiku.id,
+            'tg_id', haiku.tg_id,
+            'text', haiku.text,
+            'created_at', haiku.created_at
+        ),
+        'sources', COALESCE((
+            SELECT jsonb_agg(
+                jsonb_build_object(
+                    'id', source.id,
+                    'tg_id', source.tg_id,
+                    'from_user', source.from_user,
+                    'text', source.text,
+                    'created_at', source.created_at
+                )
+                ORDER BY ids.position
+            )
+            FROM unnest(haiku.haiku_source_ids) WITH ORDINALITY AS ids(id, position)
+            JOIN chat_history source ON source.id = ids.id
+        ), '[]'::jsonb)
+    )
+    FROM messages haiku
+    WHERE haiku.chat_id = p_chat_id AND haiku.tg_id = p_tg_id
+    ORDER BY haiku.id DESC
+    LIMIT 1;
+$$;
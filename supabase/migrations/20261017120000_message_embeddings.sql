@@ -0,0 +1,63 @@
+-- Migration: Message embeddings for semantic search in /ask
+CREATE EXTENSION IF NOT EXISTS vector;
+
+-- Розмірність має збігатися з embeddings.dimensions у config.json
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS embedding vector(1536);
+
+-- Ембеддинги записуються пачками після збереження повідомлень
+CREATE OR REPLACE FUNCTION set_message_embeddings(p_rows JSONB)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    UPDATE messages m
+    SET embedding = (r->>'embedding')::vector
+    FROM jsonb_array_elements(p_rows) AS r
+    WHERE m.id = (r->>'id')::BIGINT;
+$$;
+
+-- Найближчі до запиту повідомлення за період разом із сусідніми повідомленнями.
+-- Період одного чату вибирається за індексом (chat_id, created_at, id), тому відстань
+-- рахується точно по його рядках і окремий ANN-індекс не потрібен.
+CREATE OR REPLACE FUNCTION match_chat_messages(
+    p_chat_id BIGINT,
+    p_embedding vector(1536),
+    p_start TIMESTAMPTZ,
+    p_end TIMESTAMPTZ,
+    p_match_count INT DEFAULT 20,
+    p_neighbours INT DEFAULT 2
+)
+RETURNS TABLE (
+    id BIGINT,
+    tg_id BIGINT,
+    from_user TEXT,
+    text TEXT,
+    created_at TIMESTAMPTZ,
+    "position" BIGINT,
+    similarity FLOAT
+)
+LANGUAGE sql
+STABLE
+AS $$
+    WITH period AS (
+        SELECT h.id, h.tg_id, h.from_user, h.text, h.created_at,
+               row_number() OVER (ORDER BY h.created_at, h.id) AS position
+        FROM chat_history h
+        WHERE h.chat_id = p_chat_id
+          AND h.created_at >= p_start
+          AND h.created_at < p_end
+          AND NOT h.is_bot
+    ),
+    matches AS (
+        SELECT p.position, 1 - (m.embedding <=> p_embedding) AS similarity
+        FROM period p
+        JOIN messages m ON m.id = p.id
+        WHERE m.embedding IS NOT NULL
+        ORDER BY m.embedding <=> p_embedding
+        LIMIT p_match_count
+    )
+    SELECT p.id, p.tg_id, p.from_user, p.text, p.created_at, p.position, max(ma.similarity) AS similarity
+    FROM matches ma
+    JOIN period p ON p.position BETWEEN ma.position - p_neighbours AND ma.position + p_neighbours
+    GROUP BY p.id, p.tg_id, p.from_user, p.text, p.created_at, p.position
+    ORDER BY p.position;
+$$;
@@ -0,0 +1,59 @@
+-- Migration: Full-text search over messages.text
+-- Словника для української в Postgres немає, тому використовуємо конфігурацію 'simple'
+-- (нижній регістр без стемінгу), а відмінки покриваємо пошуком за префіксом у запиті.
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED;
+
+-- Пошук завжди в межах одного чату
+CREATE INDEX IF NOT EXISTS messages_chat_id_search_idx ON messages USING GIN (chat_id, search);
+
+-- Запит з усіх слів (AND), кожне як префікс; у довгих словах відкидаємо закінчення,
+-- щоб "велосипеди" знаходило і "велосипед", і "велосипедом"
+CREATE OR REPLACE FUNCTION chat_search_query(p_query TEXT)
+RETURNS tsquery
+LANGUAGE sql
+IMMUTABLE
+AS $$
+    SELECT to_tsquery('simple', string_agg(
+        quote_literal(CASE WHEN length(word) > 5 THEN left(word, length(word) - 2) ELSE word END) || ':*',
+        ' & '
+    ))
+    FROM unnest(tsvector_to_array(to_tsvector('simple', p_query))) AS word;
+$$;
+
+-- Повідомлення чату за період, що містять усі слова запиту.
+-- Релевантність (ts_rank_cd) ділиться на (1 + вік повідомлення в добах), тож свіжі збіги вищі.
+CREATE OR REPLACE FUNCTION search_chat_messages(
+    p_chat_id BIGINT,
+    p_query TEXT,
+    p_start TIMESTAMPTZ DEFAULT NULL,
+    p_end TIMESTAMPTZ DEFAULT NULL,
+    p_limit INT DEFAULT 200
+)
+RETURNS TABLE (
+    id BIGINT,
+    tg_id BIGINT,
+    from_user TEXT,
+    text TEXT,
+    created_at TIMESTAMPTZ,
+    rank FLOAT
+)
+LANGUAGE sql
+STABLE
+AS $$
+    WITH q AS (SELECT chat_search_query(p_query) AS query)
+    SELECT h.id, h.tg_id, h.from_user, h.text, h.created_at,
+           ts_rank_cd(m.search, q.query)
+               / (1 + extract(epoch FROM coalesce(p_end, now()) - h.created_at) / 86400) AS rank
+    FROM q
+    JOIN messages m ON m.search @@ q.query
+    JOIN chat_history h ON h.id = m.id
+    WHERE m.chat_id = p_chat_id
+      AND (p_start IS NULL OR m.created_at >= p_start)
+      AND (p_end IS NULL OR m.created_at < p_end)
+      AND NOT h.is_bot
+    ORDER BY rank DESC, h.created_at DESC
+    LIMIT p_limit;
+$$;
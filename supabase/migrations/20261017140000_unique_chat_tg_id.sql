@@ -0,0 +1,29 @@
+-- Migration: One row per Telegram message (chat_id, tg_id)
+BEGIN;
+
+-- Повторно доставлені оновлення могли зберегтися кілька разів: лишаємо найстаріший рядок
+CREATE TEMP TABLE duplicate_messages ON COMMIT DROP AS
+SELECT id, first_value(id) OVER (PARTITION BY chat_id, tg_id ORDER BY id) AS kept_id
+FROM messages
+WHERE tg_id IS NOT NULL;
+
+DELETE FROM duplicate_messages WHERE id = kept_id;
+
+-- Хайку, що посилалися на видалені копії, тепер посилаються на збережений рядок
+UPDATE messages m
+SET haiku_source_ids = ARRAY(
+    SELECT coalesce(d.kept_id, ids.id)
+    FROM unnest(m.haiku_source_ids) WITH ORDINALITY AS ids(id, position)
+    LEFT JOIN duplicate_messages d ON d.id = ids.id
+    ORDER BY ids.position
+)
+WHERE m.haiku_source_ids && ARRAY(SELECT id FROM duplicate_messages);
+
+DELETE FROM messages WHERE id IN (SELECT id FROM duplicate_messages);
+
+-- Telegram id повідомлення унікальний лише в межах чату
+ALTER TABLE messages ADD CONSTRAINT messages_chat_id_tg_id_key UNIQUE (chat_id, tg_id);
+-- Пошук лише за tg_id більше не використовується
+DROP INDEX IF EXISTS messages_tg_id_idx;
+
+COMMIT;
@@ -0,0 +1,24 @@
+-- Migration: Embedding coverage of a chat period
+-- /ask використовує пошук за ембеддингами лише тоді, коли майже всі повідомлення
+-- періоду вже мають ембеддинг (інакше частина історії випала б із запиту)
+CREATE OR REPLACE FUNCTION chat_embedding_coverage(
+    p_chat_id BIGINT,
+    p_start TIMESTAMPTZ,
+    p_end TIMESTAMPTZ
+)
+RETURNS TABLE (
+    total BIGINT,
+    embedded BIGINT
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT count(*) AS total,
+           count(m.embedding) AS embedded
+    FROM chat_history h
+    JOIN messages m ON m.id = h.id
+    WHERE h.chat_id = p_chat_id
+      AND h.created_at >= p_start
+      AND h.created_at < p_end
+      AND NOT h.is_bot;
+$$;
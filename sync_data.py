@@ -1,12 +1,25 @@
+import json
 import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Deque, Iterator, Optional, Set, Tuple
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from utils.config import SYNC_PAGE_SIZE, SYNC_BATCH_SIZE, SYNC_CONCURRENCY, SYNC_STATE_FILE, SYNC_SAFETY_LAG
 
 # Load environment variables
 load_dotenv()
 
+# Columns copied between databases. The generated search column of messages can't be written
+# (Postgres rejects non-default values for it) and embeddings are recomputed by the bot, so both are left out
+TABLE_COLUMNS = {
+    "users": "*",
+    "messages": "id, chat_id, user_id, text, created_at, tg_id, haiku_source_ids",
+}
+SKIPPED_COLUMNS = ("search", "embedding")
+
 def get_supabase_client(is_prod: bool = False) -> Client:
     """
     Get Supabase client for either production or development environment
@@ -46,13 +59,230 @@ def clear_dev_tables(dev_client: Client) -> None:
     dev_client.table("users").delete().neq("id", 0).execute()
     print("Cleared users table")
 
-def sync_data(days_back: int = 30, clear_tables: bool = False) -> None:
+def _keyset_filter(cursor: Dict[str, Any]) -> str:
+    # Rows strictly after (created_at, id) of the cursor row
+    created_at = cursor["created_at"]
+    return f'created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt.{cursor["id"]})'
+
+def iter_pages(client: Client, table: str, start_date: Optional[datetime], end_date: datetime,
+               page_size: int = SYNC_PAGE_SIZE, after: Optional[Dict[str, Any]] = None,
+               chat_id: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Read rows created within a date range page by page, ordered by (created_at, id)
+    
+    Args:
+        client: Supabase client to read from
+        table: Table name
+        start_date: Start date for filtering, None for no lower bound
+        end_date: End date for filtering
+        page_size: Number of rows per request
+        after: Start after this {'created_at', 'id'} position (e.g. a sync watermark)
+        chat_id: Only read rows of this chat (messages only)
+        
+    Yields:
+        Lists of rows, at most page_size each
+    """
+    cursor = after
+    while True:
+        query = client.table(table) \
+            .select(TABLE_COLUMNS[table]) \
+            .lte("created_at", end_date.isoformat())
+        if start_date:
+            query = query.gte("created_at", start_date.isoformat())
+        if chat_id is not None:
+            query = query.eq("chat_id", chat_id)
+        if cursor:
+            query = query.or_(_keyset_filter(cursor))
+        rows = query.order("created_at").order("id").limit(page_size).execute().data or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        cursor = rows[-1]
+
+class SyncState:
+    """
+    Watermarks of the incremental sync, persisted in a JSON file.
+    For each table it keeps the (created_at, id) of the last row known to be written,
+    so the next run (or a resumed interrupted one) only copies newer rows.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Path of the state file (created on the first checkpoint)
+        """
+        self.path = path
+        self.cursors: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.cursors = json.load(f)
+
+    def get(self, table: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the watermark of a table
+        
+        Args:
+            table: Table name
+            
+        Returns:
+            {'created_at', 'id'} of the last synced row, or None if the table was never synced
+        """
+        return self.cursors.get(table)
+
+    def checkpoint(self, table: str, row: Dict[str, Any]) -> None:
+        """
+        Advance a table's watermark and save the state file
+        
+        Args:
+            table: Table name
+            row: Last row of a written batch
+        """
+        self.cursors[table] = {"created_at": row["created_at"], "id": row["id"]}
+        # Write a temporary file first so an interrupted run never leaves a broken state file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.cursors, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+class BatchWriter:
+    """
+    Upserts batches of rows into the development database from a thread pool.
+    At most `concurrency` batches are in flight; submit() blocks while the pool is busy.
+    
+    Batches may finish out of order, so with a sync state a table's watermark only
+    advances past batches whose predecessors have all been written too.
+    """
+
+    def __init__(self, client: Client, concurrency: int = SYNC_CONCURRENCY, state: Optional[SyncState] = None):
+        """
+        Args:
+            client: Development Supabase client
+            concurrency: Maximum number of concurrent upsert requests
+            state: Incremental sync state to checkpoint, if any
+        """
+        self.client = client
+        self.concurrency = max(1, concurrency)
+        self.state = state
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.futures: Set[Future] = set()
+        # Checkpoints in submission order: (batch future, table, last row of the batch)
+        self.checkpoints: Deque[Tuple[Future, str, Dict[str, Any]]] = deque()
+        # table -> number of rows written
+        self.written: Dict[str, int] = {}
+
+    def _upsert(self, table: str, rows: List[Dict[str, Any]], on_conflict: str) -> Tuple[str, int]:
+        self.client.table(table).upsert(rows, on_conflict=on_conflict).execute()
+        return table, len(rows)
+
+    def _collect(self, done: Set[Future]) -> None:
+        for future in done:
+            self.futures.discard(future)
+            # Re-raises the first failed upsert
+            table, rows = future.result()
+            self.written[table] = self.written.get(table, 0) + rows
+            self._advance_checkpoints()
+
+    def _advance_checkpoints(self) -> None:
+        while self.checkpoints:
+            future, table, row = self.checkpoints[0]
+            if future in self.futures or future.exception() is not None:
+                return
+            self.checkpoints.popleft()
+            self.state.checkpoint(table, row)
+
+    def submit(self, table: str, rows: List[Dict[str, Any]], on_conflict: str,
+               checkpoint: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Queue an upsert of rows
+        
+        Args:
+            table: Table name
+            rows: Rows to upsert
+            on_conflict: Comma-separated unique columns to merge on
+            checkpoint: Row to record as the table's watermark once this batch is written
+        """
+        while len(self.futures) >= self.concurrency:
+            done, _ = wait(self.futures, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        future = self.executor.submit(self._upsert, table, rows, on_conflict)
+        self.futures.add(future)
+        if self.state and checkpoint:
+            self.checkpoints.append((future, table, checkpoint))
+
+    def flush(self) -> None:
+        """
+        Wait until all queued upserts are written
+        """
+        done, _ = wait(self.futures)
+        self._collect(done)
+
+    def close(self) -> None:
+        """
+        Wait for queued upserts and stop the thread pool
+        """
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+class SyncProgress:
+    """
+    Tracks the number of synced rows and prints progress with throughput
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        self.rows = 0
+        self.started = time.monotonic()
+
+    def add(self, rows: int) -> None:
+        self.rows += rows
+        elapsed = time.monotonic() - self.started
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        print(f"{self.table}: {self.rows} rows read ({rate:.0f} rows/s)")
+
+    def done(self, written: int) -> None:
+        elapsed = time.monotonic() - self.started
+        rate = written / elapsed if elapsed > 0 else 0.0
+        print(f"Synced {written} {self.table} in {elapsed:.1f}s ({rate:.0f} rows/s)")
+
+def write_batches(writer: BatchWriter, table: str, rows: List[Dict[str, Any]],
+                  on_conflict: str, batch_size: int = SYNC_BATCH_SIZE) -> None:
+    """
+    Split rows into batches and queue them on the writer.
+    The last row of every batch is its checkpoint, so rows must be ordered by (created_at, id).
+    
+    Args:
+        writer: Batch writer for the development database
+        table: Table name
+        rows: Rows to upsert
+        on_conflict: Comma-separated unique columns to merge on
+        batch_size: Maximum number of rows per upsert request
+    """
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        writer.submit(table, batch, on_conflict, checkpoint=batch[-1])
+
+def sync_data(days_back: int = 30, clear_tables: bool = False, page_size: int = SYNC_PAGE_SIZE,
+              batch_size: int = SYNC_BATCH_SIZE, concurrency: int = SYNC_CONCURRENCY,
+              incremental: bool = False, state_file: str = SYNC_STATE_FILE,
+              safety_lag: float = SYNC_SAFETY_LAG) -> None:
     """
     Sync data from production to development database for the specified time period
     
     Args:
         days_back: Number of days to look back for data sync (default: 30)
         clear_tables: If True, clear development tables before sync (default: False)
+        page_size: Number of rows read from production per request
+        batch_size: Number of rows written to development per request
+        concurrency: Number of concurrent write requests
+        incremental: If True, only copy rows newer than the watermarks saved in state_file
+            (days_back is used for tables without a watermark) and checkpoint after every batch
+        state_file: Path of the incremental sync state file
+        safety_lag: Seconds behind the current time where an incremental sync stops.
+            The bot sets created_at when a message arrives but writes it in batches later,
+            so rows newer than this may still be committed behind the watermark
     """
     # Initialize clients
     prod_client = get_supabase_client(is_prod=True)
@@ -60,137 +290,142 @@ def sync_data(days_back: int = 30, clear_tables: bool = False) -> None:
     
     # Calculate date range
     end_date = datetime.now()
+    if incremental:
+        # The watermark must not pass rows that are not written yet
+        end_date -= timedelta(seconds=safety_lag)
     start_date = end_date - timedelta(days=days_back)
     
     # Clear tables if requested
     if clear_tables:
         clear_dev_tables(dev_client)
     
-    # Sync users created within the date range
-    sync_users(prod_client, dev_client, start_date, end_date, skip_existing_check=clear_tables)
+    state = SyncState(state_file) if incremental else None
+    users_after = state.get("users") if state else None
+    messages_after = state.get("messages") if state else None
+    if state:
+        print(f"Incremental sync, watermarks: users={users_after}, messages={messages_after}")
     
-    # Sync messages (will automatically sync any referenced users that don't exist)
-    sync_messages(prod_client, dev_client, start_date, end_date, skip_existing_check=clear_tables)
+    writer = BatchWriter(dev_client, concurrency, state)
+    try:
+        # Users already present in development, so messages don't look them up again
+        known_users: Set[int] = set()
+        
+        # Sync users created within the date range (or after the watermark)
+        sync_users(prod_client, writer, None if users_after else start_date, end_date,
+                   known_users, page_size, batch_size, users_after)
+        
+        # Sync messages (will automatically sync any referenced users that don't exist)
+        sync_messages(prod_client, writer, None if messages_after else start_date, end_date,
+                      known_users, page_size, batch_size, messages_after)
+    finally:
+        writer.close()
     
-    print(f"Data sync completed for period: {start_date} to {end_date}")
+    if state:
+        print(f"Incremental data sync completed up to {end_date}")
+    else:
+        print(f"Data sync completed for period: {start_date} to {end_date}")
 
-def sync_users(prod_client: Client, dev_client: Client, 
-              start_date: datetime, end_date: datetime, skip_existing_check: bool = False) -> None:
+def sync_users(prod_client: Client, writer: BatchWriter, start_date: Optional[datetime], end_date: datetime,
+               known_users: Set[int], page_size: int = SYNC_PAGE_SIZE, batch_size: int = SYNC_BATCH_SIZE,
+               after: Optional[Dict[str, Any]] = None) -> None:
     """
     Sync users from production to development database
     
     Args:
         prod_client: Production Supabase client
-        dev_client: Development Supabase client
-        start_date: Start date for filtering
+        writer: Batch writer for the development database
+        start_date: Start date for filtering, None for no lower bound
         end_date: End date for filtering
-        skip_existing_check: If True, skip checking for existing records
+        known_users: Set of user IDs present in development, updated in place
+        page_size: Number of rows read from production per request
+        batch_size: Number of rows written to development per request
+        after: Only sync rows after this watermark
     """
-    # Get users from production
-    prod_users = prod_client.table("users") \
-        .select("*") \
-        .gte("created_at", start_date.isoformat()) \
-        .lte("created_at", end_date.isoformat()) \
-        .execute()
+    progress = SyncProgress("users")
+    written = writer.written.get("users", 0)
+    for users in iter_pages(prod_client, "users", start_date, end_date, page_size, after):
+        write_batches(writer, "users", users, "user_id", batch_size)
+        known_users.update(user["user_id"] for user in users)
+        progress.add(len(users))
     
-    if not prod_users.data:
+    # Messages reference users, so they must be written first
+    writer.flush()
+    if not progress.rows:
         print("No users found to sync")
-        return
-        
-    # Insert users into development
-    for user in prod_users.data:
-        if skip_existing_check:
-            # Skip existing check if tables were cleared
-            dev_client.table("users").insert(user).execute()
-            print(f"Synced user: {user['user_id']}")
-        else:
-            # Check if user already exists in dev
-            existing_user = dev_client.table("users") \
-                .select("*") \
-                .eq("user_id", user["user_id"]) \
-                .execute()
-                
-            if not existing_user.data:
-                dev_client.table("users").insert(user).execute()
-                print(f"Synced user: {user['user_id']}")
-            else:
-                print(f"User already exists: {user['user_id']}")
-
-def sync_user_if_needed(prod_client: Client, dev_client: Client, user_id: int) -> None:
-    """
-    Sync a specific user from production to development if they don't exist
+    progress.done(writer.written.get("users", 0) - written)
+
+def sync_missing_users(prod_client: Client, writer: BatchWriter,
+                       user_ids: Set[int], known_users: Set[int]) -> None:
+    """
+    Sync users referenced by messages that don't exist in development, in bulk
     
     Args:
         prod_client: Production Supabase client
-        dev_client: Development Supabase client
-        user_id: The user ID to check and sync if needed
+        writer: Batch writer for the development database
+        user_ids: User IDs referenced by a page of messages
+        known_users: Set of user IDs present in development, updated in place
     """
-    # Check if user exists in dev database
-    existing_user = dev_client.table("users") \
-        .select("*") \
-        .eq("user_id", user_id) \
+    unknown = list(user_ids - known_users)
+    if not unknown:
+        return
+    
+    # Check which of them already exist in dev database
+    existing = writer.client.table("users") \
+        .select("user_id") \
+        .in_("user_id", unknown) \
         .execute()
-        
-    if not existing_user.data:
-        # User doesn't exist, fetch from production and sync
-        prod_user = prod_client.table("users") \
-            .select("*") \
-            .eq("user_id", user_id) \
-            .execute()
-            
-        if prod_user.data:
-            dev_client.table("users").insert(prod_user.data[0]).execute()
-            print(f"Synced user (referenced by message): {user_id}")
-        else:
-            print(f"Warning: User {user_id} not found in production database")
+    known_users.update(user["user_id"] for user in existing.data or [])
+    
+    missing = [user_id for user_id in unknown if user_id not in known_users]
+    if not missing:
+        return
+    
+    # Fetch the rest from production and write them before the messages
+    prod_users = prod_client.table("users") \
+        .select(TABLE_COLUMNS["users"]) \
+        .in_("user_id", missing) \
+        .execute()
+    if prod_users.data:
+        writer.submit("users", prod_users.data, "user_id")
+        writer.flush()
+        known_users.update(user["user_id"] for user in prod_users.data)
+        print(f"Synced {len(prod_users.data)} users referenced by messages")
+    
+    not_found = set(missing) - known_users
+    if not_found:
+        print(f"Warning: Users {sorted(not_found)} not found in production database")
 
-def sync_messages(prod_client: Client, dev_client: Client,
-                 start_date: datetime, end_date: datetime, skip_existing_check: bool = False) -> None:
+def sync_messages(prod_client: Client, writer: BatchWriter, start_date: Optional[datetime], end_date: datetime,
+                  known_users: Set[int], page_size: int = SYNC_PAGE_SIZE, batch_size: int = SYNC_BATCH_SIZE,
+                  after: Optional[Dict[str, Any]] = None) -> None:
     """
     Sync messages from production to development database
     
     Args:
         prod_client: Production Supabase client
-        dev_client: Development Supabase client
-        start_date: Start date for filtering
+        writer: Batch writer for the development database
+        start_date: Start date for filtering, None for no lower bound
         end_date: End date for filtering
-        skip_existing_check: If True, skip checking for existing records
+        known_users: Set of user IDs present in development, updated in place
+        page_size: Number of rows read from production per request
+        batch_size: Number of rows written to development per request
+        after: Only sync rows after this watermark
     """
-    # Get messages from production
-    prod_messages = prod_client.table("messages") \
-        .select("*") \
-        .gte("created_at", start_date.isoformat()) \
-        .lte("created_at", end_date.isoformat()) \
-        .execute()
+    progress = SyncProgress("messages")
+    written = writer.written.get("messages", 0)
+    for messages in iter_pages(prod_client, "messages", start_date, end_date, page_size, after):
+        # Ensure the users exist before inserting the messages
+        sync_missing_users(prod_client, writer, {message["user_id"] for message in messages}, known_users)
+        
+        # Messages whose user is missing in production would violate the foreign key
+        messages = [message for message in messages if message["user_id"] in known_users]
+        write_batches(writer, "messages", messages, "id", batch_size)
+        progress.add(len(messages))
     
-    if not prod_messages.data:
+    writer.flush()
+    if not progress.rows:
         print("No messages found to sync")
-        return
-        
-    # Insert messages into development
-    for message in prod_messages.data:
-        if skip_existing_check:
-            # Skip existing check if tables were cleared
-            # Ensure the user exists before inserting the message
-            sync_user_if_needed(prod_client, dev_client, message["user_id"])
-            
-            dev_client.table("messages").insert(message).execute()
-            print(f"Synced message: {message['id']}")
-        else:
-            # Check if message already exists in dev
-            existing_message = dev_client.table("messages") \
-                .select("*") \
-                .eq("id", message["id"]) \
-                .execute()
-                
-            if not existing_message.data:
-                # Ensure the user exists before inserting the message
-                sync_user_if_needed(prod_client, dev_client, message["user_id"])
-                
-                dev_client.table("messages").insert(message).execute()
-                print(f"Synced message: {message['id']}")
-            else:
-                print(f"Message already exists: {message['id']}")
+    progress.done(writer.written.get("messages", 0) - written)
 
 def main():
     """
@@ -202,11 +437,23 @@ def main():
     parser = argparse.ArgumentParser(description="Sync data from production to development database")
     parser.add_argument("--days", type=int, default=30,
                       help="Number of days to look back for data sync (default: 30)")
-    parser.add_argument("--clear", action="store_true",
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--clear", action="store_true",
                       help="Clear development tables before sync (default: False)")
+    mode.add_argument("--incremental", action="store_true",
+                      help="Only copy rows newer than the last synced ones and resume interrupted runs")
+    parser.add_argument("--state-file", default=SYNC_STATE_FILE,
+                      help=f"Incremental sync state file (default: {SYNC_STATE_FILE})")
+    parser.add_argument("--page-size", type=int, default=SYNC_PAGE_SIZE,
+                      help=f"Rows read from production per request (default: {SYNC_PAGE_SIZE})")
+    parser.add_argument("--batch-size", type=int, default=SYNC_BATCH_SIZE,
+                      help=f"Rows written to development per request (default: {SYNC_BATCH_SIZE})")
+    parser.add_argument("--concurrency", type=int, default=SYNC_CONCURRENCY,
+                      help=f"Concurrent write requests (default: {SYNC_CONCURRENCY})")
     
     args = parser.parse_args()
-    sync_data(args.days, args.clear)
+    sync_data(args.days, args.clear, args.page_size, args.batch_size, args.concurrency,
+              args.incremental, args.state_file)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
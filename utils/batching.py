@@ -0,0 +1,27 @@
+"""
+Helpers shared by the background batch writers (ingestion, embeddings)
+"""
+import logging
+from typing import List, TypeVar
+
+T = TypeVar("T")
+
+def requeue(batch: List[T], pending: List[T], max_pending: int, name: str) -> List[T]:
+    """
+    Put a failed batch back in front of the items that arrived meanwhile
+
+    Args:
+        batch: Items of the failed batch
+        pending: Items queued since the batch was taken
+        max_pending: Maximum number of queued items; the oldest ones are dropped beyond it
+        name: Queue name for the log
+
+    Returns:
+        The new queue
+    """
+    queue = batch + pending
+    overflow = len(queue) - max_pending
+    if overflow > 0:
+        logging.error(f"[{name}] Queue is full, dropping {overflow} oldest items")
+        queue = queue[overflow:]
+    return queue
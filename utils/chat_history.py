@@ -0,0 +1,102 @@
+"""
+Per-chat in-memory buffer of recent messages
+"""
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Dict, Any, List, Optional
+import db_service
+from utils.config import MESSAGE_LIMIT, CHAT_HISTORY_MAX_CHATS
+
+class ChatHistoryBuffer:
+    """
+    Keeps the last max_messages human messages of every chat, already formatted
+    the same way as db_service.get_chat_messages, so haiku generation does not
+    need to read them back from the database.
+
+    A chat is warmed from the database the first time a message for it is added.
+    Memory is bounded by max_messages per chat and max_chats chats (least
+    recently active chats are dropped and warmed again when they come back).
+    """
+
+    def __init__(self, max_messages: int, max_chats: int):
+        """
+        Args:
+            max_messages: Number of messages kept per chat
+            max_chats: Number of chats kept in memory
+        """
+        self.max_messages = max_messages
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[int, deque]" = OrderedDict()
+        self._warming: Dict[int, asyncio.Task] = {}
+
+    async def _warm(self, chat_id: int) -> None:
+        if chat_id in self._chats:
+            return
+        if chat_id not in self._warming:
+            self._warming[chat_id] = asyncio.create_task(self._load(chat_id))
+        try:
+            await asyncio.shield(self._warming[chat_id])
+        finally:
+            self._warming.pop(chat_id, None)
+
+    async def _load(self, chat_id: int) -> None:
+        try:
+            # get_chat_messages returns newest first
+            messages = await db_service.get_chat_messages(chat_id, limit=self.max_messages, exclude_bots=True)
+        except Exception as e:
+            logging.warning(f"[chat_history] Failed to warm chat_id={chat_id}: {e}")
+            messages = []
+        if chat_id not in self._chats:
+            self._chats[chat_id] = deque(reversed(messages), maxlen=self.max_messages)
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+    async def add(self, chat_id: int, message: Dict[str, Any]) -> None:
+        """
+        Append a message to the chat's buffer
+
+        Args:
+            chat_id: Telegram chat ID
+            message: Formatted message with 'tg_id', 'from_user', 'text' and 'created_at';
+                'id' may be None until the message is written to the database
+        """
+        await self._warm(chat_id)
+        self._chats[chat_id].append(message)
+        self._chats.move_to_end(chat_id)
+
+    def recent(self, chat_id: int, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Get the most recent messages of a chat
+
+        Args:
+            chat_id: Telegram chat ID
+            limit: Maximum number of messages to return
+
+        Returns:
+            List of messages, newest first (same order as db_service.get_chat_messages)
+        """
+        messages = list(reversed(self._chats.get(chat_id, ())))
+        return messages[:limit] if limit is not None else messages
+
+    def assign_ids(self, saved_messages: List[Dict[str, Any]]) -> None:
+        """
+        Fill in database IDs of buffered messages once they have been saved
+
+        Args:
+            saved_messages: Rows returned by db_service.save_messages
+        """
+        for saved in saved_messages:
+            buffer = self._chats.get(saved.get("chat_id"))
+            if not buffer or saved.get("tg_id") is None:
+                continue
+            for message in reversed(buffer):
+                if message.get("id") is None and message.get("tg_id") == saved["tg_id"]:
+                    message["id"] = saved["id"]
+                    break
+
+# Shared buffer used by the message and haiku handlers
+chat_history = ChatHistoryBuffer(MESSAGE_LIMIT, CHAT_HISTORY_MAX_CHATS)
@@ -35,6 +35,17 @@ if TEST_CURRENT_TIME:
     except ValueError:
         TEST_CURRENT_TIME = None
 
+# Prometheus metrics endpoint (optional, disabled when the port is not set)
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_PORT = int(METRICS_PORT) if METRICS_PORT else None
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Webhook mode (used instead of polling when WEBHOOK_URL is set)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
 # Load configuration from config.json
 with open('config.json', 'r', encoding='utf-8') as config_file:
     config = json.load(config_file)
@@ -42,4 +53,96 @@ with open('config.json', 'r', encoding='utf-8') as config_file:
 # Get configuration values
 MESSAGE_LIMIT = config.get('message_limit')
 MODEL = config.get('model')
-BOT_USER = config.get('bot')
\ No newline at end of file
+BOT_USER = config.get('bot')
+
+# Per-task model routing
+ROUTING_CONFIG = config.get('routing', {})
+ROUTING_TASKS = ROUTING_CONFIG.get('tasks', {})
+ROUTING_WINDOW = int(ROUTING_CONFIG.get('window', 50))
+ROUTING_MIN_SAMPLES = int(ROUTING_CONFIG.get('min_samples', 10))
+ROUTING_COOLDOWN = float(ROUTING_CONFIG.get('cooldown_seconds', 120))
+
+# OpenAI client settings
+OPENAI_CONFIG = config.get('openai', {})
+OPENAI_TIMEOUT = float(OPENAI_CONFIG.get('timeout_seconds', 60))
+OPENAI_MAX_CONNECTIONS = int(OPENAI_CONFIG.get('max_connections', 20))
+OPENAI_REQUESTS_PER_MINUTE = float(OPENAI_CONFIG.get('requests_per_minute', 500))
+OPENAI_TOKENS_PER_MINUTE = float(OPENAI_CONFIG.get('tokens_per_minute', 200000))
+OPENAI_EXPECTED_COMPLETION_TOKENS = int(OPENAI_CONFIG.get('expected_completion_tokens', 1000))
+OPENAI_MAX_RETRIES = int(OPENAI_CONFIG.get('max_retries', 4))
+OPENAI_BACKOFF_BASE = float(OPENAI_CONFIG.get('backoff_base_seconds', 0.5))
+OPENAI_BACKOFF_MAX = float(OPENAI_CONFIG.get('backoff_max_seconds', 20))
+
+# Database client settings
+DATABASE_CONFIG = config.get('database', {})
+DB_TIMEOUT = float(DATABASE_CONFIG.get('timeout_seconds', 10))
+HISTORY_PAGE_SIZE = int(DATABASE_CONFIG.get('history_page_size', 500))
+HISTORY_MAX_ROWS = int(DATABASE_CONFIG.get('history_max_rows', 20000))
+
+# Write-behind message ingestion settings
+INGESTION_CONFIG = config.get('ingestion', {})
+INGESTION_MAX_BATCH_SIZE = int(INGESTION_CONFIG.get('max_batch_size', 50))
+INGESTION_MAX_LATENCY = float(INGESTION_CONFIG.get('max_latency_seconds', 2.0))
+
+# Known-user cache settings
+USER_CACHE_CONFIG = config.get('user_cache', {})
+USER_CACHE_MAX_SIZE = int(USER_CACHE_CONFIG.get('max_size', 10000))
+USER_CACHE_TTL = float(USER_CACHE_CONFIG.get('ttl_seconds', 3600))
+USER_ACTIVITY_INTERVAL = float(USER_CACHE_CONFIG.get('activity_interval_seconds', 300))
+
+# Recent chat history buffer settings
+CHAT_HISTORY_CONFIG = config.get('chat_history', {})
+CHAT_HISTORY_MAX_CHATS = int(CHAT_HISTORY_CONFIG.get('max_chats', 1000))
+
+# /ask command settings
+ASK_CONFIG = config.get('ask', {})
+ASK_CONTEXT_TOKEN_BUDGET = int(ASK_CONFIG.get('context_token_budget', 12000))
+ASK_CHUNK_TOKEN_BUDGET = int(ASK_CONFIG.get('chunk_token_budget', 4000))
+ASK_MAX_PARALLEL_SUMMARIES = int(ASK_CONFIG.get('max_parallel_summaries', 4))
+ASK_SUMMARY_MIN_WINDOW = int(ASK_CONFIG.get('summary_min_window_minutes', 180))
+ASK_SUMMARY_BUCKET_MINUTES = int(ASK_CONFIG.get('summary_bucket_minutes', 60))
+ASK_SUMMARY_MAX_BUCKETS = int(ASK_CONFIG.get('summary_max_buckets', 5000))
+ASK_SUMMARY_MAX_COLD_BUCKETS = int(ASK_CONFIG.get('summary_max_cold_buckets', 24))
+ASK_RETRIEVAL_MIN_WINDOW = int(ASK_CONFIG.get('retrieval_min_window_minutes', 360))
+ASK_RETRIEVAL_MIN_COVERAGE = float(ASK_CONFIG.get('retrieval_min_coverage', 0.95))
+ASK_RETRIEVAL_TOP_K = int(ASK_CONFIG.get('retrieval_top_k', 20))
+ASK_RETRIEVAL_NEIGHBOURS = int(ASK_CONFIG.get('retrieval_neighbours', 2))
+ASK_RETRIEVAL_TAIL_MINUTES = int(ASK_CONFIG.get('retrieval_tail_minutes', 30))
+ASK_SEARCH_MAX_RESULTS = int(ASK_CONFIG.get('search_max_results', 200))
+
+# Message embeddings (semantic retrieval for /ask)
+EMBEDDINGS_CONFIG = config.get('embeddings', {})
+EMBEDDINGS_ENABLED = bool(EMBEDDINGS_CONFIG.get('enabled', True))
+EMBEDDING_MODEL = EMBEDDINGS_CONFIG.get('model', 'text-embedding-3-small')
+EMBEDDING_DIMENSIONS = int(EMBEDDINGS_CONFIG.get('dimensions', 1536))
+EMBEDDING_BATCH_SIZE = int(EMBEDDINGS_CONFIG.get('batch_size', 100))
+
+# /ask answer cache settings
+RESPONSE_CACHE_CONFIG = config.get('response_cache', {})
+RESPONSE_CACHE_MAX_SIZE = int(RESPONSE_CACHE_CONFIG.get('max_size', 1000))
+RESPONSE_CACHE_TTL = float(RESPONSE_CACHE_CONFIG.get('ttl_seconds', 600))
+
+# Streaming replies settings
+STREAMING_CONFIG = config.get('streaming', {})
+STREAMING_ENABLED = bool(STREAMING_CONFIG.get('enabled', True))
+STREAMING_EDIT_INTERVAL = float(STREAMING_CONFIG.get('edit_interval_seconds', 1.5))
+
+# Production -> development sync settings
+SYNC_CONFIG = config.get('sync', {})
+SYNC_PAGE_SIZE = int(SYNC_CONFIG.get('page_size', 1000))
+SYNC_BATCH_SIZE = int(SYNC_CONFIG.get('batch_size', 500))
+SYNC_CONCURRENCY = int(SYNC_CONFIG.get('concurrency', 4))
+SYNC_STATE_FILE = SYNC_CONFIG.get('state_file', '.sync_state.json')
+SYNC_SAFETY_LAG = float(SYNC_CONFIG.get('safety_lag_seconds', 600))
+
+# Update processing settings
+UPDATES_CONFIG = config.get('updates', {})
+UPDATES_MAX_CONCURRENT = int(UPDATES_CONFIG.get('max_concurrent', 16))
+UPDATES_SEEN_MAX_SIZE = int(UPDATES_CONFIG.get('seen_max_size', 10000))
+UPDATES_SEEN_MESSAGES_PER_CHAT = int(UPDATES_CONFIG.get('seen_messages_per_chat', 200))
+
+# Background LLM job scheduler settings
+LLM_JOBS_CONFIG = config.get('llm_jobs', {})
+LLM_JOBS_MAX_CONCURRENT = int(LLM_JOBS_CONFIG.get('max_concurrent', 4))
+LLM_JOBS_MAX_QUEUE = int(LLM_JOBS_CONFIG.get('max_queue', 100))
+LLM_JOBS_SHED_QUEUE_DEPTH = int(LLM_JOBS_CONFIG.get('shed_queue_depth', 50))
@@ -0,0 +1,195 @@
+"""
+Token-budgeted chat history context for LLM prompts
+"""
+import asyncio
+import logging
+from functools import lru_cache
+from typing import Dict, Any, AsyncIterable, AsyncIterator, Iterable, Iterator, List, Optional, Tuple, Union
+from utils.config import MODEL, ASK_CONTEXT_TOKEN_BUDGET, ASK_CHUNK_TOKEN_BUDGET, ASK_MAX_PARALLEL_SUMMARIES
+from utils.openai_client import invoke_model
+from utils.rate_limiter import estimate_tokens
+from utils.prompts import PROMPT_SUMMARIZE_HISTORY
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning(f"[context_builder] tiktoken unavailable, approximating token counts: {e}")
+        return None
+
+async def load_tokenizer() -> None:
+    """
+    Load the tokenizer in a worker thread. On the first use tiktoken downloads its
+    BPE file, which would otherwise block the event loop inside the first /ask
+    """
+    await asyncio.to_thread(_get_encoding)
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens in text for the configured model
+
+    Args:
+        text: Text to count
+
+    Returns:
+        int: Number of tokens (approximate if tiktoken is unavailable)
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def format_history_message(msg: Dict[str, Any]) -> str:
+    """
+    Format a single chat message for the /ask prompt
+
+    Args:
+        msg: Message with 'from_user', 'created_at' and 'text'
+
+    Returns:
+        str: Formatted message block
+    """
+    return (
+        f"Автор: {msg['from_user']}\n"
+        f"Час: {msg['created_at']}\n"
+        f"Повідомлення: {msg['text']}\n"
+        "---\n"
+    )
+
+def pack_blocks(blocks: Iterable[str], chunk_tokens: int) -> Iterator[Tuple[str, int]]:
+    """
+    Pack text blocks into chunks that fit into chunk_tokens
+
+    Args:
+        blocks: Text blocks in order
+        chunk_tokens: Token budget per chunk (a single larger block forms its own chunk)
+
+    Yields:
+        Tuple of chunk text and its token count
+    """
+    chunk: List[str] = []
+    chunk_size = 0
+    for block in blocks:
+        block_size = count_tokens(block)
+        if chunk and chunk_size + block_size > chunk_tokens:
+            yield "".join(chunk), chunk_size
+            chunk, chunk_size = [], 0
+        chunk.append(block)
+        chunk_size += block_size
+    if chunk:
+        yield "".join(chunk), chunk_size
+
+# Shared limit on concurrent summarisation calls, created lazily inside the event loop
+_summary_semaphore: Optional[asyncio.Semaphore] = None
+
+async def summarize_chunks(chunks: List[str], user_query: str = "",
+                           prompt: str = PROMPT_SUMMARIZE_HISTORY) -> List[str]:
+    """
+    Summarise history chunks concurrently
+
+    Args:
+        chunks: Formatted history chunks in chronological order
+        user_query: The user's question, used to focus the summaries
+        prompt: Prompt template with {history} and optionally {user_query} placeholders
+
+    Returns:
+        List of summaries in the same order as chunks
+    """
+    global _summary_semaphore
+    if _summary_semaphore is None:
+        _summary_semaphore = asyncio.Semaphore(ASK_MAX_PARALLEL_SUMMARIES)
+
+    async def summarize(chunk: str) -> str:
+        async with _summary_semaphore:
+            return await invoke_model(prompt.format(history=chunk, user_query=user_query), task="summary")
+
+    return await asyncio.gather(*(summarize(chunk) for chunk in chunks))
+
+async def _iterate(messages: Union[Iterable[Dict[str, Any]], AsyncIterable[Dict[str, Any]]]) -> AsyncIterator[Dict[str, Any]]:
+    if hasattr(messages, "__aiter__"):
+        async for msg in messages:
+            yield msg
+    else:
+        for msg in messages:
+            yield msg
+
+async def build_history(messages: Union[Iterable[Dict[str, Any]], AsyncIterable[Dict[str, Any]]],
+                        user_query: str, budget: int = ASK_CONTEXT_TOKEN_BUDGET, encoder: Optional[Any] = None) -> str:
+    """
+    Build the history section of the /ask prompt within a token budget.
+
+    Rows are consumed one by one (e.g. straight from db_service.iter_chat_messages)
+    and packed into chunks. If the formatted history fits into the budget it is
+    returned as is, otherwise it is summarised with reduce_chunks.
+
+    Args:
+        messages: Messages in chronological order, a list or an async iterator
+        user_query: The user's question
+        budget: Token budget for the history section
+        encoder: utils.prompt_encoder.PromptEncoder for the compact format; its header
+            (time and author aliases) is not included and must be added by the caller
+
+    Returns:
+        str: History text for the prompt, empty if there are no messages
+    """
+    chunks: List[Tuple[str, int]] = []
+    blocks: List[str] = []
+    blocks_size = 0
+    async for msg in _iterate(messages):
+        block = encoder.add(msg) if encoder is not None else format_history_message(msg)
+        if not block:
+            continue
+        block_size = count_tokens(block)
+        if blocks and blocks_size + block_size > ASK_CHUNK_TOKEN_BUDGET:
+            chunks.append(("".join(blocks).lstrip("\n"), blocks_size))
+            blocks, blocks_size = [], 0
+            if encoder is not None:
+                # A chunk starts with a full line, not a continuation of the previous one
+                encoder.break_run()
+                block = encoder.encode_message(msg)
+                block_size = count_tokens(block)
+        blocks.append(block)
+        blocks_size += block_size
+    if blocks:
+        chunks.append(("".join(blocks).lstrip("\n"), blocks_size))
+    if encoder is not None:
+        chunks = [(chunk + "\n", size) for chunk, size in chunks]
+
+    # Summaries need the author names behind the aliases
+    header = encoder.header() if encoder is not None else ""
+    return await reduce_chunks(chunks, user_query, budget, header)
+
+async def reduce_chunks(chunks: List[Tuple[str, int]], user_query: str, budget: int, header: str = "") -> str:
+    """
+    Fit history chunks into a token budget: if they are too large, summarise them
+    concurrently (map) and merge the summaries (reduce), summarising again until
+    the result fits
+
+    Args:
+        chunks: Chunks of at most chunk_token_budget tokens with their token counts, in order
+        user_query: The user's question, used to focus the summaries
+        budget: Token budget for the result
+        header: Text put in front of every chunk of the first round (e.g. author aliases)
+
+    Returns:
+        str: The chunks or their summaries
+    """
+    total = sum(size for _, size in chunks)
+    if total <= budget:
+        return "".join(chunk for chunk, _ in chunks)
+
+    while True:
+        logging.info(f"[context_builder] History is {total} tokens (budget {budget}), summarising {len(chunks)} chunks")
+        summaries = await summarize_chunks([header + chunk for chunk, _ in chunks], user_query)
+        header = ""
+        parts = [f"Підсумок частини {i + 1}:\n{summary}\n---\n" for i, summary in enumerate(summaries)]
+        merged = list(pack_blocks(parts, ASK_CHUNK_TOKEN_BUDGET))
+        total = sum(size for _, size in merged)
+        if total <= budget or len(merged) == len(chunks):
+            return "".join(parts)
+        chunks = merged
@@ -0,0 +1,126 @@
+"""
+Embeddings index over chat messages for semantic retrieval in /ask
+
+Saved messages are embedded in the background, in batches, and the vectors
+are stored next to the messages (pgvector column messages.embedding).
+"""
+import asyncio
+import datetime
+import logging
+from typing import Any, Dict, List, Optional
+import db_service
+from utils.config import (
+    EMBEDDINGS_ENABLED, EMBEDDING_BATCH_SIZE, ASK_RETRIEVAL_TOP_K, ASK_RETRIEVAL_NEIGHBOURS,
+    ASK_RETRIEVAL_MIN_COVERAGE
+)
+from utils.openai_client import embed_texts
+from utils.batching import requeue
+from utils.metrics import register_queue
+
+# Longer messages are cut before embedding; their beginning carries the topic
+MAX_EMBED_CHARS = 8000
+
+class EmbeddingIndex:
+    """
+    Keeps message embeddings up to date and searches them.
+
+    add() only queues messages; a single background task embeds them in
+    batches of batch_size and writes the vectors with one call per batch,
+    so ingestion never waits for the embeddings API.
+    """
+
+    def __init__(self, enabled: bool, batch_size: int):
+        """
+        Args:
+            enabled: Whether messages are embedded and retrieval is available
+            batch_size: Number of messages embedded per request
+        """
+        self.enabled = enabled
+        self.batch_size = batch_size
+        # Failed batches are kept for retry, but never more than this many messages
+        self.max_pending = batch_size * 20
+        self._pending: List[Dict[str, Any]] = []
+        self._worker: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of messages waiting to be embedded
+        """
+        return len(self._pending)
+
+    def add(self, messages: List[Dict[str, Any]]) -> None:
+        """
+        Queue saved messages for embedding
+
+        Args:
+            messages: Saved message rows with 'id' and 'text'
+        """
+        if not self.enabled:
+            return
+        self._pending.extend(msg for msg in messages if msg.get('id') and (msg.get('text') or '').strip())
+        if self._pending and self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        try:
+            while self._pending:
+                batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+                try:
+                    embeddings = await embed_texts([msg['text'][:MAX_EMBED_CHARS] for msg in batch])
+                    await db_service.set_message_embeddings([
+                        {'id': msg['id'], 'embedding': embedding} for msg, embedding in zip(batch, embeddings)
+                    ])
+                except Exception as e:
+                    logging.error(f"[embedding_index] Failed to embed {len(batch)} messages: {e}")
+                    self._pending = requeue(batch, self._pending, self.max_pending, "embedding_index")
+                    # Retry with the next add() instead of spinning on a failing API
+                    return
+        finally:
+            self._worker = None
+
+    async def search(self, chat_id: int, query: str, start: datetime.datetime,
+                     end: datetime.datetime) -> List[List[Dict[str, Any]]]:
+        """
+        Find the messages of a period most relevant to a query, with surrounding context
+
+        Args:
+            chat_id: Telegram chat ID
+            query: The user's question
+            start: Start of the period (inclusive)
+            end: End of the period (exclusive)
+
+        Returns:
+            Excerpts in chronological order, each a list of consecutive messages
+            (empty if less than ask.retrieval_min_coverage of the period's messages
+            are embedded, so the caller uses the full history instead)
+        """
+        if not self.enabled:
+            return []
+        total, embedded = await db_service.get_embedding_coverage(chat_id, start, end)
+        if not total or embedded / total < ASK_RETRIEVAL_MIN_COVERAGE:
+            logging.info(f"[embedding_index] Only {embedded} of {total} messages of chat_id={chat_id} "
+                         f"are embedded, not using retrieval")
+            return []
+        [embedding] = await embed_texts([query[:MAX_EMBED_CHARS]])
+        rows = await db_service.match_chat_messages(
+            chat_id, embedding, start, end, ASK_RETRIEVAL_TOP_K, ASK_RETRIEVAL_NEIGHBOURS
+        )
+        excerpts: List[List[Dict[str, Any]]] = []
+        for row in rows:
+            if excerpts and row['position'] == excerpts[-1][-1]['position'] + 1:
+                excerpts[-1].append(row)
+            else:
+                excerpts.append([row])
+        return excerpts
+
+    async def close(self) -> None:
+        """
+        Wait for the messages queued so far to be embedded
+        """
+        if self._worker is not None:
+            await asyncio.gather(self._worker, return_exceptions=True)
+
+# Shared index fed by the ingestor and searched by /ask
+embedding_index = EmbeddingIndex(EMBEDDINGS_ENABLED, EMBEDDING_BATCH_SIZE)
+register_queue("embeddings", lambda: embedding_index.pending)
@@ -0,0 +1,116 @@
+"""
+Write-behind ingestion of incoming messages
+
+Messages are buffered in memory and written to the database in batches:
+one bulk user upsert, one bulk message insert and one coalesced
+last_activity update per flush instead of three round trips per message.
+"""
+import asyncio
+import logging
+from typing import Dict, Any, List, Optional
+import db_service
+from utils.chat_history import chat_history
+from utils.embedding_index import embedding_index
+from utils.batching import requeue
+from utils.config import INGESTION_MAX_BATCH_SIZE, INGESTION_MAX_LATENCY
+from utils.metrics import register_queue
+
+class MessageIngestor:
+    """
+    Buffers messages and flushes them when the batch is full or the oldest
+    buffered message has waited for max_latency seconds
+    """
+
+    def __init__(self, max_batch_size: int, max_latency: float):
+        """
+        Args:
+            max_batch_size: Number of buffered messages that triggers a flush
+            max_latency: Maximum seconds a message may wait in the buffer
+        """
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        # Failed batches are kept for retry, but never more than this many messages
+        self.max_pending = max_batch_size * 20
+        self._messages: List[Dict[str, Any]] = []
+        self._users: Dict[int, Dict[str, Any]] = {}
+        self._timer: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of messages waiting to be written
+        """
+        return len(self._messages)
+
+    async def add(self, user_data: Dict[str, Any], message_data: Dict[str, Any]) -> None:
+        """
+        Queue a message (and its author) for the next flush
+
+        Args:
+            user_data: User row built with db_service.build_user_data
+            message_data: Message row built with db_service.build_message_data
+        """
+        self._users[user_data["user_id"]] = user_data
+        self._messages.append(message_data)
+
+        if len(self._messages) >= self.max_batch_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.max_latency)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Write all buffered messages to the database
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self._messages:
+                return
+            messages, self._messages = self._messages, []
+            users, self._users = self._users, {}
+            try:
+                # Users go first because of the messages_user_id_fkey constraint
+                await db_service.upsert_users(list(users.values()))
+                saved_messages, _ = await asyncio.gather(
+                    db_service.save_messages(messages),
+                    db_service.update_users_last_activity(list(users))
+                )
+                chat_history.assign_ids(saved_messages)
+                embedding_index.add(saved_messages)
+                logging.info(f"[ingestion] Flushed {len(messages)} messages from {len(users)} users")
+            except Exception as e:
+                logging.error(f"[ingestion] Failed to flush {len(messages)} messages: {e}")
+                self._requeue(users, messages)
+                # Retry after max_latency even if no new message arrives
+                if self._timer is None:
+                    self._timer = asyncio.create_task(self._flush_later())
+
+    def _requeue(self, users: Dict[int, Dict[str, Any]], messages: List[Dict[str, Any]]) -> None:
+        self._messages = requeue(messages, self._messages, self.max_pending, "ingestion")
+        for user_id, user_data in users.items():
+            self._users.setdefault(user_id, user_data)
+
+    async def close(self) -> None:
+        """
+        Stop the flush timer and write everything that is still buffered
+        """
+        self._cancel_timer()
+        await self.flush()
+        # A failed final flush must not leave a retry timer behind
+        self._cancel_timer()
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+# Shared ingestor used by the message handler
+ingestor = MessageIngestor(INGESTION_MAX_BATCH_SIZE, INGESTION_MAX_LATENCY)
+register_queue("ingestion", lambda: ingestor.pending)
@@ -0,0 +1,188 @@
+"""
+Background scheduler for LLM jobs (haikus, haiku replies, /ask answers and summary backfills)
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Any, Awaitable, Callable, Hashable, List, Optional, Set, Tuple
+from utils.config import LLM_JOBS_MAX_CONCURRENT, LLM_JOBS_MAX_QUEUE, LLM_JOBS_SHED_QUEUE_DEPTH
+from utils.metrics import current_handler, record_handler_error, register_queue, LLM_JOBS
+
+# Lower value runs first
+PRIORITIES = {
+    "ask": 0,
+    "haiku": 1,
+    "response": 2,
+    "summary": 3,
+}
+
+# Jobs of this priority and lower are only accepted while the queue is shorter than shed_queue_depth
+SHED_PRIORITY = PRIORITIES["response"]
+
+class LLMJob:
+    """
+    A queued job: a coroutine function plus what the scheduler needs to order, dedupe and shed it
+    """
+
+    def __init__(self, kind: str, key: Tuple, func: Callable[[], Awaitable[Any]],
+                 on_shed: Optional[Callable[[], Awaitable[Any]]], handler: str, seq: int):
+        self.kind = kind
+        self.priority = PRIORITIES[kind]
+        self.key = key
+        self.func = func
+        self.on_shed = on_shed
+        self.handler = handler
+        self.seq = seq
+        self.shed = False
+
+    def __lt__(self, other: "LLMJob") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class LLMJobScheduler:
+    """
+    Runs LLM jobs in the background with a global concurrency cap.
+
+    Queued jobs run by priority (/ask, then haikus, then haiku replies, then
+    summary backfills) and in submission order within a priority. A job is
+    dropped if an identical one (same kind, chat and dedupe key) is already
+    queued or running. The queue is bounded: when it is full, a new job evicts
+    the newest job of a lower priority or is rejected, and haiku replies and
+    summary backfills are only accepted while the queue is shorter than
+    shed_queue_depth.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, shed_queue_depth: int):
+        """
+        Args:
+            max_concurrent: Maximum number of jobs running at the same time
+            max_queue: Maximum number of queued (not yet running) jobs
+            shed_queue_depth: Queue depth from which lowest priority jobs are rejected
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.shed_queue_depth = shed_queue_depth
+        self._heap: List[LLMJob] = []
+        self._queued = 0
+        self._running: Set[asyncio.Task] = set()
+        self._keys: Set[Tuple] = set()
+        self._callbacks: Set[asyncio.Task] = set()
+        self._seq = itertools.count()
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of queued jobs that haven't started yet
+        """
+        return self._queued
+
+    def submit(self, kind: str, chat_id: int, func: Callable[[], Awaitable[Any]],
+               dedupe_key: Hashable = None, on_shed: Optional[Callable[[], Awaitable[Any]]] = None) -> bool:
+        """
+        Queue a job
+
+        Args:
+            kind: 'ask', 'haiku', 'response' or 'summary'
+            chat_id: Telegram chat ID the job belongs to
+            func: Coroutine function doing the work (LLM call and reply)
+            dedupe_key: Extra part of the dedupe key, e.g. the normalised /ask query
+            on_shed: Coroutine function called if the queued job is later evicted
+
+        Returns:
+            bool: True if the job was queued, False if it was deduplicated or rejected
+        """
+        key = (kind, chat_id, dedupe_key)
+        if key in self._keys:
+            LLM_JOBS.labels(kind, "deduped").inc()
+            return False
+
+        priority = PRIORITIES[kind]
+        if priority >= SHED_PRIORITY and self._queued >= self.shed_queue_depth:
+            logging.warning(f"[llm_jobs] Shedding {kind} job for chat_id={chat_id}, queue depth {self._queued}")
+            LLM_JOBS.labels(kind, "rejected").inc()
+            return False
+
+        # A job that can start right away never waits in the queue
+        if self._queued >= self.max_queue and len(self._running) >= self.max_concurrent:
+            # No victim if nothing is queued (max_queue 0) or every queued job has the same or higher priority
+            victim = max((job for job in self._heap if not job.shed), key=lambda job: (job.priority, job.seq),
+                         default=None)
+            if victim is None or victim.priority <= priority:
+                logging.warning(f"[llm_jobs] Queue full, rejecting {kind} job for chat_id={chat_id}")
+                LLM_JOBS.labels(kind, "rejected").inc()
+                return False
+            self._evict(victim)
+
+        job = LLMJob(kind, key, func, on_shed, current_handler.get(), next(self._seq))
+        heapq.heappush(self._heap, job)
+        self._queued += 1
+        self._keys.add(key)
+        LLM_JOBS.labels(kind, "queued").inc()
+        self._dispatch()
+        return True
+
+    def _evict(self, job: LLMJob) -> None:
+        logging.warning(f"[llm_jobs] Queue full, evicting {job.kind} job for chat_id={job.key[1]}")
+        LLM_JOBS.labels(job.kind, "shed").inc()
+        job.shed = True
+        self._queued -= 1
+        self._keys.discard(job.key)
+        if job.on_shed is not None:
+            self._spawn(job.on_shed(), self._callbacks)
+
+    def _spawn(self, coroutine: Awaitable[Any], tasks: Set[asyncio.Task]) -> asyncio.Task:
+        task = asyncio.ensure_future(coroutine)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    def _job_done(self, task: asyncio.Task) -> None:
+        # Runs after the task has left the running set, so its slot is free
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._heap and len(self._running) < self.max_concurrent:
+            job = heapq.heappop(self._heap)
+            if job.shed:
+                continue
+            self._queued -= 1
+            self._spawn(self._run(job), self._running).add_done_callback(self._job_done)
+
+    async def _run(self, job: LLMJob) -> None:
+        # The task inherits the context of whoever dispatched it; label metrics with the submitting handler
+        current_handler.set(job.handler)
+        try:
+            await job.func()
+            LLM_JOBS.labels(job.kind, "done").inc()
+        except Exception as e:
+            LLM_JOBS.labels(job.kind, "failed").inc()
+            record_handler_error()
+            logging.error(f"[llm_jobs] {job.kind} job for chat_id={job.key[1]} failed: {e}")
+        finally:
+            self._keys.discard(job.key)
+
+    async def join(self) -> None:
+        """
+        Wait until all queued and running jobs have finished
+        """
+        while self._running or self._queued:
+            await asyncio.gather(*self._running, return_exceptions=True)
+            # Let finished jobs' callbacks start the next queued ones
+            await asyncio.sleep(0)
+
+    async def close(self) -> None:
+        """
+        Drop queued jobs and wait for running ones to finish
+        """
+        for job in self._heap:
+            if not job.shed:
+                self._evict(job)
+        self._heap.clear()
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+        if self._callbacks:
+            await asyncio.gather(*self._callbacks, return_exceptions=True)
+
+# Shared scheduler used by the haiku, response and query handlers and the summary store
+llm_jobs = LLMJobScheduler(LLM_JOBS_MAX_CONCURRENT, LLM_JOBS_MAX_QUEUE, LLM_JOBS_SHED_QUEUE_DEPTH)
+register_queue("llm_jobs", lambda: llm_jobs.depth)
@@ -0,0 +1,227 @@
+"""
+Prometheus metrics for the message pipeline
+"""
+import contextvars
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+except ImportError:
+    Counter = Gauge = Histogram = start_http_server = None
+
+class _NoopMetric:
+    # Stand-in used when prometheus_client is not installed
+    def labels(self, *args, **kwargs) -> "_NoopMetric":
+        return self
+
+    def observe(self, *args, **kwargs) -> None:
+        pass
+
+    def inc(self, *args, **kwargs) -> None:
+        pass
+
+    def set_function(self, *args, **kwargs) -> None:
+        pass
+
+def _metric(kind: Any, *args, **kwargs) -> Any:
+    return kind(*args, **kwargs) if kind is not None else _NoopMetric()
+
+# Latency buckets in seconds: database calls are milliseconds, LLM calls take seconds
+DB_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LLM_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+DB_CALL_SECONDS = _metric(
+    Histogram, "haikubot_db_call_seconds", "Duration of db_service calls",
+    ["operation", "handler"], buckets=DB_BUCKETS
+)
+DB_ERRORS = _metric(
+    Counter, "haikubot_db_errors_total", "Failed db_service calls", ["operation", "handler"]
+)
+LLM_CALL_SECONDS = _metric(
+    Histogram, "haikubot_llm_call_seconds", "Duration of OpenAI requests",
+    ["handler", "model", "mode"], buckets=LLM_BUCKETS
+)
+LLM_ERRORS = _metric(
+    Counter, "haikubot_llm_errors_total", "Failed OpenAI requests", ["handler", "model", "mode"]
+)
+LLM_TOKENS = _metric(
+    Counter, "haikubot_llm_tokens_total", "Tokens used by OpenAI requests", ["handler", "model", "kind"]
+)
+HANDLER_SECONDS = _metric(
+    Histogram, "haikubot_handler_seconds", "Duration of update handlers", ["handler"], buckets=LLM_BUCKETS
+)
+HANDLER_ERRORS = _metric(
+    Counter, "haikubot_handler_errors_total", "Errors in update handlers", ["handler"]
+)
+LLM_JOBS = _metric(
+    Counter, "haikubot_llm_jobs_total", "LLM jobs by outcome (queued, deduped, rejected, shed, done, failed)",
+    ["kind", "outcome"]
+)
+LLM_THROTTLED = _metric(
+    Counter, "haikubot_llm_throttled_total", "OpenAI requests delayed by the client-side rate limiter",
+    ["limit"]
+)
+LLM_RETRIES = _metric(
+    Counter, "haikubot_llm_retries_total", "Retried OpenAI requests", ["model", "reason"]
+)
+LLM_COALESCED = _metric(
+    Counter, "haikubot_llm_coalesced_total", "OpenAI requests served by an identical in-flight request"
+)
+LLM_RATE_HEADROOM = _metric(
+    Gauge, "haikubot_llm_rate_headroom", "Requests or tokens left in the client-side per-minute budget",
+    ["limit"]
+)
+LLM_ROUTED = _metric(
+    Counter, "haikubot_llm_routed_total", "OpenAI requests by task and the model tier serving them",
+    ["task", "model", "tier"]
+)
+PROMPT_TOKENS = _metric(
+    Counter, "haikubot_prompt_history_tokens_total", "Tokens of chat history put into prompts", ["handler"]
+)
+PROMPT_TOKENS_SAVED = _metric(
+    Counter, "haikubot_prompt_tokens_saved_total",
+    "Tokens saved by the compact history encoding compared to the four-line format", ["handler"]
+)
+DUPLICATE_UPDATES = _metric(
+    Counter, "haikubot_duplicate_updates_total", "Telegram updates dropped because they were delivered again"
+)
+CACHE_EVENTS = _metric(
+    Counter, "haikubot_cache_events_total", "Lookups and evictions of in-process caches (hit, miss, invalidation, eviction)",
+    ["cache", "event"]
+)
+CACHE_SIZE = _metric(
+    Gauge, "haikubot_cache_size", "Number of entries in in-process caches", ["cache"]
+)
+QUEUE_DEPTH = _metric(
+    Gauge, "haikubot_queue_depth", "Number of items waiting in internal queues", ["queue"]
+)
+
+# Name of the handler the current task works for, used as the 'handler' label
+current_handler: contextvars.ContextVar[str] = contextvars.ContextVar("current_handler", default="none")
+
+def track_handler(name: str) -> Callable:
+    """
+    Decorator for update handlers: sets the handler label for everything the handler
+    calls and records its duration and errors
+
+    Args:
+        name: Handler label, e.g. 'store', 'haiku', 'response' or 'ask'
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_handler.set(name)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.labels(name).inc()
+                raise
+            finally:
+                HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+                current_handler.reset(token)
+        return wrapper
+    return decorator
+
+def record_handler_error() -> None:
+    """
+    Count an error a handler caught and handled itself
+    """
+    HANDLER_ERRORS.labels(current_handler.get()).inc()
+
+@contextmanager
+def observe_db(operation: str) -> Iterator[None]:
+    """
+    Time a database call
+
+    Args:
+        operation: Operation label, usually the db_service function name
+    """
+    handler = current_handler.get()
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        DB_ERRORS.labels(operation, handler).inc()
+        raise
+    finally:
+        DB_CALL_SECONDS.labels(operation, handler).observe(time.perf_counter() - started)
+
+@contextmanager
+def observe_llm(model: str, mode: str) -> Iterator[None]:
+    """
+    Time an OpenAI request
+
+    Args:
+        model: Model name
+        mode: 'complete', 'stream' or 'embed'
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        record_llm_call(model, mode, time.perf_counter() - started, False)
+        raise
+    record_llm_call(model, mode, time.perf_counter() - started, True)
+
+def record_llm_call(model: str, mode: str, seconds: float, ok: bool) -> None:
+    """
+    Record the duration and outcome of an OpenAI request timed by the caller
+
+    Args:
+        model: Model name
+        mode: 'complete', 'stream' or 'embed'
+        seconds: Time spent waiting for the provider
+        ok: Whether the request succeeded
+    """
+    handler = current_handler.get()
+    if not ok:
+        LLM_ERRORS.labels(handler, model, mode).inc()
+    LLM_CALL_SECONDS.labels(handler, model, mode).observe(seconds)
+
+def record_tokens(model: str, usage: Optional[Any]) -> None:
+    """
+    Count prompt and completion tokens of an OpenAI response
+
+    Args:
+        model: Model name
+        usage: The response's usage object, if any
+    """
+    if usage is None:
+        return
+    handler = current_handler.get()
+    LLM_TOKENS.labels(handler, model, "prompt").inc(usage.prompt_tokens or 0)
+    # Embedding responses have no completion tokens
+    LLM_TOKENS.labels(handler, model, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+
+def register_queue(name: str, depth: Callable[[], float]) -> None:
+    """
+    Expose the depth of an internal queue, read on every scrape
+
+    Args:
+        name: Queue label
+        depth: Function returning the current number of queued items
+    """
+    QUEUE_DEPTH.labels(name).set_function(depth)
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> bool:
+    """
+    Serve /metrics over HTTP from a background thread
+
+    Args:
+        port: Port to listen on
+        host: Address to bind
+
+    Returns:
+        bool: True if the server was started
+    """
+    if start_http_server is None:
+        logging.warning("[metrics] prometheus_client is not installed, metrics endpoint disabled")
+        return False
+    start_http_server(port, addr=host)
+    logging.info(f"[metrics] Serving metrics on http://{host}:{port}/metrics")
+    return True
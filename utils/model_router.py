@@ -0,0 +1,161 @@
+"""
+Per-task model routing with fallback on latency or error-rate breaches
+"""
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+from utils.config import MODEL, ROUTING_TASKS, ROUTING_WINDOW, ROUTING_MIN_SAMPLES, ROUTING_COOLDOWN
+from utils.metrics import LLM_ROUTED
+
+class ModelStats:
+    """
+    Latency and outcome of a model's most recent calls
+    """
+
+    def __init__(self, window: int):
+        """
+        Args:
+            window: Number of recent calls kept
+        """
+        self._calls: Deque[Tuple[float, bool]] = deque(maxlen=window)
+
+    def record(self, seconds: float, ok: bool) -> None:
+        self._calls.append((seconds, ok))
+
+    def clear(self) -> None:
+        self._calls.clear()
+
+    @property
+    def samples(self) -> int:
+        return len(self._calls)
+
+    @property
+    def p95(self) -> float:
+        """
+        95th percentile latency of the successful calls, 0 if there are none
+        """
+        latencies = sorted(seconds for seconds, ok in self._calls if ok)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    @property
+    def error_rate(self) -> float:
+        if not self._calls:
+            return 0.0
+        return sum(1 for _, ok in self._calls if not ok) / len(self._calls)
+
+class ModelRouter:
+    """
+    Chooses the model for each kind of LLM task.
+
+    Every task has a primary model and optionally a fallback with latency and
+    error-rate objectives. Once the primary has at least min_samples recent
+    calls and its p95 latency or error rate breaches the task's threshold, the
+    task is served by the fallback for cooldown seconds; after that the
+    primary's statistics are reset and it gets traffic again.
+    """
+
+    def __init__(self, tasks: Dict[str, Dict[str, Any]], default_model: str, window: int,
+                 min_samples: int, cooldown: float):
+        """
+        Args:
+            tasks: Task name -> {'primary', 'fallback', 'p95_seconds', 'max_error_rate'}
+            default_model: Model of tasks (or fields) not configured
+            window: Number of recent calls per model used for the statistics
+            min_samples: Calls needed before a model can be considered degraded
+            cooldown: Seconds a degraded primary is bypassed
+        """
+        self.tasks = tasks
+        self.default_model = default_model
+        self.window = window
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self._stats: Dict[str, ModelStats] = {}
+        # task -> monotonic time until which the fallback is used
+        self._degraded_until: Dict[str, float] = {}
+
+    def stats(self, model: str) -> ModelStats:
+        """
+        Get the statistics of a model
+        """
+        if model not in self._stats:
+            self._stats[model] = ModelStats(self.window)
+        return self._stats[model]
+
+    def primary(self, task: str) -> str:
+        """
+        Get the configured primary model of a task
+        """
+        return self.tasks.get(task, {}).get('primary') or self.default_model
+
+    def current(self, task: str) -> str:
+        """
+        Get the model serving a task right now, without recording a call
+        (e.g. to look up cached answers of that model)
+        """
+        fallback = self.tasks.get(task, {}).get('fallback')
+        until = self._degraded_until.get(task)
+        if fallback and until is not None and time.monotonic() < until:
+            return fallback
+        return self.primary(task)
+
+    def _breached(self, task: str, model: str) -> Optional[str]:
+        config = self.tasks.get(task, {})
+        stats = self.stats(model)
+        if stats.samples < self.min_samples:
+            return None
+        p95_limit = config.get('p95_seconds')
+        if p95_limit and stats.p95 > p95_limit:
+            return f"p95 {stats.p95:.1f}s > {p95_limit}s"
+        error_limit = config.get('max_error_rate')
+        if error_limit is not None and stats.error_rate > error_limit:
+            return f"error rate {stats.error_rate:.0%} > {error_limit:.0%}"
+        return None
+
+    def choose(self, task: str) -> Tuple[str, str]:
+        """
+        Choose the model for a call
+
+        Args:
+            task: 'ask', 'summary', 'haiku' or 'response'
+
+        Returns:
+            Tuple of the model and the tier serving it ('primary' or 'fallback')
+        """
+        primary = self.primary(task)
+        fallback = self.tasks.get(task, {}).get('fallback')
+        model, tier = primary, "primary"
+        if fallback and fallback != primary:
+            now = time.monotonic()
+            until = self._degraded_until.get(task)
+            if until is not None and now >= until:
+                # Cooldown is over: give the primary a fresh window
+                del self._degraded_until[task]
+                self.stats(primary).clear()
+                logging.info(f"[model_router] {task}: trying primary model {primary} again")
+            elif until is None:
+                reason = self._breached(task, primary)
+                if reason:
+                    self._degraded_until[task] = now + self.cooldown
+                    logging.warning(f"[model_router] {task}: {primary} {reason}, using {fallback} "
+                                    f"for {self.cooldown:.0f}s")
+            if task in self._degraded_until:
+                model, tier = fallback, "fallback"
+        LLM_ROUTED.labels(task, model, tier).inc()
+        return model, tier
+
+    def record(self, model: str, seconds: float, ok: bool) -> None:
+        """
+        Record the outcome of a call to a model
+
+        Args:
+            model: Model name
+            seconds: Duration of the call
+            ok: Whether the call succeeded
+        """
+        self.stats(model).record(seconds, ok)
+
+# Shared router used by utils.openai_client
+model_router = ModelRouter(ROUTING_TASKS, MODEL, ROUTING_WINDOW, ROUTING_MIN_SAMPLES, ROUTING_COOLDOWN)
@@ -1,24 +1,228 @@
 """
 OpenAI client and related functions
 """
-from openai import OpenAI
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
-from .config import MODEL
-# Initialize OpenAI client
-client = OpenAI()
+from .config import (
+    OPENAI_TIMEOUT, OPENAI_MAX_CONNECTIONS, OPENAI_EXPECTED_COMPLETION_TOKENS,
+    EMBEDDING_MODEL, EMBEDDING_DIMENSIONS
+)
+from .metrics import observe_llm, record_llm_call, record_tokens, LLM_COALESCED
+from .rate_limiter import rate_limiter, estimate_tokens
+from .model_router import model_router
 
-def invoke_model(prompt: str) -> str:
+# Initialize OpenAI client.
+# One shared async client keeps a pool of keep-alive connections for all handlers,
+# so a slow completion in one chat never blocks the event loop for the others.
+# Retries are done by the rate limiter, which also honours Retry-After across requests.
+client = AsyncOpenAI(
+    timeout=OPENAI_TIMEOUT,
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+        )
+    ),
+)
+
+class _SharedCall:
+    # A completion in flight and the number of callers waiting for it
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+# (task, requested model, prompt) -> identical completion request in flight
+_in_flight: Dict[Tuple[str, Optional[str], str], _SharedCall] = {}
+
+def _usage_tokens(usage) -> Optional[int]:
+    return usage.total_tokens if usage is not None else None
+
+def _record(model: str, mode: str, seconds: float, ok: bool) -> None:
+    # Feed the duration and outcome of a request to the metrics and the model router
+    record_llm_call(model, mode, seconds, ok)
+    model_router.record(model, seconds, ok)
+
+async def _complete(prompt: str, model: str, timeout: float) -> str:
+    estimated = estimate_tokens(prompt, OPENAI_EXPECTED_COMPLETION_TOKENS)
+
+    async def attempt():
+        # Each attempt is timed on its own, without the rate limiter's waits
+        started = time.perf_counter()
+        try:
+            completion = await client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                timeout=timeout,
+            )
+        except Exception:
+            _record(model, "complete", time.perf_counter() - started, False)
+            raise
+        _record(model, "complete", time.perf_counter() - started, True)
+        return completion
+
+    completion = await rate_limiter.call(attempt, estimated, model)
+    rate_limiter.record_usage(estimated, _usage_tokens(completion.usage))
+    record_tokens(model, completion.usage)
+    return completion.choices[0].message.content.strip()
+
+async def invoke_model(prompt: str, timeout: Optional[float] = None, task: str = "ask",
+                       model: Optional[str] = None) -> str:
     """
     Invoke OpenAI model with the given prompt.
     
+    The model is chosen by the model router for the task. The request waits for room in the per-minute budget and transient failures
+    are retried. Callers sending the same prompt while a request is in flight
+    share its result instead of sending it again.
+    
+    The call can be cancelled by cancelling the awaiting task; once no caller
+    is waiting, the underlying HTTP request is aborted and its connection
+    returned to the pool.
+    
     Args:
         prompt: The prompt to send to the model.
+        timeout: Overall deadline for the call in seconds, including retries (defaults to config value).
+        task: Kind of call for model routing: 'ask', 'summary', 'haiku' or 'response'.
+        model: Model already chosen with model_router.choose(task), if the caller needs to know it.
         
     Returns:
         str: The model's response.
+        
+    Raises:
+        asyncio.TimeoutError: If the model did not answer within the deadline.
+    """
+    timeout = timeout if timeout is not None else OPENAI_TIMEOUT
+    key = (task, model, prompt)
+    shared = _in_flight.get(key)
+    if shared is None:
+        if model is None:
+            model, tier = model_router.choose(task)
+            logging.info(f"[openai_client] {task}: {model} ({tier})")
+        shared = _SharedCall(asyncio.ensure_future(_complete(prompt, model, timeout)))
+        _in_flight[key] = shared
+
+        def forget(task: asyncio.Task, shared: _SharedCall = shared) -> None:
+            if _in_flight.get(key) is shared:
+                del _in_flight[key]
+        shared.task.add_done_callback(forget)
+    else:
+        LLM_COALESCED.inc()
+
+    shared.waiters += 1
+    try:
+        return await asyncio.wait_for(asyncio.shield(shared.task), timeout=timeout)
+    finally:
+        shared.waiters -= 1
+        if not shared.waiters and not shared.task.done():
+            shared.task.cancel()
+
+async def stream_model(prompt: str, timeout: Optional[float] = None, task: str = "ask",
+                       model: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    Invoke OpenAI model with the given prompt and stream the response.
+    
+    The model is chosen by the model router for the task. The request waits
+    for room in the per-minute budget; failures before the stream starts are retried.
+    The latency recorded for metrics and routing is the time spent waiting for
+    the provider (the request and every chunk), not for the rate limiter or the consumer.
+    
+    Args:
+        prompt: The prompt to send to the model.
+        timeout: Network timeout in seconds for each read (defaults to config value).
+        task: Kind of call for model routing: 'ask', 'summary', 'haiku' or 'response'.
+        model: Model already chosen with model_router.choose(task), if the caller needs to know it.
+        
+    Yields:
+        str: Pieces of the model's response as they arrive.
+    """
+    estimated = estimate_tokens(prompt, OPENAI_EXPECTED_COMPLETION_TOKENS)
+    used = None
+    if model is None:
+        model, tier = model_router.choose(task)
+        logging.info(f"[openai_client] {task}: {model} ({tier}, stream)")
+    elapsed = 0.0
+
+    async def attempt():
+        nonlocal elapsed
+        started = time.perf_counter()
+        try:
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                stream=True,
+                # The last chunk then carries token usage
+                stream_options={"include_usage": True},
+                timeout=timeout if timeout is not None else OPENAI_TIMEOUT,
+            )
+        except Exception:
+            _record(model, "stream", time.perf_counter() - started, False)
+            raise
+        elapsed = time.perf_counter() - started
+        return stream
+
+    stream = await rate_limiter.call(attempt, estimated, model)
+    # True once the stream ended, False if it failed, None if the consumer stopped reading
+    ok = None
+    try:
+        chunks = stream.__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                elapsed += time.perf_counter() - started
+                break
+            except Exception:
+                elapsed += time.perf_counter() - started
+                ok = False
+                raise
+            elapsed += time.perf_counter() - started
+            if chunk.usage:
+                used = _usage_tokens(chunk.usage)
+                record_tokens(model, chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        ok = True
+    finally:
+        if ok is not None:
+            _record(model, "stream", elapsed, ok)
+        rate_limiter.record_usage(estimated, used)
+        await stream.close()
+
+async def embed_texts(texts: List[str]) -> List[List[float]]:
+    """
+    Get embeddings of several texts with a single request.
+    
+    Args:
+        texts: Texts to embed.
+        
+    Returns:
+        List[List[float]]: One embedding per text, in the same order.
+    """
+    if not texts:
+        return []
+    estimated = sum(estimate_tokens(text) for text in texts)
+
+    async def attempt():
+        with observe_llm(EMBEDDING_MODEL, "embed"):
+            return await client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=texts,
+                dimensions=EMBEDDING_DIMENSIONS,
+            )
+
+    response = await rate_limiter.call(attempt, estimated, EMBEDDING_MODEL)
+    rate_limiter.record_usage(estimated, _usage_tokens(response.usage))
+    record_tokens(EMBEDDING_MODEL, response.usage)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+async def close_client() -> None:
+    """
+    Close the shared OpenAI client and its connection pool.
     """
-    completion = client.chat.completions.create(
-        model=MODEL,
-        messages=[{"role": "user", "content": prompt}]
-    )
-    return completion.choices[0].message.content.strip() 
\ No newline at end of file
+    await client.close()
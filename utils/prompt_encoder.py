@@ -0,0 +1,272 @@
+"""
+Compact encoding of chat messages for LLM prompts
+
+Instead of four lines per message with a full ISO timestamp, messages are
+rendered one line per run of consecutive messages by the same author
+(the format is described to the model by HISTORY_FORMAT in utils/prompts.py):
+
+    Зараз: 2026-10-17 14:05
+    Учасники: A — Іван Петренко, B — Марія Коваль
+    -2г05хв A: привіт / хто йде на обід?
+    -2г B: я
+"""
+import datetime
+import logging
+import re
+import string
+from typing import Any, Dict, Iterable, List, Optional
+import db_service
+from utils.context_builder import count_tokens, format_history_message
+from utils.metrics import current_handler, PROMPT_TOKENS, PROMPT_TOKENS_SAVED
+
+# Emoji, pictographs, flags, variation selectors and zero-width joiners
+EMOJI_RE = re.compile(
+    "["
+    "\U0001F000-\U0001FAFF"
+    "\U00002600-\U000027BF"
+    "\U00002B00-\U00002BFF"
+    "\U0001F1E6-\U0001F1FF"
+    "\U0000FE00-\U0000FE0F"
+    "\U0000200D"
+    "\U000020E3"
+    "]+"
+)
+# Text smileys such as :) ;-( =D :3 (only these eyes, so "8)" and "x3" stay)
+EMOTICON_RE = re.compile(r"(?<!\w)[:;=][-^']?[()DPpРр3*]+(?!\w)")
+# Runs of brackets, used as smileys when unbalanced ("дякую))", "шкода((")
+BRACKETS_RE = re.compile(r"\(+|\)+")
+# A number or a single letter before ")" makes it a list marker ("1)", "б)")
+LIST_MARKER_RE = re.compile(r"(?:^|\s)(?:\d{1,3}|[^\W\d_])$")
+SPACES_RE = re.compile(r"\s+")
+
+# Messages of one author are merged into one line while they are within this time of the line's first message
+RUN_GAP = datetime.timedelta(minutes=10)
+
+def _strip_bracket_smileys(text: str) -> str:
+    # Brackets without a pair: closing ones left over after matching, and opening ones never closed
+    opened: List[int] = []
+    unmatched = set()
+    for i, char in enumerate(text):
+        if char == "(":
+            opened.append(i)
+        elif char == ")":
+            if opened:
+                opened.pop()
+            else:
+                unmatched.add(i)
+    unmatched.update(opened)
+
+    dropped = set()
+    for run in BRACKETS_RE.finditer(text):
+        positions = [i for i in range(run.start(), run.end()) if i in unmatched]
+        if not positions:
+            continue
+        if run.group().startswith(")"):
+            if len(run.group()) == 1 and LIST_MARKER_RE.search(text, 0, run.start()):
+                continue
+            dropped.update(positions)
+        elif len(positions) > 1 and (run.end() == len(text) or not text[run.end()].isalnum()):
+            # A single "(" may open a remark that is never closed, "((" at the end of a word is a smiley
+            dropped.update(positions)
+    return "".join(char for i, char in enumerate(text) if i not in dropped)
+
+def strip_emoji(text: str) -> str:
+    """
+    Remove emoji and text smileys, which the prompts tell the model to ignore anyway
+
+    Brackets are only removed when they have no pair and are used as smileys;
+    list markers and brackets around text are kept.
+
+    >>> strip_emoji("привіт :) як справи? 😀")
+    'привіт як справи?'
+    >>> strip_emoji("Пункти: 1) так 8) ні")
+    'Пункти: 1) так 8) ні'
+    >>> strip_emoji("x3 рази, хр знає")
+    'x3 рази, хр знає'
+    >>> strip_emoji("дякую)) (завтра")
+    'дякую (завтра'
+    >>> strip_emoji("шкода(( але (може) завтра")
+    'шкода але (може) завтра'
+    >>> strip_emoji("зустріч о 10:30 (у офісі)")
+    'зустріч о 10:30 (у офісі)'
+
+    Args:
+        text: Message text
+
+    Returns:
+        str: Text without emoji, on one line
+    """
+    text = EMOJI_RE.sub("", text)
+    text = EMOTICON_RE.sub("", text)
+    text = _strip_bracket_smileys(text)
+    return SPACES_RE.sub(" ", text).strip()
+
+def format_age(delta: datetime.timedelta) -> str:
+    """
+    Format the age of a message, e.g. '-45хв', '-2г05хв', '-3д04г'
+    """
+    minutes = max(0, int(delta.total_seconds() // 60))
+    days, minutes = divmod(minutes, 1440)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"-{days}д{hours:02d}г" if hours else f"-{days}д"
+    if hours:
+        return f"-{hours}г{minutes:02d}хв" if minutes else f"-{hours}г"
+    return f"-{minutes}хв"
+
+def _alias(index: int) -> str:
+    # A..Z, then A1..Z1, ...
+    letter = string.ascii_uppercase[index % 26]
+    return letter if index < 26 else f"{letter}{index // 26}"
+
+class PromptEncoder:
+    """
+    Encodes the messages of one prompt.
+
+    Author aliases stay the same for the whole prompt. Messages are added one
+    by one (so long histories can be streamed into chunks); consecutive
+    messages of one author within RUN_GAP of the line's first one are merged
+    into a single line, and a time is only written when it differs from the previous line's.
+    """
+
+    def __init__(self, now: Optional[datetime.datetime] = None):
+        """
+        Args:
+            now: Moment timestamps are relative to; None writes absolute times
+                (for text that is cached and reused later, e.g. bucket summaries)
+        """
+        self.now = now
+        self._aliases: Dict[str, str] = {}
+        self._last_author: Optional[str] = None
+        self._last_time: Optional[str] = None
+        self._last_date: Optional[str] = None
+        # Time of the first message of the current line
+        self._last_moment: Optional[datetime.datetime] = None
+        self.verbose_tokens = 0
+
+    @staticmethod
+    def _moment(created_at: Any) -> Optional[datetime.datetime]:
+        if not created_at:
+            return None
+        if isinstance(created_at, datetime.datetime):
+            return created_at.replace(tzinfo=None)
+        return db_service.parse_timestamp(str(created_at))
+
+    def _time(self, moment: Optional[datetime.datetime]) -> str:
+        if moment is None:
+            return ""
+        if self.now is not None:
+            return format_age(self.now - moment)
+        date = f"{moment:%d.%m}"
+        if date != self._last_date:
+            self._last_date = date
+            return f"{date} {moment:%H:%M}"
+        return f"{moment:%H:%M}"
+
+    def alias(self, name: str) -> str:
+        """
+        Get the short alias of an author, assigning the next free one
+        """
+        if name not in self._aliases:
+            self._aliases[name] = _alias(len(self._aliases))
+        return self._aliases[name]
+
+    def break_run(self) -> None:
+        """
+        Start the next message on a new line with its time (e.g. at a chunk boundary)
+        """
+        self._last_author = None
+        self._last_time = None
+        self._last_date = None
+        self._last_moment = None
+
+    def add(self, msg: Dict[str, Any]) -> str:
+        """
+        Encode the next message and count its cost in the four-line format
+
+        Args:
+            msg: Message with 'from_user', 'created_at' and 'text'
+
+        Returns:
+            str: Text to append: a new line, a continuation of the author's line,
+                or '' if nothing is left after stripping emoji
+        """
+        self.verbose_tokens += count_tokens(format_history_message(msg))
+        return self.encode_message(msg)
+
+    def encode_message(self, msg: Dict[str, Any]) -> str:
+        """
+        Encode the next message, like add() but without counting it
+        (e.g. to encode it again after break_run())
+        """
+        text = strip_emoji(msg.get('text') or '')
+        if not text:
+            return ""
+        author = self.alias(msg.get('from_user') or '?')
+        moment = self._moment(msg.get('created_at'))
+        if author == self._last_author and (
+            moment is None or self._last_moment is None or moment - self._last_moment <= RUN_GAP
+        ):
+            return f" / {text}"
+        time = self._time(moment)
+        prefix = f"{time} " if time and time != self._last_time else ""
+        self._last_author, self._last_time, self._last_moment = author, time, moment
+        return f"\n{prefix}{author}: {text}"
+
+    def encode(self, messages: Iterable[Dict[str, Any]]) -> str:
+        """
+        Encode messages into lines (without the header)
+
+        Args:
+            messages: Messages in chronological order
+
+        Returns:
+            str: Encoded messages
+        """
+        return "".join(self.add(msg) for msg in messages).lstrip("\n") + "\n"
+
+    def header(self) -> str:
+        """
+        Lines explaining the encoded messages: the current time and the author aliases
+        """
+        lines = []
+        if self.now is not None:
+            lines.append(f"Зараз: {self.now:%Y-%m-%d %H:%M}")
+        if self._aliases:
+            lines.append("Учасники: " + ", ".join(f"{alias} — {name}" for name, alias in self._aliases.items()))
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def report(self, text: str) -> int:
+        """
+        Log and count the tokens saved by the encoding of a prompt's history
+
+        Args:
+            text: The encoded history as it goes into the prompt
+
+        Returns:
+            int: Tokens saved compared to the four-line format
+        """
+        tokens = count_tokens(text)
+        saved = max(0, self.verbose_tokens - tokens)
+        handler = current_handler.get()
+        PROMPT_TOKENS.labels(handler).inc(tokens)
+        PROMPT_TOKENS_SAVED.labels(handler).inc(saved)
+        logging.info(f"[prompt_encoder] {handler}: history is {tokens} tokens, saved {saved} of {self.verbose_tokens}")
+        return saved
+
+def encode_messages(messages: Iterable[Dict[str, Any]], now: Optional[datetime.datetime] = None) -> str:
+    """
+    Encode a short list of messages for a prompt, header included, and report the tokens saved
+
+    Args:
+        messages: Messages in chronological order
+        now: Moment timestamps are relative to (defaults to the current time)
+
+    Returns:
+        str: Encoded history
+    """
+    encoder = PromptEncoder(now or db_service.get_current_time())
+    body = encoder.encode(messages)
+    text = encoder.header() + body
+    encoder.report(text)
+    return text
@@ -2,35 +2,35 @@
 Prompts used by the haikubot
 """
 
-PROMPT_HAIKU = """
-Згенеруй хокку мовою цих повідомлень, беручі до уваги умови.
+# Опис компактного формату історії (utils/prompt_encoder.py).
+# Сталі інструкції йдуть на початку промптів, а змінні дані в кінці, щоб спільний префікс кешувався провайдером.
+HISTORY_FORMAT = """
+Формат історії: кожен рядок — послідовні повідомлення одного автора, розділені « / ».
+На початку рядка час відносно моменту «Зараз» (хв — хвилини, г — години, д — дні) або абсолютний час;
+якщо час не вказано, він той самий, що й у попередньому рядку. Далі позначка автора (A, B, ...),
+повні імена авторів наведено в рядку «Учасники».
+"""
 
-Повідомлення:
-{messages}
+PROMPT_HAIKU = """
+Згенеруй хокку мовою повідомлень нижче, беручі до уваги умови.
 
 Умови:
 1. Пиши хокку у форматі 5-7-5. 
 2. Мова хокку - українська.
 3. Ігноруй смайли та емоджі в тексті, не інтерпретуй їх, як емоції. Наприклад ")" не означає сміх, а "(" - не означає сум. Просто ІГНОРУЙ ці символи.
 4. Використовуй інформацію про автора та час повідомлення тільки для розуміння контексту розмови. Для самого хокку використовуй тільки тексти повідомлень.
+""" + HISTORY_FORMAT + """
+Повідомлення:
+{messages}
 """
 
-PROMPT_RESPONSE_BASE = """
+PROMPT_RESPONSE_RULES = """
 Ти автор хокку, який ти написав з історії повідомлень.
 Проаналізуй коментар користувача, визнач його емоцію і дай відповідь у відповідній емоції.
 Для аргументації посилайся на історію повідомлень з якої писалось хокку.
 
 Варіанти емоції: ввічлива, нейтральна, агрессивна
 
-Хокку:
-{haiku}
-
-Коментар користувача:
-{user_comment}
-
-Історія повідомлень:
-{messages}
-
 Спільні умови:
 1. Використовуй українську мову.
 2. Звертай увагу на контекст розмови.
@@ -38,28 +38,69 @@ PROMPT_RESPONSE_BASE = """
 4. Відповідь має бути довжиною максимум в 2 речення.
 5. Пиши від імені автора хокку.
 6. Відповідь - звичайні розмовні речення, не хокку
+7. Називай людей їхніми іменами, а не позначками з історії.
+""" + HISTORY_FORMAT
+
+PROMPT_RESPONSE_DATA = """
+Історія повідомлень:
+{messages}
+
+Хокку:
+{haiku}
+
+Коментар користувача:
+{user_comment}
 """
 
-PROMPT_POLITE_RESPONSE = f"""
-{PROMPT_RESPONSE_BASE}
+PROMPT_RESPONSE_BASE = PROMPT_RESPONSE_RULES + PROMPT_RESPONSE_DATA
 
+PROMPT_POLITE_RESPONSE = f"""
+{PROMPT_RESPONSE_RULES}
 Стиль відповіді:
 1. Відповідь має бути ввічливою та визнавати можливі помилки.
-"""
+{PROMPT_RESPONSE_DATA}"""
 
 PROMPT_NEUTRAL_RESPONSE = f"""
-{PROMPT_RESPONSE_BASE}
-
+{PROMPT_RESPONSE_RULES}
 Стиль відповіді:
 1. Відповідь має бути нейтральною та пояснювати причини вибору слів.
 2. Цитуй конкретні слова з повідомлень користувача.
-"""
+{PROMPT_RESPONSE_DATA}"""
 
 PROMPT_RUDE_RESPONSE = f"""
-{PROMPT_RESPONSE_BASE}
-
+{PROMPT_RESPONSE_RULES}
 Стиль відповіді:
 1. Відповідь має бути грубою та різкою.
 2. Аналізуй історію повідомлень для аргументації.
 3. Використовуй сарказм
-""" 
\ No newline at end of file
+{PROMPT_RESPONSE_DATA}"""
+
+PROMPT_SUMMARIZE_HISTORY = """
+Стисло підсумуй цю частину історії чату.
+Збережи факти, імена авторів, час та деталі, які можуть знадобитися для відповіді на запит користувача.
+
+Умови:
+1. Використовуй українську мову.
+2. Не відповідай на запит, лише підсумуй історію.
+3. Підсумок має бути значно коротшим за історію.
+4. Називай авторів повними іменами, а не позначками з історії.
+""" + HISTORY_FORMAT + """
+Запит користувача:
+{user_query}
+
+Частина історії повідомлень:
+{history}
+"""
+
+PROMPT_SUMMARIZE_PERIOD = """
+Стисло підсумуй цю частину історії чату, щоб підсумок можна було використати для відповідей на різні запитання про неї.
+Збережи основні теми, факти, рішення, питання та хто що казав.
+
+Умови:
+1. Використовуй українську мову.
+2. Підсумок має бути значно коротшим за історію.
+3. Називай авторів повними іменами, а не позначками з історії.
+""" + HISTORY_FORMAT + """
+Частина історії повідомлень:
+{history}
+"""
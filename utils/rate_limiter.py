@@ -0,0 +1,248 @@
+"""
+Client-side rate limiting and retries for OpenAI requests
+"""
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+import openai
+from utils.config import (
+    OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE, OPENAI_MAX_RETRIES,
+    OPENAI_BACKOFF_BASE, OPENAI_BACKOFF_MAX
+)
+from utils.metrics import LLM_THROTTLED, LLM_RETRIES, LLM_RATE_HEADROOM
+
+T = TypeVar("T")
+
+# Rough number of characters per token, used to budget a request before it is sent
+# (and by context_builder.count_tokens when tiktoken is unavailable)
+CHARS_PER_TOKEN = 3
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `per_minute` units per minute.
+
+    Callers reserve units up front; the level may go negative, and the
+    reservation then tells the caller how long to wait. This keeps callers
+    in FIFO order without a lock.
+    """
+
+    def __init__(self, per_minute: float):
+        """
+        Args:
+            per_minute: Capacity and refill rate per minute (0 disables the bucket)
+        """
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self._level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def level(self) -> float:
+        """
+        Units currently available (negative while callers are waiting)
+        """
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        return self._level
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take units from the bucket
+
+        Args:
+            amount: Units to take (capped at the bucket capacity)
+
+        Returns:
+            float: Seconds to wait before the units are actually available
+        """
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        self._level -= min(amount, self.capacity)
+        return -self._level / self.rate if self._level < 0 else 0.0
+
+    def adjust(self, amount: float) -> None:
+        """
+        Return (positive) or take (negative) units after the fact, e.g. once the
+        real token usage of a request is known
+        """
+        if not self.capacity:
+            return
+        self._refill()
+        self._level = min(self.capacity, self._level + amount)
+
+class RateLimiter:
+    """
+    Budgets OpenAI requests and tokens per minute and retries failed requests
+    with jittered exponential backoff, honouring the server's Retry-After.
+
+    A 429 pauses all callers until the Retry-After deadline, so the rest of
+    the bot backs off together instead of each request hitting the limit.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_retries: int,
+                 backoff_base: float, backoff_max: float):
+        """
+        Args:
+            requests_per_minute: Request budget (0 means unlimited)
+            tokens_per_minute: Token budget, prompt plus completion (0 means unlimited)
+            max_retries: How many times a failed request is retried
+            backoff_base: First backoff delay in seconds
+            backoff_max: Upper bound of a backoff delay in seconds
+        """
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._paused_until = 0.0
+
+    async def acquire(self, tokens: int) -> None:
+        """
+        Wait until a request of the given size fits into the budget
+
+        Args:
+            tokens: Estimated tokens of the request
+        """
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            LLM_THROTTLED.labels("retry_after").inc()
+            await asyncio.sleep(pause)
+        wait_requests = self.requests.reserve(1)
+        wait_tokens = self.tokens.reserve(tokens)
+        if wait_requests or wait_tokens:
+            LLM_THROTTLED.labels("requests" if wait_requests >= wait_tokens else "tokens").inc()
+            await asyncio.sleep(max(wait_requests, wait_tokens))
+
+    def record_usage(self, estimated: int, used: Optional[int]) -> None:
+        """
+        Correct the token budget with the real usage of a finished request
+
+        Args:
+            estimated: Tokens reserved by acquire
+            used: Tokens reported by the API, if known
+        """
+        if used is not None:
+            self.tokens.adjust(estimated - used)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hold back all new requests for the given number of seconds
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Delay before retry number `attempt` (0-based): full jitter over an
+        exponentially growing window, but never shorter than Retry-After
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def call(self, func: Callable[[], Awaitable[T]], tokens: int, model: str) -> T:
+        """
+        Run an OpenAI request within the budget, retrying transient failures
+
+        Args:
+            func: Coroutine function sending the request
+            tokens: Estimated tokens of the request
+            model: Model name, for metrics
+
+        Returns:
+            The request's result
+
+        Raises:
+            openai.APIError: If the request failed permanently or ran out of retries
+        """
+        attempt = 0
+        while True:
+            await self.acquire(tokens)
+            try:
+                return await func()
+            except Exception as e:
+                # A failed attempt has no usage to reconcile, so give its reservation back;
+                # the next attempt reserves again
+                self.tokens.adjust(tokens)
+                reason = retry_reason(e)
+                if reason is None or attempt >= self.max_retries:
+                    raise
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    self.pause(retry_after)
+                delay = self.backoff(attempt, retry_after)
+                LLM_RETRIES.labels(model, reason).inc()
+                logging.warning(
+                    f"[rate_limiter] OpenAI request failed ({reason}), retry {attempt + 1}/{self.max_retries} "
+                    f"in {delay:.1f}s"
+                )
+                attempt += 1
+                await asyncio.sleep(delay)
+
+def estimate_tokens(prompt: str, completion_tokens: int = 0) -> int:
+    """
+    Cheap estimate of a request's token cost, used before it is sent
+
+    Args:
+        prompt: Prompt text
+        completion_tokens: Expected completion length
+
+    Returns:
+        int: Estimated tokens
+    """
+    return len(prompt) // CHARS_PER_TOKEN + 1 + completion_tokens
+
+def retry_reason(error: Exception) -> Optional[str]:
+    """
+    Classify an error of the OpenAI client
+
+    Returns:
+        Optional[str]: Metrics label if the request is worth retrying, None otherwise
+    """
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    if isinstance(error, openai.APIStatusError) and (error.status_code >= 500 or error.status_code == 409):
+        return f"status_{error.status_code}"
+    return None
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    Read the server's requested delay (retry-after-ms or retry-after) from an error response
+
+    Returns:
+        Optional[float]: Delay in seconds, None if the server didn't say
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # HTTP-date form, not used by OpenAI
+        return None
+    return None
+
+# Shared limiter for all OpenAI requests of the process
+rate_limiter = RateLimiter(
+    OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE, OPENAI_MAX_RETRIES,
+    OPENAI_BACKOFF_BASE, OPENAI_BACKOFF_MAX
+)
+LLM_RATE_HEADROOM.labels("requests").set_function(lambda: rate_limiter.requests.level)
+LLM_RATE_HEADROOM.labels("tokens").set_function(lambda: rate_limiter.tokens.level)
@@ -0,0 +1,158 @@
+"""
+Cache of /ask answers invalidated by new chat messages
+"""
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+from utils.config import RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_TTL, CHAT_HISTORY_MAX_CHATS
+from utils.metrics import CACHE_EVENTS, CACHE_SIZE
+
+def normalize_query(query: str) -> str:
+    """
+    Normalise a user query so trivially different spellings share a cache entry
+
+    Args:
+        query: User query
+
+    Returns:
+        str: Lower-cased query with collapsed whitespace and no trailing punctuation
+    """
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.rstrip("?!.… ")
+
+class ResponseCache:
+    """
+    Bounded LRU cache of LLM answers keyed on (chat_id, window minutes, normalised query, model).
+
+    Each chat has a watermark, the id of the last message seen in it. An answer is only
+    served while the chat's watermark is the same as when the answer's history was read,
+    i.e. no new messages have arrived since. Entries also expire after ttl seconds.
+    """
+
+    def __init__(self, max_size: int, ttl: float, max_chats: int):
+        """
+        Args:
+            max_size: Maximum number of cached answers
+            ttl: Seconds an answer stays valid
+            max_chats: Maximum number of chat watermarks kept
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_chats = max_chats
+        # key -> (watermark, stored at, response)
+        self._entries: "OrderedDict[Tuple, Tuple[Optional[int], float, str]]" = OrderedDict()
+        self._watermarks: "OrderedDict[int, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def note_message(self, chat_id: int, message_id: int) -> None:
+        """
+        Advance a chat's watermark when a new message arrives
+
+        Args:
+            chat_id: Telegram chat ID
+            message_id: Telegram message ID
+        """
+        if message_id > self._watermarks.get(chat_id, -1):
+            self._watermarks[chat_id] = message_id
+        self._watermarks.move_to_end(chat_id)
+        while len(self._watermarks) > self.max_chats:
+            self._watermarks.popitem(last=False)
+
+    @property
+    def size(self) -> int:
+        """
+        Number of cached answers
+        """
+        return len(self._entries)
+
+    def watermark(self, chat_id: int) -> Optional[int]:
+        """
+        Get a chat's current watermark, to be passed to put() for an answer built from now on
+
+        Args:
+            chat_id: Telegram chat ID
+
+        Returns:
+            ID of the last message seen in the chat, or None
+        """
+        return self._watermarks.get(chat_id)
+
+    def _key(self, chat_id: int, minutes: int, query: str, model: str) -> Tuple:
+        return (chat_id, minutes, normalize_query(query), model)
+
+    def get(self, chat_id: int, minutes: int, query: str, model: str) -> Optional[str]:
+        """
+        Get a cached answer if it is still valid
+
+        Args:
+            chat_id: Telegram chat ID
+            minutes: Length of the requested period in minutes
+            query: User query
+            model: Model that produced the answer
+
+        Returns:
+            The cached answer, or None
+        """
+        key = self._key(chat_id, minutes, query, model)
+        entry = self._entries.get(key)
+        if entry is not None:
+            watermark, stored_at, response = entry
+            if watermark != self._watermarks.get(chat_id):
+                del self._entries[key]
+                self.invalidations += 1
+                CACHE_EVENTS.labels("responses", "invalidation").inc()
+            elif time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                CACHE_EVENTS.labels("responses", "hit").inc()
+                return response
+        self.misses += 1
+        CACHE_EVENTS.labels("responses", "miss").inc()
+        return None
+
+    def put(self, chat_id: int, minutes: int, query: str, model: str, response: str,
+            watermark: Optional[int]) -> None:
+        """
+        Store an answer
+
+        Args:
+            chat_id: Telegram chat ID
+            minutes: Length of the requested period in minutes
+            query: User query
+            model: Model that produced the answer
+            response: The answer (empty answers are not stored)
+            watermark: The chat's watermark from before the answer's history was read
+        """
+        if not response:
+            return
+        key = self._key(chat_id, minutes, query, model)
+        self._entries[key] = (watermark, time.monotonic(), response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            CACHE_EVENTS.labels("responses", "eviction").inc()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache counters
+
+        Returns:
+            Dictionary with size, hits, misses, invalidations and hit_rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+# Shared cache used by the query handler
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_TTL, CHAT_HISTORY_MAX_CHATS)
+CACHE_SIZE.labels("responses").set_function(lambda: response_cache.size)
@@ -0,0 +1,91 @@
+"""
+Bounded sets of recently processed Telegram update IDs and message IDs
+"""
+from collections import OrderedDict
+import db_service
+from utils.config import UPDATES_SEEN_MAX_SIZE, UPDATES_SEEN_MESSAGES_PER_CHAT, CHAT_HISTORY_MAX_CHATS
+
+class SeenUpdates:
+    """
+    Remembers the last max_size update IDs, so updates Telegram delivers again
+    (after a polling hiccup or a webhook retry) can be dropped before any handler runs
+    """
+
+    def __init__(self, max_size: int):
+        """
+        Args:
+            max_size: Number of most recent update IDs remembered
+        """
+        self.max_size = max_size
+        self._ids: "OrderedDict[int, None]" = OrderedDict()
+        self.duplicates = 0
+
+    def add(self, update_id: int) -> bool:
+        """
+        Mark an update as seen
+
+        Args:
+            update_id: Telegram update ID
+
+        Returns:
+            bool: True if the update is new, False if it was seen before
+        """
+        if update_id in self._ids:
+            self.duplicates += 1
+            return False
+        self._ids[update_id] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return True
+
+class SeenMessages:
+    """
+    Remembers the Telegram message IDs (tg_id) of the last max_per_chat messages of
+    each chat, from all authors. A chat's IDs are loaded from the database when it is
+    first seen, so a message Telegram delivers again after a restart, when the seen
+    update IDs are gone, is still recognised. Memory is bounded by max_chats chats
+    (least recently active are dropped).
+    """
+
+    def __init__(self, max_per_chat: int, max_chats: int):
+        """
+        Args:
+            max_per_chat: Number of most recent message IDs remembered per chat
+            max_chats: Maximum number of chats remembered
+        """
+        self.max_per_chat = max_per_chat
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[int, OrderedDict[int, None]]" = OrderedDict()
+        self.duplicates = 0
+
+    async def add(self, chat_id: int, tg_id: int) -> bool:
+        """
+        Mark a message as seen
+
+        Args:
+            chat_id: Telegram chat ID
+            tg_id: Telegram message ID
+
+        Returns:
+            bool: True if the message is new, False if it was seen (or stored) before
+        """
+        if chat_id not in self._chats:
+            stored = await db_service.get_recent_tg_ids(chat_id, self.max_per_chat)
+            # Another update of the chat may have loaded it in the meantime
+            if chat_id not in self._chats:
+                self._chats[chat_id] = OrderedDict.fromkeys(reversed(stored))
+                while len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+        ids = self._chats[chat_id]
+        self._chats.move_to_end(chat_id)
+        if tg_id in ids:
+            self.duplicates += 1
+            return False
+        ids[tg_id] = None
+        if len(ids) > self.max_per_chat:
+            ids.popitem(last=False)
+        return True
+
+# Shared sets used by haikubot's duplicate filter and the message handler
+seen_updates = SeenUpdates(UPDATES_SEEN_MAX_SIZE)
+seen_messages = SeenMessages(UPDATES_SEEN_MESSAGES_PER_CHAT, CHAT_HISTORY_MAX_CHATS)
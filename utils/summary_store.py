@@ -0,0 +1,224 @@
+"""
+Per-chat store of rolling time-bucket summaries for long /ask windows
+"""
+import asyncio
+import datetime
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+import db_service
+from utils.config import (
+    HISTORY_MAX_ROWS, ASK_CHUNK_TOKEN_BUDGET, ASK_SUMMARY_BUCKET_MINUTES, ASK_SUMMARY_MAX_BUCKETS,
+    ASK_SUMMARY_MAX_COLD_BUCKETS
+)
+from utils.context_builder import pack_blocks, reduce_chunks, summarize_chunks
+from utils.llm_jobs import llm_jobs
+from utils.prompt_encoder import PromptEncoder
+from utils.prompts import PROMPT_SUMMARIZE_PERIOD
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+class SummaryStore:
+    """
+    Caches summaries of fixed, already closed time buckets (e.g. one per hour) per chat.
+
+    Closed buckets don't change, so a summary is computed once, lazily, the first time
+    a long /ask window covers it, and is then reused by every later request.
+    A request summarises at most max_cold_buckets missing buckets (the most recent
+    ones), so the first /ask over a long window doesn't send a summary call per
+    bucket; older buckets are summarised by a low-priority background job, in
+    slices of max_cold_buckets, newest first.
+    Memory is bounded by max_buckets summaries (least recently used are dropped).
+    """
+
+    def __init__(self, bucket_minutes: int, max_buckets: int, max_cold_buckets: int):
+        """
+        Args:
+            bucket_minutes: Length of one bucket in minutes
+            max_buckets: Maximum number of cached bucket summaries across all chats
+            max_cold_buckets: Maximum number of buckets summarised for one request
+        """
+        self.bucket = datetime.timedelta(minutes=bucket_minutes)
+        self.max_buckets = max_buckets
+        self.max_cold_buckets = max_cold_buckets
+        # (chat_id, bucket start) -> summary ('' for a bucket without messages)
+        self._summaries: "OrderedDict[Tuple[int, datetime.datetime], str]" = OrderedDict()
+        self._pending: Dict[Tuple[int, datetime.datetime], asyncio.Task] = {}
+        # chat_id -> buckets left for the background job
+        self._backfill: Dict[int, Set[datetime.datetime]] = {}
+
+    def bucket_start(self, moment: datetime.datetime) -> datetime.datetime:
+        """
+        Get the start of the bucket containing a moment
+
+        Args:
+            moment: Naive datetime
+
+        Returns:
+            Start of the bucket
+        """
+        return moment - (moment - EPOCH) % self.bucket
+
+    async def get_summaries(self, chat_id: int, start: datetime.datetime,
+                            end: datetime.datetime) -> Tuple[List[Tuple[datetime.datetime, str]], Optional[datetime.datetime]]:
+        """
+        Get summaries of all buckets from the one containing start up to end
+
+        Args:
+            chat_id: Telegram chat ID
+            start: Start of the window (rounded down to a bucket boundary)
+            end: Bucket boundary where the window's raw tail begins; buckets must be closed
+
+        Returns:
+            Tuple of:
+            - list of (bucket start, summary) for buckets that have messages, oldest first
+            - the moment before which buckets are not summarised yet (over max_cold_buckets),
+              or None if the whole window is covered
+        """
+        buckets = []
+        bucket = self.bucket_start(start)
+        while bucket + self.bucket <= end:
+            buckets.append(bucket)
+            bucket += self.bucket
+
+        missing = [b for b in buckets if (chat_id, b) not in self._summaries and (chat_id, b) not in self._pending]
+        uncovered = None
+        if len(missing) > self.max_cold_buckets:
+            skipped, missing = missing[:len(missing) - self.max_cold_buckets], missing[len(missing) - self.max_cold_buckets:]
+            uncovered = skipped[-1] + self.bucket
+            logging.info(f"[summary_store] Leaving {len(skipped)} older buckets of chat_id={chat_id} "
+                         f"to the background job")
+            self._backfill.setdefault(chat_id, set()).update(skipped)
+            self._submit_backfill(chat_id)
+        if missing:
+            self._start(chat_id, missing)
+
+        tasks = {self._pending[(chat_id, b)] for b in buckets if (chat_id, b) in self._pending}
+        if tasks:
+            await asyncio.gather(*tasks)
+
+        summaries = []
+        for b in buckets:
+            if uncovered is not None and b < uncovered:
+                continue
+            summary = self._summaries.get((chat_id, b))
+            if summary is None:
+                continue
+            self._summaries.move_to_end((chat_id, b))
+            if summary:
+                summaries.append((b, summary))
+        return summaries, uncovered
+
+    def _start(self, chat_id: int, buckets: List[datetime.datetime]) -> asyncio.Task:
+        task = asyncio.create_task(self._compute(chat_id, buckets))
+        for bucket in buckets:
+            self._pending[(chat_id, bucket)] = task
+        return task
+
+    def _submit_backfill(self, chat_id: int) -> None:
+        # One job per chat at a time; a rejected or shed job is submitted again by the next long request
+        llm_jobs.submit("summary", chat_id, lambda: self._backfill_slice(chat_id))
+
+    async def _backfill_slice(self, chat_id: int) -> None:
+        buckets = sorted(
+            b for b in self._backfill.pop(chat_id, ())
+            if (chat_id, b) not in self._summaries and (chat_id, b) not in self._pending
+        )
+        size = max(self.max_cold_buckets, 1)
+        rest, buckets = buckets[:-size], buckets[-size:]
+        if rest:
+            self._backfill[chat_id] = set(rest)
+        try:
+            if buckets:
+                await self._start(chat_id, buckets)
+        finally:
+            if rest:
+                # Next slice as a new job once this one has left the queue, so it doesn't hold a slot
+                asyncio.get_running_loop().call_soon(self._submit_backfill, chat_id)
+
+    async def _compute(self, chat_id: int, buckets: List[datetime.datetime]) -> None:
+        missing = set(buckets)
+        tasks: Dict[datetime.datetime, asyncio.Task] = {}
+
+        def finish(bucket: Optional[datetime.datetime], messages: List[dict]) -> None:
+            # Summarise a bucket as soon as all its rows were read, then drop them
+            if bucket in missing and messages:
+                tasks[bucket] = asyncio.create_task(self._summarize(messages))
+
+        try:
+            # One paged walk over the whole missing range, summarising bucket by bucket
+            start, end = buckets[0], buckets[-1] + self.bucket
+            current, current_messages = None, []
+            while True:
+                rows = 0
+                async for msg in db_service.iter_chat_messages(chat_id, start=start, end=end):
+                    rows += 1
+                    bucket = self.bucket_start(db_service.parse_timestamp(msg['created_at']))
+                    if bucket != current:
+                        finish(current, current_messages)
+                        current, current_messages = bucket, []
+                    current_messages.append(msg)
+                if rows < HISTORY_MAX_ROWS or current is None:
+                    break
+                # The walk hit the row cap, so the current bucket may be incomplete
+                if current == start:
+                    # A single bucket is larger than the cap: summarise what was read and move on
+                    finish(current, current_messages)
+                    start = current + self.bucket
+                else:
+                    # Read the current bucket again from its start
+                    start = current
+                current, current_messages = None, []
+            finish(current, current_messages)
+
+            logging.info(f"[summary_store] Summarising {len(tasks)} of {len(buckets)} buckets for chat_id={chat_id}")
+            results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+            for bucket in buckets:
+                self._summaries[(chat_id, bucket)] = results.get(bucket, "")
+            while len(self._summaries) > self.max_buckets:
+                self._summaries.popitem(last=False)
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            for bucket in buckets:
+                self._pending.pop((chat_id, bucket), None)
+
+    async def _summarize(self, messages: List[dict]) -> str:
+        if not messages:
+            return ""
+        # Absolute times: the summary is reused long after it was made
+        encoder = PromptEncoder()
+        lines: List[str] = []
+        for msg in messages:
+            part = encoder.add(msg)
+            if part.startswith("\n") or (part and not lines):
+                lines.append(part.lstrip("\n"))
+            elif part:
+                lines[-1] += part
+        header = encoder.header()
+        chunks = [header + chunk for chunk, _ in pack_blocks((line + "\n" for line in lines), ASK_CHUNK_TOKEN_BUDGET)]
+        encoder.report("".join(chunks))
+        return "\n".join(await summarize_chunks(chunks, prompt=PROMPT_SUMMARIZE_PERIOD))
+
+    async def format_summaries(self, summaries: List[Tuple[datetime.datetime, str]], user_query: str,
+                               budget: int) -> str:
+        """
+        Format bucket summaries for the history section of a prompt, merging them
+        into summaries of longer periods if they don't fit into the budget
+
+        Args:
+            summaries: List of (bucket start, summary)
+            user_query: The user's question, used to focus merged summaries
+            budget: Token budget for the summaries
+
+        Returns:
+            str: Formatted summaries
+        """
+        parts = [
+            f"Підсумок за {start:%Y-%m-%d %H:%M}–{start + self.bucket:%H:%M}:\n{summary}\n---\n"
+            for start, summary in summaries
+        ]
+        return await reduce_chunks(list(pack_blocks(parts, ASK_CHUNK_TOKEN_BUDGET)), user_query, budget)
+
+# Shared store used by the query handler
+summary_store = SummaryStore(ASK_SUMMARY_BUCKET_MINUTES, ASK_SUMMARY_MAX_BUCKETS, ASK_SUMMARY_MAX_COLD_BUCKETS)
@@ -0,0 +1,132 @@
+"""
+Progressive Telegram replies for streamed LLM responses
+"""
+import asyncio
+import datetime
+import logging
+import time
+from typing import AsyncIterator, List, Optional
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+from utils.config import STREAMING_EDIT_INTERVAL
+
+# Telegram's limit for the text of a single message
+MAX_MESSAGE_LENGTH = 4096
+
+PLACEHOLDER = "…"
+
+def split_text(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Split text into pieces that fit into one message each, at line breaks or spaces where possible
+
+    Args:
+        text: Text to split
+        limit: Maximum length of a piece
+
+    Returns:
+        List of pieces, the whole text if it fits
+
+    >>> split_text("one two\\nthree four", limit=9)
+    ['one two', 'three', 'four']
+    >>> split_text("abcdefgh", limit=3)
+    ['abc', 'def', 'gh']
+    """
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        piece = text[:cut].rstrip()
+        if piece:
+            pieces.append(piece)
+        text = text[cut:].lstrip()
+    if text or not pieces:
+        pieces.append(text)
+    return pieces
+
+async def reply_long(message: Message, text: str) -> None:
+    """
+    Reply with text, split into several messages if it is longer than Telegram allows
+
+    Args:
+        message: Message to reply to
+        text: Reply text
+    """
+    for piece in split_text(text):
+        await message.reply_text(piece)
+
+async def _finish(message: Message, sent: Message, text: str, shown: str) -> None:
+    # The final text goes into the streamed reply, whatever doesn't fit follows in new messages
+    first, *rest = split_text(text)
+    if first != shown:
+        await _edit(sent, first, wait=True)
+    for piece in rest:
+        await message.reply_text(piece)
+
+async def _edit(message: Message, text: str, wait: bool = False) -> bool:
+    try:
+        await message.edit_text(text[:MAX_MESSAGE_LENGTH])
+        return True
+    except RetryAfter as e:
+        logging.warning(f"[telegram_stream] Edit throttled, retry after {e.retry_after}s")
+        if wait:
+            # The final text must not be lost, so wait for Telegram and try once more
+            delay = e.retry_after
+            if isinstance(delay, datetime.timedelta):
+                delay = delay.total_seconds()
+            await asyncio.sleep(delay)
+            return await _edit(message, text)
+        # Intermediate updates are skipped; the next one catches up
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return False
+
+async def reply_streaming(message: Message, chunks: AsyncIterator[str], prefix: str = "",
+                          min_interval: float = STREAMING_EDIT_INTERVAL) -> Optional[str]:
+    """
+    Reply with a placeholder and keep editing it as response chunks arrive.
+    Edits are sent at most once per min_interval seconds, plus a final one;
+    a response longer than one message is continued in follow-up replies.
+
+    Args:
+        message: Message to reply to
+        chunks: Stream of response pieces (e.g. from stream_model)
+        prefix: Text shown before the response
+        min_interval: Minimum seconds between two edits
+
+    Returns:
+        Optional[str]: The full response text (without prefix), or None if the stream
+            was empty (the placeholder is deleted then)
+    """
+    sent = await message.reply_text(prefix + PLACEHOLDER)
+    shown = prefix + PLACEHOLDER
+    parts = []
+    last_edit = time.monotonic()
+    try:
+        async for chunk in chunks:
+            parts.append(chunk)
+            if time.monotonic() - last_edit >= min_interval:
+                text = prefix + "".join(parts) + " " + PLACEHOLDER
+                if await _edit(sent, text):
+                    shown = text[:MAX_MESSAGE_LENGTH]
+                last_edit = time.monotonic()
+    except Exception:
+        # Don't leave a dangling placeholder behind, but report the stream's error, not the cleanup's
+        try:
+            if parts:
+                await _finish(message, sent, prefix + "".join(parts), shown)
+            else:
+                await sent.delete()
+        except Exception as e:
+            logging.warning(f"[telegram_stream] Failed to clean up the reply: {e}")
+        raise
+
+    response = "".join(parts).strip()
+    if not response:
+        await sent.delete()
+        return None
+    await _finish(message, sent, prefix + response, shown)
+    return response
@@ -0,0 +1,74 @@
+"""
+Concurrent update processing with per-chat ordering
+"""
+import asyncio
+from typing import Any, Awaitable, Dict, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# The base class limit is applied before an update's chat is known; it is kept out of the way
+UNLIMITED = 2 ** 31 - 1
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently, at most max_concurrent at a time,
+    while updates from the same chat run strictly one after another in arrival order
+    (so per-chat state such as message counters stays consistent).
+
+    An update waiting for an earlier update of its chat does not occupy a concurrency slot,
+    so one slow chat never holds up the others.
+    """
+
+    def __init__(self, max_concurrent: int):
+        """
+        Args:
+            max_concurrent: Maximum number of updates processed at the same time
+        """
+        super().__init__(max_concurrent_updates=UNLIMITED)
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be a positive integer")
+        self.max_concurrent = max_concurrent
+        self._limit: Optional[asyncio.Semaphore] = None
+        # chat_id -> future resolved when the chat's latest update has been processed
+        self._tails: Dict[int, asyncio.Future] = {}
+        self.pending = 0
+
+    async def initialize(self) -> None:
+        self._limit = asyncio.Semaphore(self.max_concurrent)
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def _chat_id(update: object) -> Optional[int]:
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if self._limit is None:
+            await self.initialize()
+        chat_id = self._chat_id(update)
+        # Take a place in the chat's queue before the first await, i.e. in arrival order
+        previous = self._tails.get(chat_id) if chat_id is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if chat_id is not None:
+            self._tails[chat_id] = done
+
+        self.pending += 1
+        started = False
+        try:
+            if previous is not None:
+                await asyncio.wait({previous})
+            async with self._limit:
+                started = True
+                await coroutine
+        finally:
+            self.pending -= 1
+            if not started and asyncio.iscoroutine(coroutine):
+                # Cancelled while waiting for its turn
+                coroutine.close()
+            if not done.done():
+                done.set_result(None)
+            if chat_id is not None and self._tails.get(chat_id) is done:
+                del self._tails[chat_id]
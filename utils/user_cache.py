@@ -0,0 +1,140 @@
+"""
+In-process cache of users known to exist in the database
+"""
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Iterable
+from utils.config import BOT_USER, USER_CACHE_MAX_SIZE, USER_CACHE_TTL, USER_ACTIVITY_INTERVAL
+from utils.metrics import CACHE_EVENTS, CACHE_SIZE
+
+class UserCache:
+    """
+    Bounded LRU cache of user rows with a TTL per entry.
+
+    Also remembers when last_activity was last written for each cached user,
+    so those writes can be debounced to at most one per interval.
+    Pinned users (the bot itself) are never evicted.
+    """
+
+    def __init__(self, max_size: int, ttl: float, activity_interval: float,
+                 pinned_ids: Iterable[int] = ()):
+        """
+        Args:
+            max_size: Maximum number of cached users
+            ttl: Seconds after which a cached user is looked up again
+            activity_interval: Minimum seconds between last_activity writes per user
+            pinned_ids: User IDs that are exempt from TTL and LRU eviction
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.activity_interval = activity_interval
+        self.pinned_ids = set(pinned_ids)
+        # user_id -> [user row, cached at, last_activity written at]
+        self._entries: "OrderedDict[int, list]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def size(self) -> int:
+        """
+        Number of cached users
+        """
+        return len(self._entries)
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Get a cached user row
+
+        Args:
+            user_id: Telegram user ID
+
+        Returns:
+            The user row, or None if the user is not cached or the entry expired
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None and user_id not in self.pinned_ids \
+                and time.monotonic() - entry[1] > self.ttl:
+            del self._entries[user_id]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            CACHE_EVENTS.labels("users", "miss").inc()
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        CACHE_EVENTS.labels("users", "hit").inc()
+        return entry[0]
+
+    def put(self, user_data: Dict[str, Any], activity_written: bool = False) -> None:
+        """
+        Remember a user that exists in the database
+
+        Args:
+            user_data: User row
+            activity_written: Whether last_activity was just written with the row
+        """
+        user_id = user_data["user_id"]
+        entry = self._entries.get(user_id)
+        activity_at = entry[2] if entry is not None else None
+        if activity_written:
+            activity_at = time.monotonic()
+        self._entries[user_id] = [user_data, time.monotonic(), activity_at]
+        self._entries.move_to_end(user_id)
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_size:
+            for user_id in self._entries:
+                if user_id not in self.pinned_ids:
+                    del self._entries[user_id]
+                    self.evictions += 1
+                    CACHE_EVENTS.labels("users", "eviction").inc()
+                    break
+            else:
+                return
+
+    def should_update_activity(self, user_id: int) -> bool:
+        """
+        Check whether last_activity should be written for a user now.
+        A positive answer is recorded as a write.
+
+        Args:
+            user_id: Telegram user ID
+
+        Returns:
+            False if the user's last_activity was written less than activity_interval ago
+        """
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return True
+        if entry[2] is not None and now - entry[2] < self.activity_interval:
+            return False
+        entry[2] = now
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache counters
+
+        Returns:
+            Dictionary with size, hits, misses, evictions and hit_rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+# Shared cache used by db_service
+user_cache = UserCache(
+    USER_CACHE_MAX_SIZE,
+    USER_CACHE_TTL,
+    USER_ACTIVITY_INTERVAL,
+    pinned_ids=[BOT_USER['user_id']] if BOT_USER else []
+)
+CACHE_SIZE.labels("users").set_function(lambda: user_cache.size)